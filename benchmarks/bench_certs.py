@@ -0,0 +1,119 @@
+"""Certificate renders per second.
+
+Compares the preloaded CertificateRenderer against the previous behaviour
+of opening the four fonts and decoding the template on every render.
+Both must draw the same image. Also reports the size and encode time of
+each rendition, and the cost of alternating between two templates with a
+template LRU that holds both or only one.
+
+	python benchmarks/bench_certs.py [--renders N]
+"""
+import argparse, datetime, io, json, sys, tempfile, time
+from pathlib import Path
+from PIL import Image, ImageDraw, ImageFont
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "src"))
+import certs
+
+def legacy_gen_cert(cert_id, user_name, user_score, submit_time):
+	fonts_path = certs.ASSETS_PATH / "fonts"
+	name_font = ImageFont.truetype(str(fonts_path / "Lato-Light.ttf"), 160)
+	serial_font = ImageFont.truetype(str(fonts_path / "Lato-Regular.ttf"), 55)
+	score_font = ImageFont.truetype(str(fonts_path / "Lato-Black.ttf"), 200)
+	date_font = ImageFont.truetype(str(fonts_path / "Lato-Light.ttf"), 75)
+
+	img = Image.open(str(certs.ASSETS_PATH / "cert_tpl.jpg"))
+	cert_width = img.width
+	draw = ImageDraw.Draw(img)
+
+	_, _, w, h = draw.textbbox((0, 0), user_name, font=name_font)
+	draw.text(((cert_width-w)/2, 740), user_name, font=name_font, fill="black")
+	cert_id_formatted = " ".join((cert_id[:4], cert_id[4:8], cert_id[8:]))
+	draw.text((495, 1580), cert_id_formatted, font=serial_font, fill="black")
+	_, _, w, h = draw.textbbox((0, 0), str(user_score), font=score_font)
+	draw.text(((cert_width-w)/2, 1150), str(user_score), font=score_font, fill="black")
+	date_formatted = datetime.datetime.fromtimestamp(submit_time).strftime("%B %d, %Y")
+	_, _, w, h = draw.textbbox((0, 0), date_formatted, font=date_font)
+	draw.text(((cert_width-w)/2, 1410), date_formatted, font=date_font, fill="black")
+
+	img_bytesio = io.BytesIO()
+	img.save(img_bytesio, "jpeg")
+	return img_bytesio.getvalue()
+
+def measure(fn, renders):
+	start = time.perf_counter()
+	for i in range(renders):
+		fn(str(10 ** 11 + i), f"Candidate {i}", 100 + i % 40, 1700000000 + i)
+	return renders / (time.perf_counter() - start)
+
+def two_template_manifest(directory):
+	# The default template plus a copy in another colour, assets shared
+	manifest = json.loads((certs.ASSETS_PATH / "manifest.json").read_text())
+	default = manifest["default"]
+	default["background"] = str(certs.ASSETS_PATH / default["background"])
+	for field in default["fields"].values():
+		field["font"] = str(certs.ASSETS_PATH / field["font"])
+	brand = json.loads(json.dumps(default))
+	for field in brand["fields"].values():
+		field["color"] = "#1a3d7c"
+	manifest["brand"] = brand
+	path = Path(directory) / "manifest.json"
+	path.write_text(json.dumps(manifest))
+	return path
+
+def measure_switching(manifest_path, max_bytes, renders):
+	renderer = certs.CertificateRenderer(manifest_path, max_bytes)
+	templates = ["default", "brand"]
+	start = time.perf_counter()
+	for i in range(renders):
+		renderer.draw(str(10 ** 11 + i), f"Candidate {i}", 100, 1700000000, templates[i % 2])
+	return renders / (time.perf_counter() - start), renderer.stats()
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+	parser.add_argument("--renders", type=int, default=50)
+	args = parser.parse_args()
+
+	renderer = certs.CertificateRenderer()
+
+	def preloaded_baseline(*args):
+		# Same encoder settings as the legacy code, to compare like for like
+		img_bytesio = io.BytesIO()
+		renderer.draw(*args).save(img_bytesio, "jpeg")
+		return img_bytesio.getvalue()
+
+	sample = ("123456789012", "Jane Doe", 120, 1700000000)
+	if legacy_gen_cert(*sample) != preloaded_baseline(*sample):
+		sys.exit("renderer output differs from the legacy rendering")
+
+	legacy = measure(legacy_gen_cert, args.renders)
+	preloaded = measure(preloaded_baseline, args.renders)
+	full = measure(renderer.render, args.renders)
+	stats = renderer.stats()
+
+	print(f"certificate renders, {args.renders} each")
+	print(f"  load fonts + template per render: {legacy:7.1f} renders/s")
+	print(f"  preloaded renderer:               {preloaded:7.1f} renders/s")
+	print(f"  speedup:                          {preloaded / legacy:7.2f}x")
+	print(f"  full rendition (progressive):     {full:7.1f} renders/s")
+	print(f"  avg render time (renderer stats): {stats['avg_ms']:7.1f} ms")
+
+	img = renderer.draw(*sample)
+	print(f"renditions (legacy baseline JPEG: {len(legacy_gen_cert(*sample)) // 1024} KB)")
+	for rendition, fmt in certs.variants():
+		start = time.perf_counter()
+		data = renderer.encode(renderer.resize(img, rendition), fmt)
+		elapsed = time.perf_counter() - start
+		width, height = renderer.size(rendition)
+		print(f"  {rendition:8} {fmt:5} {width:5}x{height:<5} {len(data) // 1024:5} KB  {elapsed * 1000:6.1f} ms")
+
+	with tempfile.TemporaryDirectory() as directory:
+		manifest_path = two_template_manifest(directory)
+		template_bytes = renderer.template("default").size_bytes
+		print(f"alternating between 2 templates ({template_bytes / 1024 / 1024:.1f} MB each), draws only")
+		for label, max_bytes in (("LRU holds both", 4 * template_bytes), ("LRU holds one", template_bytes)):
+			rate, stats = measure_switching(manifest_path, max_bytes, args.renders)
+			print(f"  {label}: {rate:7.1f} draws/s, {stats['template_loads']} template loads")
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,91 @@
+"""Indexed lookups on a large results table.
+
+Seeds a temporary database (1M rows by default) and times the lookups the
+app does per request: get_result, cert_id_exists, email_exists,
+delete_result and the newest results of one campaign. Exits non-zero if
+any of them averages above the budget (1 ms by default).
+
+    python benchmarks/bench_lookups.py [--rows N] [--calls N] [--budget-ms X]
+"""
+import argparse, random, sys, tempfile, time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "src"))
+import storage, sqlite_storage
+
+CAMPAIGNS = [f"camp{i:03d}" for i in range(200)]
+
+def seed(rows):
+	now = int(time.time())
+	batch = 100000
+	with storage.get_backend().db() as db:
+		for start in range(0, rows, batch):
+			db.cursor.executemany(sqlite_storage.INSERT_RESULT,
+				(sqlite_storage.insert_params((str(10 ** 11 + i), 100, 30,
+					now - i, None, f"User {i}", 3, f"user{i}@example.com", 600,
+					40, CAMPAIGNS[i % len(CAMPAIGNS)]))
+					for i in range(start, min(start + batch, rows))))
+
+def campaign_latest(slug):
+	with storage.get_backend().db() as db:
+		return db.cursor.execute(
+			f"SELECT {sqlite_storage.RESULT_COLUMNS} FROM results " \
+			"WHERE campaign_slug = ? " \
+			"ORDER BY submit_time DESC, id DESC LIMIT 50", (slug,)).fetchall()
+
+def measure(fn, args):
+	start = time.perf_counter()
+	for arg in args:
+		fn(arg)
+	return (time.perf_counter() - start) / len(args) * 1000
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+	parser.add_argument("--rows", type=int, default=1000000)
+	parser.add_argument("--calls", type=int, default=1000)
+	parser.add_argument("--budget-ms", type=float, default=1.0)
+	args = parser.parse_args()
+
+	with tempfile.TemporaryDirectory() as tmp:
+		backend = sqlite_storage.SQLiteBackend(Path(tmp) / "bench.db")
+		storage.set_backend(backend)
+		start = time.perf_counter()
+		seed(args.rows)
+		print(f"seeded {args.rows} rows in {time.perf_counter() - start:.1f}s")
+
+		existing = [str(10 ** 11 + random.randrange(args.rows))
+			for _ in range(args.calls)]
+		missing = [str(random.randrange(10 ** 11)) for _ in range(args.calls)]
+		known = [f"User{random.randrange(args.rows)}@Example.com "
+			for _ in range(args.calls)]
+		unknown = [f"new{random.randrange(args.rows)}@example.com"
+			for _ in range(args.calls)]
+		slugs = [random.choice(CAMPAIGNS) for _ in range(args.calls)]
+		doomed = random.sample(range(args.rows), args.calls)
+		doomed = [str(10 ** 11 + i) for i in doomed]
+
+		start = time.perf_counter()
+		storage.warm_up()
+		while backend.email_filter._building:
+			time.sleep(0.01)
+		print(f"built email filter in {time.perf_counter() - start:.1f}s")
+
+		timings = [
+			("get_result", measure(storage.get_result, existing)),
+			("cert_id_exists (miss)", measure(storage.cert_id_exists, missing)),
+			("email_exists (hit)", measure(storage.email_exists, known)),
+			("email_exists (miss)", measure(storage.email_exists, unknown)),
+			("campaign latest 50", measure(campaign_latest, slugs)),
+			("delete_result", measure(storage.delete_result, doomed)),
+		]
+		backend.close()
+
+	failed = False
+	for name, ms in timings:
+		over = ms > args.budget_ms
+		failed = failed or over
+		print(f"  {name:24s} {ms:8.3f} ms/call{'  OVER BUDGET' if over else ''}")
+	sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+	main()
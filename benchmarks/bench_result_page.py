@@ -0,0 +1,87 @@
+"""Result page renders per second.
+
+Compares filling result_template.html the previous way (read the file,
+four str.replace over the whole document, SHARETHIS_ADDIN from the
+environment) with the compiled PageTemplate, which must produce the same
+page. Then times a result view end to end, against a temporary SQLite
+database, for a tier 2 and a tier 3 result: rendering the page for every
+view (two lookups, as before), through the result page cache (one
+lookup), and answering a conditional GET with 304.
+
+	python benchmarks/bench_result_page.py [--renders N]
+"""
+import argparse, os, sys, tempfile, time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "src"))
+import storage, sqlite_storage, tester
+
+def legacy_fill(values):
+	return (tester.base_dir / "result_template.html").read_text(encoding="utf-8").replace(
+		"%title%", values["title"]).replace(
+		"%sharethis%", os.getenv("SHARETHIS_ADDIN")).replace(
+		"%og_meta%", values["og_meta"]).replace(
+		"%main%", values["main"])
+
+def compiled_fill(values):
+	return tester.result_template.render(sharethis=tester.sharethis_addin(), **values)
+
+def measure(fn, arg, renders):
+	start = time.perf_counter()
+	for _ in range(renders):
+		fn(*arg)
+	return renders / (time.perf_counter() - start)
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+	parser.add_argument("--renders", type=int, default=20000)
+	args = parser.parse_args()
+
+	os.environ.setdefault("SHARETHIS_ADDIN", "<script src=\"https://platform-api.sharethis.com/js/sharethis.js#property=x&product=inline-share-buttons\" async></script>")
+	values = {"title": "Jane Doe's IQ Test Result",
+		"og_meta": "<meta property=\"og:title\" content=\"Jane Doe's IQ Test Result\" />\n" * 8,
+		"main": "<div class=\"result plain\"><div class=\"score\">120</div></div>\n" * 4}
+	if legacy_fill(values) != compiled_fill(values):
+		sys.exit("compiled template output differs from the legacy replace chain")
+
+	legacy = measure(legacy_fill, (values,), args.renders)
+	compiled = measure(compiled_fill, (values,), args.renders)
+	print(f"result template fill, {args.renders} each")
+	print(f"  read + replace per render: {legacy:9.0f} renders/s")
+	print(f"  compiled template:         {compiled:9.0f} renders/s")
+	print(f"  speedup:                   {compiled / legacy:9.2f}x")
+
+	with tempfile.TemporaryDirectory() as tmp:
+		storage.set_backend(sqlite_storage.SQLiteBackend(Path(tmp) / "bench.db"))
+		storage.migrate()
+		now = int(time.time())
+		results = (("100000000002", 2), ("100000000003", 3))
+		for result_id, tier in results:
+			storage.insert_result((result_id, 120, 30, now, None, "Jane Doe", tier,
+				None, 600, 40, None), tester.new_cert_id)
+		domain = "https://example.com"
+
+		def uncached(result_id):
+			# The route's lookup, then get_result_page's own
+			storage.get_result(result_id)
+			return tester.get_result_page(storage.get_result(result_id), domain)
+
+		def cached(result_id):
+			result = storage.get_result(result_id)
+			return tester.result_pages.get(result, domain, tester.result_page_etag(result, domain))
+
+		def not_modified(result_id):
+			return tester.result_page_etag(storage.get_result(result_id), domain)
+
+		print(f"result views, SQLite backend, {args.renders} each")
+		for result_id, tier in results:
+			if cached(result_id) != uncached(result_id):
+				sys.exit("cached page differs from a fresh render")
+			for label, fn in (("rendered", uncached), ("cached", cached), ("304", not_modified)):
+				rate = measure(fn, (result_id,), args.renders)
+				print(f"  tier {tier} {label:9} {rate:9.0f} views/s")
+		print(f"  template loads: {tester.result_template.loads}")
+		storage.get_backend().close()
+
+if __name__ == "__main__":
+	main()
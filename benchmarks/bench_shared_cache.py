@@ -0,0 +1,89 @@
+"""Result lookups through the cross-worker shared cache.
+
+Seeds a temporary database (200k rows by default, the oldest half moved
+to monthly archive files), then times storage.get_result for recent and
+archived results: straight from the database, through the shared cache
+on a miss, and on a hit. Database reads and hits are also timed from several
+forked processes at once, which find what this one cached.
+
+	python benchmarks/bench_shared_cache.py [--rows N] [--calls N] [--workers N]
+"""
+import argparse, multiprocessing, random, sys, tempfile, time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "src"))
+import storage, sqlite_storage, shared_cache
+
+def seed(rows):
+	# One row every 60s, ending now: the older half spans several months
+	now = int(time.time())
+	batch = 100000
+	with storage.get_backend().db() as db:
+		for start in range(0, rows, batch):
+			db.cursor.executemany(sqlite_storage.INSERT_RESULT,
+				(sqlite_storage.insert_params((str(10 ** 11 + i), 100, 30,
+					now - i * 60, None, f"User {i}", 3, f"user{i}@example.com", 600,
+					40, None))
+					for i in range(start, min(start + batch, rows))))
+	return now - rows // 2 * 60
+
+def measure(ids):
+	start = time.perf_counter()
+	for result_id in ids:
+		if storage.get_result(result_id) is None:
+			sys.exit(f"result {result_id} not found")
+	return (time.perf_counter() - start) / len(ids) * 1000
+
+def measure_in_child(ids, queue):
+	queue.put(measure(ids))
+
+def measure_in_processes(ids, workers):
+	# Forked like gunicorn workers, all at once
+	context = multiprocessing.get_context("fork")
+	queue = context.Queue()
+	children = [context.Process(target=measure_in_child, args=(ids, queue))
+		for _ in range(workers)]
+	for child in children:
+		child.start()
+	elapsed = sum(queue.get() for _ in children) / len(children)
+	for child in children:
+		child.join()
+	return elapsed
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+	parser.add_argument("--rows", type=int, default=200000)
+	parser.add_argument("--calls", type=int, default=2000)
+	parser.add_argument("--workers", type=int, default=4)
+	args = parser.parse_args()
+
+	with tempfile.TemporaryDirectory() as tmp:
+		backend = sqlite_storage.SQLiteBackend(Path(tmp) / "bench.db")
+		storage.set_backend(backend)
+		archived = storage.archive_results(seed(args.rows))
+		print(f"seeded {args.rows} rows, {archived} archived")
+
+		half = args.rows // 2
+		samples = {
+			"recent": [str(10 ** 11 + random.randrange(half)) for _ in range(args.calls)],
+			"archived": [str(10 ** 11 + half + random.randrange(half)) for _ in range(args.calls)],
+		}
+		print(f"get_result, ms/call over {args.calls} random ids, " \
+			f"alone and in {args.workers} processes at once")
+		for name, ids in samples.items():
+			ids = list(dict.fromkeys(ids))
+			storage.shared_cache = shared_cache.SharedCache(Path(tmp) / f"{name}.db",
+				max_entries=args.rows)
+			direct = measure(ids)
+			direct_parallel = measure_in_processes(ids, args.workers)
+			storage.start_shared_cache()
+			miss = measure(ids)
+			hit = measure(ids)
+			# The children find what this process cached
+			hit_parallel = measure_in_processes(ids, args.workers)
+			print(f"  {name:8} database {direct:6.3f} / {direct_parallel:6.3f}  " \
+				f"cache miss {miss:6.3f}  hit {hit:6.3f} / {hit_parallel:6.3f}")
+		backend.close()
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,75 @@
+"""Per-call latency of storage.get_result.
+
+Compares the current pooled, migration-once path against the previous
+behaviour of opening a fresh connection per call and re-running the legacy
+ALTER TABLE / CREATE statements on it.
+
+    python benchmarks/bench_storage.py [--rows N] [--calls N]
+"""
+import argparse, random, sqlite3, sys, tempfile, time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "src"))
+import storage, sqlite_storage
+
+LEGACY_DDL = [
+	"ALTER TABLE results ADD COLUMN email text",
+	"ALTER TABLE results ADD COLUMN test_duration integer",
+	"ALTER TABLE results ADD COLUMN correct_answers integer",
+	"ALTER TABLE results ADD COLUMN campaign_slug text",
+	"CREATE TABLE campaigns (slug text PRIMARY KEY, name text UNIQUE, enabled integer DEFAULT 1)",
+	"ALTER TABLE campaigns ADD COLUMN enabled integer DEFAULT 1",
+	"CREATE UNIQUE INDEX IF NOT EXISTS idx_campaign_name_unique ON campaigns(name)",
+]
+
+def legacy_get_result(result_id):
+	conn = sqlite3.connect(storage.get_backend().db_path)
+	cursor = conn.cursor()
+	for statement in LEGACY_DDL:
+		try:
+			cursor.execute(statement)
+		except:
+			pass
+	row = cursor.execute(
+		"SELECT * FROM results WHERE id = ?", (result_id,)).fetchone()
+	conn.commit()
+	conn.close()
+	return storage.result_row_to_dict(row)
+
+def seed(rows):
+	now = int(time.time())
+	with storage.get_backend().db() as db:
+		db.cursor.executemany(sqlite_storage.INSERT_RESULT,
+			(sqlite_storage.insert_params((str(10 ** 11 + i), 100, 30, now - i,
+				None, f"User {i}", 3, f"user{i}@example.com", 600, 40, None))
+				for i in range(rows)))
+	return [str(10 ** 11 + i) for i in range(rows)]
+
+def measure(fn, ids, calls):
+	sample = [random.choice(ids) for _ in range(calls)]
+	start = time.perf_counter()
+	for result_id in sample:
+		fn(result_id)
+	return (time.perf_counter() - start) / calls * 1e6
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+	parser.add_argument("--rows", type=int, default=10000)
+	parser.add_argument("--calls", type=int, default=2000)
+	args = parser.parse_args()
+
+	with tempfile.TemporaryDirectory() as tmp:
+		backend = sqlite_storage.SQLiteBackend(Path(tmp) / "bench.db")
+		storage.set_backend(backend)
+		ids = seed(args.rows)
+		legacy_us = measure(legacy_get_result, ids, args.calls)
+		pooled_us = measure(storage.get_result, ids, args.calls)
+		backend.close()
+
+	print(f"get_result over {args.rows} rows, {args.calls} calls")
+	print(f"  connect + DDL per call: {legacy_us:9.1f} us/call")
+	print(f"  pooled, migrated once:  {pooled_us:9.1f} us/call")
+	print(f"  speedup:                {legacy_us / pooled_us:9.1f}x")
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,1090 @@
+"""Certificate rendering and caching.
+
+A CertificateRenderer loads the certificate templates of the manifest and
+their fonts once per process, then renders each certificate on an
+in-memory copy of the decoded template. A CertificateCache keeps rendered certificates on disk,
+shared by all workers. A RenderPool renders them in separate processes, so
+a burst of certificate views doesn't take the CPU from the other routes,
+and a Prerenderer fills the cache in the background as results are
+submitted. `iter_certificate_zip` streams many certificates as one ZIP.
+`renderer`, `cache`, `pool` and `prerenderer` are the process-wide
+instances.
+"""
+import atexit, collections, concurrent.futures, contextlib, ctypes, datetime, fcntl, hashlib
+import io, json, math, multiprocessing, os, queue, re, shutil, signal, threading, time
+import traceback, zipfile
+from pathlib import Path
+from PIL import Image, ImageDraw, ImageFont
+import storage
+
+ASSETS_PATH = Path(__file__).parent / "cert_assets"
+
+# Part of the renderer version: bump when the drawing code changes, so
+# certificates cached with the old layout are no longer served
+RENDER_VERSION = 1
+
+DEFAULT_TEMPLATE = "default"
+
+# Named sizes a certificate is served in. "width" None keeps the template
+# size; "formats" are in order of preference, the last one being what
+# clients that don't accept the others get.
+RENDITIONS = {
+	# The download link
+	"full": {"width": None, "formats": ["jpeg"]},
+	# Shown on the result page
+	"preview": {"width": 1000, "formats": ["webp", "jpeg"]},
+	# og:image: crawlers don't all read WebP
+	"social": {"width": 1200, "formats": ["jpeg"]},
+}
+
+FORMATS = {
+	"jpeg": {"mime": "image/jpeg", "ext": "jpg"},
+	"webp": {"mime": "image/webp", "ext": "webp"},
+}
+
+def variants():
+	"""Every (rendition, format) pair a certificate is served as."""
+	return [(rendition, fmt) for rendition, spec in RENDITIONS.items() for fmt in spec["formats"]]
+
+def negotiate(rendition, accept):
+	"""Picks the format of a rendition for a request's Accept header.
+
+	A preferred format is only served to clients naming its type with a
+	non-zero q: `image/*` and `*/*` are sent by browsers that can't
+	decode WebP too.
+	"""
+	formats = RENDITIONS[rendition]["formats"]
+	accepted = accepted_types(accept)
+	for fmt in formats[:-1]:
+		if accepted.get(FORMATS[fmt]["mime"], 0) > 0:
+			return fmt
+	return formats[-1]
+
+def accepted_types(accept):
+	"""Returns {media type: q} for the media ranges of an Accept header."""
+	accepted = {}
+	for media_range in (accept or "").lower().split(","):
+		media_type, *params = media_range.split(";")
+		q = 1.0
+		for param in params:
+			name, _, value = param.partition("=")
+			if name.strip() == "q":
+				try:
+					q = float(value)
+				except ValueError:
+					q = 0.0
+		if media_type.strip():
+			accepted[media_type.strip()] = q
+	return accepted
+
+def is_cached_file(name):
+	# Skips the temp files of writes in progress
+	return name.rpartition(".")[2] in [spec["ext"] for spec in FORMATS.values()]
+
+def template_of(result):
+	"""Returns the name of the certificate template of a result.
+
+	That is its campaign's template, or the default one. Results handed to
+	render processes carry it as "cert_template" (see `with_template`), so
+	those never touch the database.
+	"""
+	name = result.get("cert_template")
+	if name is None and result.get("campaign_slug"):
+		campaign = storage.get_campaign_by_slug(result["campaign_slug"])
+		name = campaign and campaign.get("cert_template")
+	return renderer.resolve(name)
+
+def with_template(result):
+	return dict(result, cert_template=template_of(result))
+
+class CertificateTemplate():
+	"""A template of the manifest, ready to draw on.
+
+	Holds the decoded background image and the fonts of its fields.
+	`size_bytes` is roughly what it takes in memory.
+	"""
+	def __init__(self, name, spec, base_path):
+		self.name = name
+		background = Image.open(str(base_path / spec["background"]))
+		background.load()
+		self.image = background
+		self.size_bytes = background.width * background.height * len(background.getbands())
+		fonts = {}
+		self.fields = []
+		for field, field_spec in spec["fields"].items():
+			key = (field_spec["font"], field_spec["size"])
+			if key not in fonts:
+				font_path = base_path / field_spec["font"]
+				fonts[key] = ImageFont.truetype(str(font_path), field_spec["size"])
+				self.size_bytes += font_path.stat().st_size
+			self.fields.append((field, field_spec, fonts[key]))
+
+class CertificateRenderer():
+	"""Renders result certificates as JPEG or WebP.
+
+	Templates are described in a manifest (cert_assets/manifest.json, or
+	CERT_TEMPLATES_MANIFEST): a background image and, for each field
+	(name, serial, score, date), its font, size, position and alignment.
+	Campaigns pick one by name; results without one use "default".
+
+	Decoded templates are kept in an LRU of at most CERT_TEMPLATE_CACHE_MB
+	per process (the most recent one always stays), so switching between
+	brands doesn't read the assets again for every certificate. Render
+	times are recorded: `render_timed` returns the time of one render and
+	`stats()` sums them up.
+
+	`version(template)` hashes the template's manifest entry and assets,
+	the renditions, the encoder quality and RENDER_VERSION, and
+	`modified(template)` is the newest asset mtime: a certificate is fully
+	defined by its result row and these.
+	"""
+	def __init__(self, manifest_path=None, max_bytes=None):
+		self._manifest_path = manifest_path
+		self._max_bytes = max_bytes
+		self._load_lock = threading.Lock()
+		# FreeType faces aren't safe to use from several threads at once
+		self._draw_lock = threading.Lock()
+		self._stats_lock = threading.Lock()
+		self._manifest = None
+		self._infos = {}
+		self._templates = collections.OrderedDict()
+		self._templates_bytes = 0
+		self.quality = None
+		self.template_loads = 0
+		self.render_count = 0
+		self.render_seconds = 0.0
+
+	def manifest_path(self):
+		if self._manifest_path is None:
+			return Path(os.getenv("CERT_TEMPLATES_MANIFEST") or ASSETS_PATH / "manifest.json")
+		return Path(self._manifest_path)
+
+	def max_bytes(self):
+		if self._max_bytes is None:
+			return int(os.getenv("CERT_TEMPLATE_CACHE_MB", "256")) * 1024 * 1024
+		return self._max_bytes
+
+	def load(self):
+		"""Reads the manifest and preloads the default template."""
+		if self._manifest is None:
+			self._load_manifest()
+			self.template(DEFAULT_TEMPLATE)
+
+	def _load_manifest(self):
+		# Enough for names, labels and cache keys; templates are decoded
+		# only to draw, so these lookups don't reorder the LRU
+		if self._manifest is None:
+			with self._load_lock:
+				if self._manifest is None:
+					self.quality = {
+						"jpeg": int(os.getenv("CERT_JPEG_QUALITY", "75")),
+						"webp": int(os.getenv("CERT_WEBP_QUALITY", "75")),
+					}
+					self._manifest = json.loads(self.manifest_path().read_text(encoding="utf-8"))
+
+	def template_names(self):
+		self._load_manifest()
+		return list(self._manifest)
+
+	def label(self, name):
+		self._load_manifest()
+		return self._manifest[name].get("label", name)
+
+	def resolve(self, name):
+		"""Returns `name` if the manifest has it, else the default template."""
+		self._load_manifest()
+		if name in self._manifest:
+			return name
+		return DEFAULT_TEMPLATE
+
+	def _info(self, name):
+		# What pages and cache keys need, without decoding the template
+		info = self._infos.get(name)
+		if info is None:
+			self._load_manifest()
+			spec = self._manifest[name]
+			base_path = self.manifest_path().parent
+			paths = [base_path / spec["background"]] + \
+				sorted({base_path / field["font"] for field in spec["fields"].values()})
+			digest = hashlib.sha256(json.dumps(
+				[RENDER_VERSION, RENDITIONS, self.quality, spec], sort_keys=True).encode())
+			for path in paths:
+				digest.update(path.read_bytes())
+			with Image.open(str(paths[0])) as background:
+				size = background.size
+			info = {
+				"version": digest.hexdigest()[:16],
+				"modified": max(int(path.stat().st_mtime) for path in paths),
+				"size": size,
+			}
+			self._infos[name] = info
+		return info
+
+	def version(self, template=DEFAULT_TEMPLATE):
+		return self._info(template)["version"]
+
+	def modified(self, template=DEFAULT_TEMPLATE):
+		return self._info(template)["modified"]
+
+	def template(self, name):
+		"""Returns a loaded template, through the LRU."""
+		with self._load_lock:
+			template = self._templates.get(name)
+			if template is not None:
+				self._templates.move_to_end(name)
+				return template
+			template = CertificateTemplate(name, self._manifest[name], self.manifest_path().parent)
+			self._templates[name] = template
+			self._templates_bytes += template.size_bytes
+			self.template_loads += 1
+			while self._templates_bytes > self.max_bytes() and len(self._templates) > 1:
+				_, evicted = self._templates.popitem(last=False)
+				self._templates_bytes -= evicted.size_bytes
+			return template
+
+	def size(self, rendition, template=DEFAULT_TEMPLATE):
+		"""Returns the (width, height) of a rendition."""
+		template_width, template_height = self._info(template)["size"]
+		width = RENDITIONS[rendition]["width"] or template_width
+		return width, round(template_height * width / template_width)
+
+	def draw(self, cert_id, user_name, user_score, submit_time, template=DEFAULT_TEMPLATE):
+		"""Returns the full-size certificate image."""
+		self._load_manifest()
+		template = self.template(template)
+		img = template.image.copy()
+		cert_width = img.width
+		texts = {
+			"name": user_name,
+			"serial": " ".join((cert_id[:4], cert_id[4:8], cert_id[8:])),
+			"score": str(user_score),
+		}
+
+		with self._draw_lock:
+			draw = ImageDraw.Draw(img)
+			for field, spec, font in template.fields:
+				if field == "date":
+					text = datetime.datetime.fromtimestamp(
+						submit_time).strftime(spec.get("format", "%B %d, %Y"))
+				else:
+					text = texts[field]
+				x = spec.get("x", cert_width / 2)
+				if spec.get("align") == "center":
+					_, _, w, h = draw.textbbox((0, 0), text, font=font)
+					x -= w / 2
+				draw.text((x, spec["y"]), text, font=font, fill=spec.get("color", "black"))
+		return img
+
+	def resize(self, img, rendition, template=DEFAULT_TEMPLATE):
+		size = self.size(rendition, template)
+		if size == img.size:
+			return img
+		# Box-reducing by a whole factor first is ~2x faster than a
+		# Lanczos resize of the full image, and looks the same
+		factor = img.width // size[0]
+		if factor > 1:
+			img = img.reduce(factor)
+		return img.resize(size, Image.LANCZOS)
+
+	def encode(self, img, fmt):
+		img_bytesio = io.BytesIO()
+		if fmt == "jpeg":
+			img.save(img_bytesio, "jpeg", quality=self.quality["jpeg"], progressive=True)
+		else:
+			# method 2 encodes twice as fast as the default 4, for ~3% more bytes
+			img.save(img_bytesio, fmt, quality=self.quality[fmt], method=2)
+		return img_bytesio.getvalue()
+
+	def render(self, cert_id, user_name, user_score, submit_time, rendition="full", fmt="jpeg",
+			template=DEFAULT_TEMPLATE):
+		return self.render_timed(cert_id, user_name, user_score, submit_time,
+			rendition, fmt, template)[0]
+
+	def render_timed(self, cert_id, user_name, user_score, submit_time, rendition="full", fmt="jpeg",
+			template=DEFAULT_TEMPLATE):
+		"""Renders a certificate, returns the image bytes and the seconds taken."""
+		renders, elapsed = self.render_variants(cert_id, user_name, user_score,
+			submit_time, [(rendition, fmt)], template)
+		return renders[rendition, fmt], elapsed
+
+	def render_variants(self, cert_id, user_name, user_score, submit_time, wanted,
+			template=DEFAULT_TEMPLATE):
+		"""Draws a certificate once and encodes it as each (rendition, format).
+
+		Returns {(rendition, format): bytes} and the seconds taken.
+		"""
+		start = time.perf_counter()
+		img = self.draw(cert_id, user_name, user_score, submit_time, template)
+		resized = {}
+		renders = {}
+		for rendition, fmt in wanted:
+			if rendition not in resized:
+				resized[rendition] = self.resize(img, rendition, template)
+			renders[rendition, fmt] = self.encode(resized[rendition], fmt)
+		elapsed = time.perf_counter() - start
+		with self._stats_lock:
+			self.render_count += 1
+			self.render_seconds += elapsed
+		return renders, elapsed
+
+	def stats(self):
+		with self._stats_lock:
+			count, seconds = self.render_count, self.render_seconds
+		with self._load_lock:
+			templates, templates_bytes = len(self._templates), self._templates_bytes
+		return {
+			"renders": count,
+			"avg_ms": seconds / count * 1000 if count else None,
+			"templates_loaded": templates,
+			"templates_mb": round(templates_bytes / 1024 / 1024, 1),
+			"template_loads": self.template_loads,
+		}
+
+class CertificateCache():
+	"""Rendered certificates on disk, shared by all workers.
+
+	A certificate only depends on its result row, which never changes, and
+	on the version of its template, so files are named after both (and the
+	rendition and format): a new template, or a campaign switching to
+	another one, simply stops matching the old files. Hits refresh a file's
+	mtime, and the least recently used files are deleted to keep the
+	directory under CERT_CACHE_MAX_MB.
+	"""
+	def __init__(self, renderer, directory=None, max_bytes=None):
+		self.renderer = renderer
+		self._directory = directory
+		self._max_bytes = max_bytes
+		self._lock = threading.Lock()
+		# Bytes this process believes are on disk, re-counted before evicting
+		self._size = None
+
+	def directory(self):
+		if self._directory is None:
+			return Path(os.getenv("CERT_CACHE_DIR") or Path(__file__).parent / "cert_cache")
+		return Path(self._directory)
+
+	def max_bytes(self):
+		if self._max_bytes is None:
+			return int(os.getenv("CERT_CACHE_MAX_MB", "1024")) * 1024 * 1024
+		return self._max_bytes
+
+	def path(self, result, rendition="full", fmt="jpeg"):
+		result_id = result["id"]
+		version = self.renderer.version(template_of(result))
+		# Sharded by the last digits, so no directory gets huge
+		return self.directory() / result_id[-2:] / \
+			f"{result_id}-{version}-{rendition}.{FORMATS[fmt]['ext']}"
+
+	def etag(self, result, rendition="full", fmt="jpeg"):
+		version = self.renderer.version(template_of(result))
+		return f'"{result["id"]}-{version}-{rendition}-{fmt}"'
+
+	def last_modified(self, result):
+		return max(result["submit_time"] or 0, self.renderer.modified(template_of(result)))
+
+	def missing(self, result):
+		"""Returns the variants of a certificate that aren't cached."""
+		return [(rendition, fmt) for rendition, fmt in variants()
+			if not self.path(result, rendition, fmt).exists()]
+
+	def fetch(self, result, rendition="full", fmt="jpeg"):
+		"""Returns the path of a certificate variant, rendering it if needed.
+
+		Also returns the render time in seconds, None on a cache hit.
+		"""
+		path = self.path(result, rendition, fmt)
+		try:
+			os.utime(path)
+			return path, None
+		except FileNotFoundError:
+			pass
+		data, elapsed = self.renderer.render_timed(result["id"], result["user_name"],
+			result["score"], result["submit_time"], rendition, fmt, template_of(result))
+		self.store(path, data)
+		return path, elapsed
+
+	def fill(self, result):
+		"""Renders every variant of a certificate that isn't cached yet."""
+		wanted = self.missing(result)
+		if not wanted:
+			return
+		renders, _ = self.renderer.render_variants(result["id"], result["user_name"],
+			result["score"], result["submit_time"], wanted, template_of(result))
+		for (rendition, fmt), data in renders.items():
+			self.store(self.path(result, rendition, fmt), data)
+
+	def fetch_locked(self, result, rendition="full", fmt="jpeg"):
+		"""Like `fetch`, but one process at a time per shard.
+
+		Workers asking for a certificate that is being rendered wait for
+		it and then read the file, instead of rendering it again.
+		"""
+		with self._shard_lock(result["id"]):
+			return self.fetch(result, rendition, fmt)
+
+	def fill_locked(self, result):
+		with self._shard_lock(result["id"]):
+			self.fill(result)
+
+	@contextlib.contextmanager
+	def _shard_lock(self, result_id):
+		shard = self.directory() / result_id[-2:]
+		shard.mkdir(parents=True, exist_ok=True)
+		with open(shard / ".lock", "a") as lock_file:
+			fcntl.flock(lock_file, fcntl.LOCK_EX)
+			try:
+				yield
+			finally:
+				fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+	def store(self, path, data):
+		path.parent.mkdir(parents=True, exist_ok=True)
+		# Write and rename, so other workers never read a partial file
+		tmp_path = path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+		tmp_path.write_bytes(data)
+		os.replace(tmp_path, path)
+		self._added(len(data))
+
+	def invalidate(self, result_id):
+		"""Deletes the cached certificates of a result, in any version."""
+		if not result_id.isalnum():
+			return
+		for path in (self.directory() / result_id[-2:]).glob(f"{result_id}-*"):
+			if not is_cached_file(path.name):
+				continue
+			try:
+				size = path.stat().st_size
+				path.unlink()
+			except FileNotFoundError:
+				continue
+			self._added(-size)
+
+	def _added(self, size):
+		with self._lock:
+			if self._size is None:
+				self._size = sum(file_size for _, file_size, _ in self._files())
+			else:
+				self._size += size
+			if self._size > self.max_bytes():
+				self._evict()
+
+	def _files(self):
+		files = []
+		try:
+			shards = [entry.path for entry in os.scandir(self.directory()) if entry.is_dir()]
+		except FileNotFoundError:
+			return files
+		for shard in shards:
+			for entry in os.scandir(shard):
+				if not is_cached_file(entry.name):
+					continue
+				try:
+					stat = entry.stat()
+				except FileNotFoundError:
+					continue
+				files.append((stat.st_mtime, stat.st_size, entry.path))
+		return files
+
+	def _evict(self):
+		# Other workers add files too: count what is really there, then
+		# delete the least recently used down to 90% of the limit
+		files = sorted(self._files())
+		size = sum(file_size for _, file_size, _ in files)
+		target = self.max_bytes() * 0.9
+		for _, file_size, path in files:
+			if size <= target:
+				break
+			try:
+				os.unlink(path)
+			except FileNotFoundError:
+				pass
+			size -= file_size
+		self._size = size
+
+class RenderBusy(Exception):
+	"""The render pool is full, or a render took too long.
+
+	`retry_after` is how many seconds the client should wait.
+	"""
+	def __init__(self, retry_after):
+		super().__init__(f"Certificate rendering busy, retry after {retry_after}s")
+		self.retry_after = retry_after
+
+class RenderPool():
+	"""Renders certificates into the cache in child processes.
+
+	Renders are CPU-bound and hold the GIL, so they run in
+	CERT_RENDER_PROCESSES forked children (0 renders in the calling
+	thread). A request waiting for a render holds one of the host's
+	CERT_RENDER_SLOTS, lock files shared by every worker: with all of them
+	taken, `fetch` raises RenderBusy at once, so a burst of certificate
+	misses can't tie up every sync worker. It also raises it when this
+	worker already has CERT_RENDER_QUEUE_SIZE renders running or queued,
+	and when a render takes longer than CERT_RENDER_TIMEOUT seconds.
+	Concurrent requests for the same certificate share one render; across
+	workers, the cache's shard lock makes the second one read the file
+	the first one wrote.
+	"""
+	def __init__(self, cache, processes=None, max_queued=None, timeout=None, slots=None):
+		self.cache = cache
+		self._processes = processes
+		self._max_queued = max_queued
+		self._timeout = timeout
+		self._slots = slots
+		self._lock = threading.Lock()
+		self._executor = None
+		self._futures = {}
+		self._queued = 0
+		self._render_count = 0
+		self._render_seconds = 0.0
+
+	def processes(self):
+		if self._processes is None:
+			return int(os.getenv("CERT_RENDER_PROCESSES", "1"))
+		return self._processes
+
+	def max_queued(self):
+		if self._max_queued is None:
+			return int(os.getenv("CERT_RENDER_QUEUE_SIZE", "4"))
+		return self._max_queued
+
+	def timeout(self):
+		if self._timeout is None:
+			return float(os.getenv("CERT_RENDER_TIMEOUT", "15"))
+		return self._timeout
+
+	def slots(self):
+		if self._slots is None:
+			return int(os.getenv("CERT_RENDER_SLOTS", "2"))
+		return self._slots
+
+	def start(self):
+		"""Forks the render processes.
+
+		Called at startup, before the server starts its threads. Forking
+		doesn't wait for other threads, though: the export pool forks
+		while this pool's manager thread runs, and a pool that lost a
+		child is forked again with every thread running. A lock another
+		thread held at that moment stays locked in the child, so children
+		only use the renderer and the cache, whose locks `reinit_locks`
+		re-creates after a fork.
+		"""
+		if self.processes() > 0:
+			with self._lock:
+				self._get_executor()
+
+	def _get_executor(self):
+		if self._executor is None:
+			self.cache.renderer.load()
+			self._executor = concurrent.futures.ProcessPoolExecutor(self.processes(),
+				mp_context=multiprocessing.get_context("fork"),
+				initializer=exit_with_parent, initargs=(os.getpid(),))
+			# With fork, creating the first task forks every child at once
+			self._executor.submit(int).result()
+			atexit.register(self._executor.shutdown, cancel_futures=True)
+		return self._executor
+
+	def fetch(self, result, rendition="full", fmt="jpeg", background=False):
+		"""Returns the path of a certificate variant, rendering it if needed.
+
+		Also returns the render time in seconds, None on a cache hit.
+		Raises RenderBusy when the pool can't take it. `background` callers
+		hold no request, so they don't take a slot.
+		"""
+		result = with_template(result)
+		path = self.cache.path(result, rendition, fmt)
+		try:
+			os.utime(path)
+			return path, None
+		except FileNotFoundError:
+			pass
+		with self._render_slot(background):
+			if self.processes() <= 0:
+				return self.cache.fetch_locked(result, rendition, fmt)
+			future = self._submit((result["id"], rendition, fmt),
+				render_task, result, rendition, fmt)
+			return self._wait(future)
+
+	@contextlib.contextmanager
+	def _render_slot(self, background=False):
+		# Non-blocking: a full host answers 503 rather than queueing
+		if background or self.slots() <= 0:
+			yield
+			return
+		directory = self.cache.directory() / "slots"
+		directory.mkdir(parents=True, exist_ok=True)
+		for slot in range(self.slots()):
+			lock_file = open(directory / f"{slot}.lock", "a")
+			try:
+				fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+			except BlockingIOError:
+				lock_file.close()
+				continue
+			try:
+				yield
+			finally:
+				# Explicitly: a child forked meanwhile shares the file
+				fcntl.flock(lock_file, fcntl.LOCK_UN)
+				lock_file.close()
+			return
+		with self._lock:
+			raise RenderBusy(self._retry_after(self.slots()))
+
+	def fill(self, result):
+		"""Renders every missing variant; used by the Prerenderer.
+
+		Background jobs are never turned away, but count towards the queue
+		size, so requests see the pool as busy while they run.
+		"""
+		result = with_template(result)
+		if not self.cache.missing(result):
+			return
+		if self.processes() <= 0:
+			self.cache.fill_locked(result)
+			return
+		future = self._submit((result["id"], None, None), fill_task, result, force=True)
+		self._wait(future)
+
+	def _submit(self, key, task, *args, force=False):
+		with self._lock:
+			future = self._futures.get(key)
+			if future is not None:
+				return future
+			if self._queued >= self.max_queued() and not force:
+				raise RenderBusy(self._retry_after())
+			try:
+				future = self._get_executor().submit(task, *args)
+			except concurrent.futures.process.BrokenProcessPool:
+				# A child died: start over with a new pool next time
+				self._executor = None
+				raise RenderBusy(1)
+			except RuntimeError:
+				# Shutting down
+				raise RenderBusy(1)
+			self._futures[key] = future
+			self._queued += 1
+		future.add_done_callback(lambda future: self._done(key, future))
+		return future
+
+	def _done(self, key, future):
+		with self._lock:
+			self._futures.pop(key, None)
+			self._queued -= 1
+			if not future.cancelled() and future.exception() is None:
+				_, seconds = future.result()
+				if seconds is not None:
+					self._render_count += 1
+					self._render_seconds += seconds
+
+	def _wait(self, future):
+		try:
+			return future.result(timeout=self.timeout())
+		except concurrent.futures.TimeoutError:
+			# The render goes on and fills the cache for the retry
+			with self._lock:
+				raise RenderBusy(self._retry_after())
+		except concurrent.futures.process.BrokenProcessPool:
+			with self._lock:
+				self._executor = None
+			raise RenderBusy(1)
+
+	def _retry_after(self, queued=None):
+		# Time for the pool to work through what is queued now
+		if queued is None:
+			queued = self._queued
+		average = self._render_seconds / self._render_count if self._render_count else 0.2
+		seconds = math.ceil(queued * average / max(self.processes(), 1))
+		return min(max(seconds, 1), 60)
+
+	def stats(self):
+		with self._lock:
+			count, seconds, queued = self._render_count, self._render_seconds, self._queued
+		return {
+			"renders": count,
+			"avg_ms": seconds / count * 1000 if count else None,
+			"queued": queued,
+		}
+
+def render_task(result, rendition, fmt):
+	# Runs in a pool process
+	return cache.fetch_locked(result, rendition, fmt)
+
+def fill_task(result):
+	# Runs in a pool process
+	start = time.perf_counter()
+	cache.fill_locked(result)
+	return None, time.perf_counter() - start
+
+PR_SET_PDEATHSIG = 1
+
+def exit_with_parent(parent_pid):
+	"""Makes a pool process exit when the worker that forked it dies.
+
+	A worker killed by gunicorn's timeout or the OOM killer can't shut its
+	pool down, and the orphans would keep the templates and the server's
+	output pipes. On Linux the kernel sends SIGKILL when the parent goes;
+	elsewhere a thread polls for it.
+	"""
+	try:
+		libc = ctypes.CDLL(None, use_errno=True)
+		watched = libc.prctl(PR_SET_PDEATHSIG, signal.SIGKILL, 0, 0, 0) == 0
+	except (OSError, AttributeError):
+		watched = False
+	if not watched:
+		def poll():
+			while os.getppid() == parent_pid:
+				time.sleep(1)
+			os._exit(0)
+		threading.Thread(target=poll, daemon=True).start()
+	if os.getppid() != parent_pid:
+		# Died before the signal was armed
+		os._exit(0)
+
+def reinit_locks():
+	# Locks held by another thread at fork time stay locked in the child
+	renderer._load_lock = threading.Lock()
+	renderer._draw_lock = threading.Lock()
+	renderer._stats_lock = threading.Lock()
+	cache._lock = threading.Lock()
+	pool._lock = threading.Lock()
+	pool._executor = None
+	pool._futures = {}
+	pool._queued = 0
+	export_pool._lock = threading.Lock()
+	export_pool._executor = None
+	export_pool._exports = 0
+
+class Prerenderer():
+	"""Renders certificates into the cache in the background.
+
+	Every job is first written as a marker file to the cache's pending/
+	directory, holding what the certificate needs (id, user_name, score,
+	submit_time), so it doesn't depend on the result being in the database
+	yet and survives a restart: `start()` queues the markers left behind.
+	The in-memory queue is bounded; jobs that don't fit stay on disk and
+	are picked up once the queue has drained. A certificate viewed before
+	its job ran is rendered on demand by /cert, and the job then only
+	renders the variants still missing. Functions in `listeners` are then
+	called with the job, as a tier-3 result.
+	"""
+	def __init__(self, cache, pool, max_queued=None):
+		self.cache = cache
+		self.pool = pool
+		self.listeners = []
+		self._max_queued = max_queued
+		self._queue = None
+		self._overflowed = threading.Event()
+
+	def enabled(self):
+		return self.max_queued() > 0
+
+	def max_queued(self):
+		if self._max_queued is None:
+			return int(os.getenv("CERT_PRERENDER_QUEUE_SIZE", "1000"))
+		return self._max_queued
+
+	def pending_dir(self):
+		return self.cache.directory() / "pending"
+
+	def start(self):
+		"""Starts the render thread and queues the jobs left from a previous run."""
+		if not self.enabled() or self._queue is not None:
+			return
+		self._queue = queue.Queue(self.max_queued())
+		self._overflowed.set()
+		threading.Thread(target=self._run, daemon=True).start()
+
+	def enqueue(self, result):
+		if not self.enabled() or result["result_tier"] != 3:
+			return
+		job = {key: result[key] for key in ("id", "user_name", "score", "submit_time")}
+		job["cert_template"] = template_of(result)
+		pending_dir = self.pending_dir()
+		pending_dir.mkdir(parents=True, exist_ok=True)
+		marker = pending_dir / f"{job['id']}.json"
+		tmp_path = marker.with_name(f"{marker.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+		tmp_path.write_text(json.dumps(job))
+		os.replace(tmp_path, marker)
+		if self._queue is None:
+			# Not running here (e.g. a maintenance command): the next start
+			# picks the marker up
+			return
+		try:
+			self._queue.put_nowait(job)
+		except queue.Full:
+			self._overflowed.set()
+
+	def discard(self, result_id):
+		"""Drops the pending job of a deleted result."""
+		if result_id.isalnum():
+			try:
+				(self.pending_dir() / f"{result_id}.json").unlink()
+			except FileNotFoundError:
+				pass
+
+	def is_pending(self, result_id):
+		return (self.pending_dir() / f"{result_id}.json").exists()
+
+	def pending_count(self):
+		try:
+			return sum(1 for name in os.listdir(self.pending_dir()) if name.endswith(".json"))
+		except FileNotFoundError:
+			return 0
+
+	def _run(self):
+		while True:
+			if self._overflowed.is_set() and self._queue.empty():
+				self._overflowed.clear()
+				self._requeue()
+			try:
+				job = self._queue.get(timeout=1)
+			except queue.Empty:
+				continue
+			try:
+				self._render(job)
+			except RenderBusy:
+				# The marker stays: try again once the queue has drained
+				self._overflowed.set()
+				time.sleep(1)
+			except Exception:
+				print(traceback.format_exc())
+
+	def _requeue(self):
+		try:
+			names = sorted(os.listdir(self.pending_dir()))
+		except FileNotFoundError:
+			return
+		for name in names:
+			if not name.endswith(".json"):
+				continue
+			try:
+				job = json.loads((self.pending_dir() / name).read_text())
+			except (FileNotFoundError, ValueError):
+				continue
+			try:
+				self._queue.put_nowait(job)
+			except queue.Full:
+				self._overflowed.set()
+				return
+
+	def _render(self, job):
+		marker = self.pending_dir() / f"{job['id']}.json"
+		if not marker.exists():
+			# Deleted, or already done by another worker
+			return
+		self.pool.fill(job)
+		for listener in self.listeners:
+			# Only tier-3 results are queued
+			listener(dict(job, result_tier=3))
+		try:
+			marker.unlink()
+		except FileNotFoundError:
+			pass
+
+class ZipStream():
+	"""Write-only file that hands out what was written since the last `take()`.
+
+	zipfile sees it as unseekable and writes sizes after each entry, so a
+	ZIP can be produced entry by entry without ever holding all of it.
+	"""
+	def __init__(self):
+		self._chunks = []
+
+	def write(self, data):
+		self._chunks.append(bytes(data))
+		return len(data)
+
+	def flush(self):
+		pass
+
+	def take(self):
+		data = b"".join(self._chunks)
+		self._chunks = []
+		return data
+
+def zip_entry_name(result, fmt):
+	# Readable in a file browser, unique thanks to the id
+	name = re.sub(r"[^\w\- ]+", "", result["user_name"] or "")
+	name = " ".join(name.split())[:60] or "certificate"
+	return f"{name} - {result['id']}.{FORMATS[fmt]['ext']}"
+
+def render_bytes_task(result, rendition, fmt):
+	# Runs in an export process
+	return renderer.render(result["id"], result["user_name"], result["score"],
+		result["submit_time"], rendition, fmt, template_of(result))
+
+class ExportBusy(Exception):
+	pass
+
+class ExportPool():
+	"""Processes rendering the certificates of ZIP downloads.
+
+	Forked once at startup next to the render pool, CERT_EXPORT_PROCESSES
+	of them (default 2), and shared by the downloads of the worker: at
+	most CERT_EXPORT_CONCURRENCY (default 1) run at a time, `acquire`
+	raises ExportBusy beyond that. Kept apart from the render pool so a
+	download of thousands of certificates doesn't turn /cert views away.
+	If a process dies, the pool is forked again for the next render.
+	"""
+	def __init__(self, processes=None, max_exports=None, timeout=None):
+		self._processes = processes
+		self._max_exports = max_exports
+		self._timeout = timeout
+		self._lock = threading.Lock()
+		self._executor = None
+		self._exports = 0
+
+	def processes(self):
+		if self._processes is None:
+			return int(os.getenv("CERT_EXPORT_PROCESSES", "2"))
+		return self._processes
+
+	def max_exports(self):
+		if self._max_exports is None:
+			return int(os.getenv("CERT_EXPORT_CONCURRENCY", "1"))
+		return self._max_exports
+
+	def timeout(self):
+		if self._timeout is None:
+			return float(os.getenv("CERT_RENDER_TIMEOUT", "15"))
+		return self._timeout
+
+	def start(self):
+		"""Forks the export processes; see RenderPool.start."""
+		with self._lock:
+			self._get_executor()
+
+	def _get_executor(self):
+		if self._executor is None:
+			renderer.load()
+			self._executor = concurrent.futures.ProcessPoolExecutor(max(self.processes(), 1),
+				mp_context=multiprocessing.get_context("fork"),
+				initializer=exit_with_parent, initargs=(os.getpid(),))
+			self._executor.submit(int).result()
+			atexit.register(self._executor.shutdown, cancel_futures=True)
+		return self._executor
+
+	def acquire(self):
+		with self._lock:
+			if self._exports >= self.max_exports():
+				raise ExportBusy()
+			self._exports += 1
+
+	def release(self):
+		with self._lock:
+			self._exports -= 1
+
+	def submit(self, result, rendition, fmt):
+		with self._lock:
+			executor = self._get_executor()
+			try:
+				future = executor.submit(render_bytes_task, result, rendition, fmt)
+			except concurrent.futures.process.BrokenProcessPool:
+				# A child died since the last render: start over
+				self._executor = None
+				executor = self._get_executor()
+				future = executor.submit(render_bytes_task, result, rendition, fmt)
+		future.add_done_callback(lambda future: self._done(executor, future))
+		return future
+
+	def _done(self, executor, future):
+		if not future.cancelled() and \
+				isinstance(future.exception(), concurrent.futures.process.BrokenProcessPool):
+			with self._lock:
+				if self._executor is executor:
+					self._executor = None
+
+def iter_certificate_zip(results, rendition="full", fmt="jpeg", exports=None):
+	"""Yields a ZIP of the certificates of `results`, chunk by chunk.
+
+	Cached certificates are copied from the cache. The others are rendered
+	by the export pool, a bounded window ahead of the entry being
+	written, so memory stays flat however many results there are; one
+	the pool fails to render within CERT_RENDER_TIMEOUT seconds is
+	rendered in this thread instead. They aren't added to the cache: an
+	export of thousands of certificates would evict the ones being viewed.
+
+	Takes one of the export pool's slots, or raises ExportBusy, before
+	returning the generator, which gives the slot back once it is
+	exhausted or closed.
+	"""
+	exports = exports or export_pool
+	exports.acquire()
+	try:
+		window = max(exports.processes(), 1) * 2
+		chunks = _iter_certificate_zip(iter(results), rendition, fmt, exports, window)
+		# Started, so closing or dropping it always runs its finally
+		next(chunks)
+		return chunks
+	except BaseException:
+		exports.release()
+		raise
+
+def _iter_certificate_zip(results, rendition, fmt, exports, window):
+	pending = collections.deque()
+
+	def fill_window():
+		while len(pending) < window:
+			result = next(results, None)
+			if result is None:
+				return
+			result = with_template(result)
+			path = cache.path(result, rendition, fmt)
+			if path.exists():
+				pending.append((result, path))
+				continue
+			try:
+				pending.append((result, exports.submit(result, rendition, fmt)))
+			except (concurrent.futures.process.BrokenProcessPool, RuntimeError):
+				# The pool can't be forked again, or is shutting down
+				pending.append((result, None))
+
+	stream = ZipStream()
+	try:
+		yield b""
+		with zipfile.ZipFile(stream, "w", zipfile.ZIP_STORED) as zip_file:
+			fill_window()
+			while pending:
+				result, source = pending.popleft()
+				fill_window()
+				info = zipfile.ZipInfo(zip_entry_name(result, fmt),
+					time.localtime(max(result["submit_time"] or 0, 315532800))[:6])
+				cert = data = None
+				if isinstance(source, Path):
+					try:
+						cert = open(source, "rb")
+					except FileNotFoundError:
+						# Evicted since
+						pass
+				elif isinstance(source, concurrent.futures.Future):
+					try:
+						data = source.result(timeout=exports.timeout())
+					except (concurrent.futures.TimeoutError,
+							concurrent.futures.process.BrokenProcessPool):
+						# Stuck, or its process died
+						source.cancel()
+				if cert is None:
+					if data is None:
+						data = render_bytes_task(result, rendition, fmt)
+					info.file_size = len(data)
+					zip_file.writestr(info, data)
+				else:
+					with cert:
+						info.file_size = os.fstat(cert.fileno()).st_size
+						with zip_file.open(info, "w") as entry:
+							shutil.copyfileobj(cert, entry, 1 << 20)
+				yield stream.take()
+		yield stream.take()
+	finally:
+		# Abandoned download: don't render what nobody will receive
+		for _, source in pending:
+			if isinstance(source, concurrent.futures.Future):
+				source.cancel()
+		exports.release()
+
+renderer = CertificateRenderer()
+cache = CertificateCache(renderer)
+pool = RenderPool(cache)
+prerenderer = Prerenderer(cache, pool)
+export_pool = ExportPool()
+os.register_at_fork(after_in_child=reinit_locks)
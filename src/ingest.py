@@ -0,0 +1,224 @@
+"""Journaled ingestion of test submissions.
+
+With INGEST_MODE=journal, /submit_result doesn't write to SQLite itself.
+The result row is appended as one JSON line to a local append-only journal
+and the candidate gets an answer straight away; a background applier then
+drains the journal into the database in multi-row transactions.
+
+- Writers in every worker append with O_APPEND under a shared flock, and a
+  flusher thread fsyncs the journal every INGEST_FSYNC_INTERVAL_MS, so one
+  fsync covers every submission made in that window. Submissions are
+  acknowledged before that fsync: a process crash loses nothing, but a
+  power loss can lose the last INGEST_FSYNC_INTERVAL_MS of them.
+- One applier runs per host: each worker tries to take an exclusive lock
+  on the applier lock file, and the one that gets it drains the journal
+  until it exits, at which point another worker takes over.
+- The applied byte offset is stored in SQLite in the same transaction as
+  the rows (storage.apply_journaled_results), so after a crash the applier
+  resumes exactly where the last committed batch ended.
+- Ids are checked against the database when the submission is journaled,
+  since the candidate is sent to theirs straight away. A row that still
+  collides when applied (another submission drew the same id before
+  either was applied) is not inserted but kept in the .rejected file
+  next to the journal. Certificates are pre-rendered from the rows the
+  applier inserted.
+- Once everything is applied the journal is emptied, under an exclusive
+  lock that keeps writers out: an empty file whose first line holds the
+  next generation number atomically replaces it, and writers reopen the
+  path when they see their file was replaced. The database stores the
+  generation with the offset, so if the process dies before recording
+  the new position, the applier sees the new generation and starts at
+  its beginning instead of replaying the applied rows, which would bring
+  back results deleted since.
+"""
+import fcntl, json, os, threading, time, traceback
+from pathlib import Path
+import certs, storage, tester
+
+base_dir = Path(__file__).parent
+
+journal = None
+
+def journal_enabled():
+	return os.getenv("INGEST_MODE", "direct") == "journal"
+
+def start():
+	"""Opens the journal and starts the flusher and applier threads."""
+	global journal
+	journal = Journal(
+		Path(os.getenv("INGEST_JOURNAL_PATH", base_dir / "ingest_journal.ndjson")),
+		fsync_interval=int(os.getenv("INGEST_FSYNC_INTERVAL_MS", "50")) / 1000)
+	journal.start_flusher()
+	applier = Applier(journal,
+		batch_size=int(os.getenv("INGEST_BATCH_SIZE", "500")),
+		poll_interval=int(os.getenv("INGEST_APPLY_INTERVAL_MS", "200")) / 1000)
+	applier.start()
+
+def submit(tester_data):
+	"""Journals a new result and returns it as a result dict."""
+	result_id = tester.new_cert_id()
+	while storage.cert_id_exists(result_id):
+		result_id = tester.new_cert_id()
+	result_row = tester.build_result_row(tester_data, result_id)
+	journal.append(result_row)
+	return storage.result_row_to_dict(result_row)
+
+class Journal():
+	def __init__(self, path, fsync_interval=0.05):
+		self.path = path
+		self.fsync_interval = fsync_interval
+		self.lock_path = path.with_name(path.name + ".lock")
+		self.rejected_path = path.with_name(path.name + ".rejected")
+		self._fd_lock = threading.Lock()
+		self._fd = self._open()
+		self._lock_fd = os.open(self.lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+		self._dirty = threading.Event()
+
+	def _open(self):
+		return os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+
+	def append(self, result_row):
+		line = json.dumps({"row": list(result_row)}) + "\n"
+		# Shared lock: writers of other processes never block each other,
+		# only truncation. The flock belongs to the process's descriptor,
+		# which its threads share, so they take turns holding it.
+		with self._fd_lock:
+			fcntl.flock(self._lock_fd, fcntl.LOCK_SH)
+			try:
+				if os.fstat(self._fd).st_nlink == 0:
+					# Replaced by truncate_if_applied
+					os.close(self._fd)
+					self._fd = self._open()
+				os.write(self._fd, line.encode("utf-8"))
+			finally:
+				fcntl.flock(self._lock_fd, fcntl.LOCK_UN)
+		self._dirty.set()
+
+	def start_flusher(self):
+		def flush():
+			while True:
+				self._dirty.wait()
+				time.sleep(self.fsync_interval)
+				self._dirty.clear()
+				with self._fd_lock:
+					fd = os.dup(self._fd)
+				try:
+					os.fsync(fd)
+				except OSError:
+					print(traceback.format_exc())
+				finally:
+					os.close(fd)
+		threading.Thread(target=flush, daemon=True).start()
+
+	def header(self):
+		"""Returns the journal's generation and where its entries start.
+
+		Journals that were never emptied have no header: generation 0.
+		"""
+		with open(self.path, "rb") as f:
+			line = f.readline()
+		if line.startswith(b'{"generation": ') and line.endswith(b"\n"):
+			return json.loads(line)["generation"], len(line)
+		return 0, 0
+
+	def read_from(self, offset, max_entries):
+		"""Returns (rows, end_offset) for up to max_entries complete lines."""
+		rows = []
+		with open(self.path, "rb") as f:
+			f.seek(offset)
+			while len(rows) < max_entries:
+				line = f.readline()
+				if not line.endswith(b"\n"):
+					# Nothing more, or a line still being written
+					break
+				offset += len(line)
+				try:
+					rows.append(json.loads(line)["row"])
+				except (ValueError, KeyError):
+					print(f"Skipping malformed journal entry: {line[:200]!r}")
+		return rows, offset
+
+	def truncate_if_applied(self, generation, offset):
+		"""Empties the journal if everything up to its end is applied."""
+		with self._fd_lock:
+			fcntl.flock(self._lock_fd, fcntl.LOCK_EX)
+			try:
+				return self._replace_if_applied(generation, offset)
+			finally:
+				fcntl.flock(self._lock_fd, fcntl.LOCK_UN)
+
+	def _replace_if_applied(self, generation, offset):
+		if os.path.getsize(self.path) != offset:
+			return False
+		header = json.dumps({"generation": generation + 1}) + "\n"
+		tmp_path = self.path.with_name(self.path.name + ".tmp")
+		with open(tmp_path, "w") as f:
+			f.write(header)
+			f.flush()
+			os.fsync(f.fileno())
+		os.replace(tmp_path, self.path)
+		directory_fd = os.open(self.path.parent, os.O_RDONLY)
+		try:
+			os.fsync(directory_fd)
+		finally:
+			os.close(directory_fd)
+		storage.set_journal_position(generation + 1, len(header))
+		return True
+
+class Applier():
+	def __init__(self, journal, batch_size=500, poll_interval=0.2):
+		self.journal = journal
+		self.batch_size = batch_size
+		self.poll_interval = poll_interval
+		self.leader_lock_path = journal.path.with_name(journal.path.name + ".applier")
+
+	def start(self):
+		threading.Thread(target=self.run, daemon=True).start()
+
+	def run(self):
+		# Only one process per journal applies it; the rest wait their turn
+		lock_fd = os.open(self.leader_lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+		while True:
+			try:
+				fcntl.flock(lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+				break
+			except BlockingIOError:
+				time.sleep(5)
+		while True:
+			try:
+				if not self.apply_pending():
+					time.sleep(self.poll_interval)
+			except Exception:
+				print(traceback.format_exc())
+				time.sleep(self.poll_interval)
+
+	def apply_pending(self):
+		"""Applies one batch; returns False when the journal was drained."""
+		# Only the applier replaces the journal, so it can't change under us
+		generation, offset = storage.get_journal_position()
+		journal_generation, start = self.journal.header()
+		if journal_generation != generation or \
+				not start <= offset <= os.path.getsize(self.journal.path):
+			# Replaced since the position was stored, by a truncation that
+			# died before storing the new one, or by hand
+			storage.set_journal_position(journal_generation, start)
+			generation, offset = journal_generation, start
+		rows, end_offset = self.journal.read_from(offset, self.batch_size)
+		if end_offset == offset:
+			if offset > start:
+				self.journal.truncate_if_applied(generation, offset)
+			return False
+		inserted, rejected = storage.apply_journaled_results(rows, end_offset)
+		if rejected:
+			self.reject(rejected)
+		for result in inserted:
+			certs.prerenderer.enqueue(result)
+		return True
+
+	def reject(self, rows):
+		with open(self.journal.rejected_path, "a") as f:
+			for row in rows:
+				f.write(json.dumps({"row": list(row)}) + "\n")
+		for row in rows:
+			print(f"Journaled result {row[0]} ({row[5]}) not applied: " \
+				f"the id is taken, kept in {self.journal.rejected_path}")
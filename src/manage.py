@@ -0,0 +1,224 @@
+"""Maintenance commands, run from the command line next to the server.
+
+	python src/manage.py rebuild-stats
+	python src/manage.py archive [--older-than-days N] [--vacuum]
+	python src/manage.py export [--output FILE] [--since WATERMARK | --resume]
+	python src/manage.py import FILE [--batch-size N]
+	python src/manage.py publish-static [--campaign-slug SLUG]
+
+Uses the same .env settings (STORAGE_BACKEND, ...) as the server.
+"""
+import argparse, itertools, json, os, sys, time
+from pathlib import Path
+import dotenv
+import certs, static_site, storage
+
+base_dir = Path(__file__).parent
+
+def rebuild_stats(args):
+	start = time.perf_counter()
+	storage.rebuild_campaign_stats()
+	print(f"Rebuilt campaign stats in {time.perf_counter() - start:.1f}s")
+
+def archive(args):
+	days = args.older_than_days
+	if days is None:
+		days = int(os.getenv("ARCHIVE_AFTER_DAYS", "365"))
+	before_time = int(time.time()) - days * 86400
+	start = time.perf_counter()
+	archived = storage.archive_results(before_time)
+	print(f"Archived {archived} results older than {days} days in {time.perf_counter() - start:.1f}s")
+	if args.vacuum:
+		storage.vacuum()
+		print("Vacuumed the database")
+
+def add_archive_arguments(parser):
+	parser.add_argument("--older-than-days", type=int,
+		help="archive results older than this (default: ARCHIVE_AFTER_DAYS or 365)")
+	parser.add_argument("--vacuum", action="store_true",
+		help="shrink the database file afterwards (locks it while running)")
+
+# --- Export / Import ---
+#
+# NDJSON, one record per line: campaigns first ({"type": "campaign", ...}),
+# then results oldest first ({"type": "result", ...}, the fields of
+# storage.result_row_to_dict). The (submit_time, id) of the last result
+# written is the watermark an interrupted export resumes from.
+
+def parse_watermark(value):
+	"""Parses "SUBMIT_TIME[:ID]"; a bare time includes that second."""
+	if ":" in value:
+		return storage.decode_page_cursor(value)
+	return int(value), ""
+
+def last_watermark(path):
+	"""Drops a torn last line from an export file, returns its watermark.
+
+	Returns None if the file holds no result yet, in which case the export
+	starts over.
+	"""
+	with open(path, "rb+") as f:
+		data = f.read()
+		end = data.rfind(b"\n") + 1
+		f.truncate(end)
+		for line in reversed(data[:end].splitlines()):
+			record = json.loads(line)
+			if record["type"] == "result":
+				return record["submit_time"], record["id"]
+	return None
+
+def export(args):
+	after = parse_watermark(args.since) if args.since else None
+	write_campaigns = after is None
+	mode = "w"
+	if args.resume:
+		if args.output == "-" or not Path(args.output).exists():
+			sys.exit("--resume needs an existing --output file")
+		after = last_watermark(args.output)
+		write_campaigns = after is None
+		mode = "a" if after else "w"
+	output = sys.stdout if args.output == "-" else open(args.output, mode, buffering=1 << 20)
+	count = 0
+	try:
+		if write_campaigns:
+			for campaign in storage.get_campaigns():
+				output.write(json.dumps(dict(campaign, type="campaign")) + "\n")
+		for result in storage.export_results(after, include_archived=args.include_archived):
+			output.write(json.dumps(dict(result, type="result")) + "\n")
+			after = (result["submit_time"], result["id"])
+			count += 1
+	finally:
+		if output is not sys.stdout:
+			output.close()
+		else:
+			output.flush()
+	watermark = f", resume with --since {after[0]}:{after[1]}" if after else ""
+	print(f"Exported {count} results{watermark}", file=sys.stderr)
+
+def import_(args):
+	records = read_records(args.input)
+	# Campaigns come first: create them before the bulk insert takes the
+	# write lock
+	first = None
+	campaigns = 0
+	for record in records:
+		if record["type"] != "campaign":
+			first = record
+			break
+		campaigns += import_campaign(record)
+	late_campaigns = []
+
+	def result_rows():
+		for record in itertools.chain([first] if first else [], records):
+			if record["type"] == "result":
+				yield storage.result_dict_to_row(record)
+			elif record["type"] == "campaign":
+				late_campaigns.append(record)
+
+	start = time.perf_counter()
+	inserted = storage.import_results(result_rows(), args.batch_size)
+	for record in late_campaigns:
+		campaigns += import_campaign(record)
+	print(f"Imported {campaigns} campaigns and {inserted} results " \
+		f"in {time.perf_counter() - start:.1f}s")
+
+def import_campaign(record):
+	if not storage.create_campaign(record["slug"], record["name"]):
+		return 0
+	if not record.get("enabled", True):
+		storage.set_campaign_enabled(record["slug"], False)
+	if record.get("cert_template"):
+		storage.set_campaign_template(record["slug"], record["cert_template"])
+	return 1
+
+def read_records(path):
+	source = sys.stdin if path == "-" else open(path, buffering=1 << 20)
+	try:
+		for line in source:
+			if line.strip():
+				yield json.loads(line)
+	finally:
+		if source is not sys.stdin:
+			source.close()
+
+def add_export_arguments(parser):
+	parser.add_argument("--output", default="-",
+		help="file to write (default: stdout)")
+	parser.add_argument("--since", metavar="WATERMARK",
+		help="only results after SUBMIT_TIME:ID, or from SUBMIT_TIME on")
+	parser.add_argument("--resume", action="store_true",
+		help="continue an interrupted export into --output")
+	parser.add_argument("--include-archived", action="store_true",
+		help="also export archived results")
+
+def add_import_arguments(parser):
+	parser.add_argument("input", help="NDJSON file from export, or - for stdin")
+	parser.add_argument("--batch-size", type=int, default=50000,
+		help="rows per transaction when the database already has results")
+
+# --- Static Site ---
+
+def publish_static(args):
+	site = static_site.site
+	if not site.enabled():
+		sys.exit("set STATIC_OUTPUT_DIR to publish result pages")
+	certs.renderer.load()
+	certs.pool.start()
+	start = time.perf_counter()
+	published = 0
+	for result in storage.iter_results(args.campaign_slug):
+		if result["result_tier"] == 3:
+			site.publish(result)
+			published += 1
+	removed = 0
+	if args.campaign_slug is None:
+		# Results deleted while the server was down, or just as their
+		# page was being published
+		for result_id in site.published_ids():
+			if not storage.get_result(result_id):
+				site.remove(result_id)
+				removed += 1
+	print(f"Published {published} results, removed {removed} in {time.perf_counter() - start:.1f}s")
+
+def add_publish_static_arguments(parser):
+	parser.add_argument("--campaign-slug",
+		help="only this campaign's results, e.g. after changing its certificate template")
+
+COMMANDS = {
+	"rebuild-stats": (rebuild_stats, None,
+		"recompute the per-campaign rollups from all results"),
+	"archive": (archive, add_archive_arguments,
+		"move old results into monthly archive files"),
+	"export": (export, add_export_arguments,
+		"write campaigns and results as NDJSON"),
+	"import": (import_, add_import_arguments,
+		"bulk-load campaigns and results from an NDJSON export"),
+	"publish-static": (publish_static, add_publish_static_arguments,
+		"write tier-3 result pages and certificates to STATIC_OUTPUT_DIR"),
+}
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+	commands = parser.add_subparsers(dest="command", required=True)
+	for name, (handler, add_arguments, help_text) in COMMANDS.items():
+		command = commands.add_parser(name, help=help_text)
+		if add_arguments:
+			add_arguments(command)
+		command.set_defaults(handler=handler)
+	args = parser.parse_args(argv)
+	# Paths given on the command line are relative to where we were started
+	for name in ("input", "output"):
+		value = getattr(args, name, None)
+		if value and value != "-":
+			setattr(args, name, os.path.abspath(value))
+
+	os.chdir(base_dir)
+	dotenv.load_dotenv()
+	storage.migrate()
+	try:
+		args.handler(args)
+	finally:
+		storage.get_backend().close()
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,242 @@
+import bisect, threading
+from storage import StorageBackend, UNTAGGED_NAME, result_row_to_dict, \
+    decode_page_cursor, encode_page_cursor, normalize_email, new_rollup, \
+    add_to_rollup, merge_rollups, stats_from_rollups
+
+class MemoryBackend(StorageBackend):
+    """Keeps results and campaigns in process memory.
+
+    Nothing is persisted and every process has its own copy, so this is
+    only meant for load tests and benchmarks that shouldn't measure disk
+    I/O. Results are also kept in a list sorted by (submit_time, id) so
+    listings page the same way as on SQLite.
+    """
+    shared = False
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._results = {}
+        self._order = []
+        self._emails = {}
+        self._rollups = {}
+        self._campaigns = {}
+        self._campaigns_version = 0
+        self._journal_generation = 0
+        self._journal_offset = 0
+
+    # --- Campaigns ---
+
+    def create_campaign(self, slug, name):
+        with self._lock:
+            if slug in self._campaigns or any(
+                    c["name"] == name for c in self._campaigns.values()):
+                return False
+            self._campaigns[slug] = {"slug": slug, "name": name, "enabled": True,
+                "cert_template": None}
+            self._campaigns_version += 1
+            return True
+
+    def get_campaigns(self):
+        with self._lock:
+            return sorted((dict(c) for c in self._campaigns.values()),
+                key=lambda c: c["name"])
+
+    def get_campaign_by_slug(self, slug):
+        with self._lock:
+            campaign = self._campaigns.get(slug)
+            return dict(campaign) if campaign else None
+
+    def delete_campaign(self, slug):
+        with self._lock:
+            self._campaigns.pop(slug, None)
+            self._campaigns_version += 1
+
+    def set_campaign_enabled(self, slug, enabled):
+        with self._lock:
+            if slug in self._campaigns:
+                self._campaigns[slug]["enabled"] = bool(enabled)
+            self._campaigns_version += 1
+
+    def set_campaign_template(self, slug, template):
+        with self._lock:
+            if slug in self._campaigns:
+                self._campaigns[slug]["cert_template"] = template
+            self._campaigns_version += 1
+
+    def get_campaigns_version(self):
+        return self._campaigns_version
+
+    # --- Results ---
+
+    def cert_id_exists(self, cert_id):
+        return cert_id in self._results
+
+    def email_exists(self, email):
+        return normalize_email(email) in self._emails
+
+    def get_result(self, result_id):
+        row = self._results.get(result_id)
+        if row:
+            return result_row_to_dict(row)
+
+    def save_result(self, result_row):
+        with self._lock:
+            if result_row[0] in self._results:
+                raise ValueError(f"Duplicate result id {result_row[0]}")
+            self._add(tuple(result_row))
+
+    def insert_result(self, result_row, new_id):
+        result_row = tuple(result_row)
+        with self._lock:
+            while result_row[0] in self._results:
+                result_row = (new_id(),) + result_row[1:]
+            self._add(result_row)
+        return result_row_to_dict(result_row)
+
+    def get_all_results(self):
+        with self._lock:
+            return [result_row_to_dict(self._results[key[1]])
+                for key in reversed(self._order)]
+
+    def delete_result(self, result_id):
+        with self._lock:
+            row = self._results.pop(result_id, None)
+            if row is None:
+                return
+            del self._order[bisect.bisect_left(self._order, sort_key(row))]
+            email = normalize_email(row[7])
+            self._emails[email] -= 1
+            if not self._emails[email]:
+                del self._emails[email]
+            # Extremes can't be decremented: recount the campaign's rollup
+            slug = row[10] or None
+            rollup = new_rollup()
+            for other in self._results.values():
+                if (other[10] or None) == slug:
+                    add_to_rollup(rollup, other)
+            if rollup["count"]:
+                self._rollups[slug] = rollup
+            else:
+                self._rollups.pop(slug, None)
+
+    def _add(self, row):
+        self._results[row[0]] = row
+        bisect.insort(self._order, sort_key(row))
+        email = normalize_email(row[7])
+        self._emails[email] = self._emails.get(email, 0) + 1
+        add_to_rollup(self._rollups.setdefault(row[10] or None, new_rollup()), row)
+
+    # --- Journaled ingestion ---
+
+    def get_journal_position(self):
+        with self._lock:
+            return self._journal_generation, self._journal_offset
+
+    def set_journal_position(self, generation, offset):
+        with self._lock:
+            self._journal_generation = generation
+            self._journal_offset = offset
+
+    def apply_journaled_results(self, result_rows, journal_offset):
+        inserted = []
+        rejected = []
+        with self._lock:
+            for result_row in result_rows:
+                result_row = tuple(result_row)
+                existing = self._results.get(result_row[0])
+                if existing is None:
+                    self._add(result_row)
+                    inserted.append(result_row_to_dict(result_row))
+                elif (existing[3], existing[5], existing[7]) != \
+                        (result_row[3], result_row[5], result_row[7]):
+                    rejected.append(result_row)
+            self._journal_offset = journal_offset
+        return inserted, rejected
+
+    # --- Listing and aggregates ---
+
+    def get_results_page(self, campaign_slug=None, page_size=50, cursor=None):
+        with self._lock:
+            end = len(self._order)
+            if cursor:
+                end = bisect.bisect_left(self._order, decode_page_cursor(cursor))
+            results = []
+            for key in reversed(self._order[:end]):
+                result = self._matching(key, campaign_slug)
+                if result:
+                    results.append(result)
+                    if len(results) > page_size:
+                        break
+        next_cursor = None
+        if len(results) > page_size:
+            results = results[:page_size]
+            next_cursor = encode_page_cursor(results[-1])
+        return results, next_cursor
+
+    def iter_results(self, campaign_slug=None, batch_size=500, include_archived=False):
+        # Nothing is ever archived in memory
+        with self._lock:
+            keys = list(reversed(self._order))
+        for key in keys:
+            result = self._matching(key, campaign_slug)
+            if result:
+                yield result
+
+    def get_result_stats(self, start_time=None, end_time=None):
+        rollups = {}
+        with self._lock:
+            campaign_names = {slug: c["name"] for slug, c in self._campaigns.items()}
+            if start_time is None and end_time is None:
+                for slug, rollup in self._rollups.items():
+                    merge_rollups(rollups.setdefault(slug, new_rollup()), rollup)
+                return stats_from_rollups(rollups, campaign_names)
+            for row in self._results.values():
+                if start_time is not None and row[3] < start_time:
+                    continue
+                if end_time is not None and row[3] >= end_time:
+                    continue
+                add_to_rollup(rollups.setdefault(row[10], new_rollup()), row)
+        return stats_from_rollups(rollups, campaign_names)
+
+    def rebuild_campaign_stats(self):
+        with self._lock:
+            self._rollups = {}
+            for row in self._results.values():
+                add_to_rollup(self._rollups.setdefault(row[10] or None, new_rollup()), row)
+
+    # --- Bulk transfer ---
+
+    def export_results(self, after=None, batch_size=5000, include_archived=False):
+        with self._lock:
+            start = bisect.bisect_right(self._order, tuple(after)) if after else 0
+            rows = [self._results[key[1]] for key in self._order[start:]]
+        for row in rows:
+            yield result_row_to_dict(row)
+
+    def import_results(self, result_rows, batch_size=50000):
+        inserted = 0
+        with self._lock:
+            for result_row in result_rows:
+                if result_row[0] not in self._results:
+                    self._add(tuple(result_row))
+                    inserted += 1
+        return inserted
+
+    def _matching(self, key, campaign_slug):
+        # Applies the admin campaign filter, see get_results_page
+        row = self._results.get(key[1])
+        if row is None:
+            return None
+        campaign = self._campaigns.get(row[10])
+        if campaign_slug and campaign_slug != "all":
+            if campaign_slug == "untagged":
+                if campaign:
+                    return None
+            elif row[10] != campaign_slug:
+                return None
+        result = result_row_to_dict(row)
+        result["campaign_name"] = campaign["name"] if campaign else UNTAGGED_NAME
+        return result
+
+def sort_key(row):
+    return (row[3], row[0])
@@ -1,9 +1,10 @@
-from bottle import Bottle, run, static_file, request, redirect, response, template
+from bottle import Bottle, run, static_file, request, redirect, response, template, http_date, parse_date
 from beaker.middleware import SessionMiddleware # Added for session management
 from pathlib import Path
-from urllib.parse import unquote
-import tester, json, os, storage, traceback, hashlib, secrets
+from urllib.parse import unquote, urlencode
+import tester, certs, json, os, storage, ingest, static_site, traceback, hashlib, secrets
 from bottle import request as bottle_request
+from util import sanitize_html
 import dotenv
 from math import erf, sqrt
 import datetime # Added for date formatting
@@ -19,6 +20,27 @@ webroot = base_dir / "webroot"
 os.chdir(base_dir)
 dotenv.load_dotenv()
 
+# Bring the database schema up to date once, before serving any request
+storage.migrate()
+# Decode the certificate template and open its fonts before the first /cert,
+# then fork the render processes while this is the only thread
+certs.renderer.load()
+certs.pool.start()
+certs.export_pool.start()
+storage.warm_up()
+# Workers share result and campaign lookups through a cache file
+storage.start_shared_cache()
+# Render certificates of new results in the background, starting with the
+# jobs a previous run left pending, and copy them out for the proxy
+if static_site.site.enabled():
+	static_site.site.site_url()
+	certs.prerenderer.listeners.append(static_site.site.publish_new)
+certs.prerenderer.start()
+
+# Journaled ingestion: submissions go to a local journal first
+if ingest.journal_enabled():
+	ingest.start()
+
 session_opts = {
 	'session.type': 'file',
 	'session.cookie_expires': 86400,
@@ -34,6 +56,10 @@ app = SessionMiddleware(main_app, session_opts)
 ADMIN_LOGIN = os.environ["ADMIN_LOGIN"]
 ADMIN_PASSWORD = os.environ["ADMIN_PASSWORD"]
 
+# Results per page on the admin dashboard
+ADMIN_PAGE_SIZE = 50
+ADMIN_MAX_PAGE_SIZE = 500
+
 # Session storage now handled by Beaker session middleware
 def check_admin_session():
 	session = bottle_request.environ.get('beaker.session')
@@ -56,23 +82,83 @@ def show_result(tier, result_id):
 	return on_result_open(tier, result_id)
 
 @main_app.route("/cert/<result_id>")
-def generate_cert(result_id):
+@main_app.route("/cert/<result_id>/<rendition>")
+def generate_cert(result_id, rendition="full"):
+	if rendition not in certs.RENDITIONS:
+		response.status = 404
+		return "Unknown certificate size"
 	result = storage.get_result(result_id)
+	if not result:
+		response.status = 404
+		return "Result not found"
 	if result["result_tier"] != 3:
 		response.status = 403
 		return "Not allowed"
 	
-	response.content_type = "image/jpeg"
-	return tester.gen_cert(result["id"], result["user_name"],
-		result["score"], result["submit_time"])
+	fmt = certs.negotiate(rendition, request.get_header("Accept"))
+	if len(certs.RENDITIONS[rendition]["formats"]) > 1:
+		response.set_header("Vary", "Accept")
+	# A certificate never changes for a given template version (links carry
+	# it as ?v=), so clients and crawlers may keep it for good
+	etag = certs.cache.etag(result, rendition, fmt)
+	last_modified = certs.cache.last_modified(result)
+	cache_headers = {
+		"ETag": etag,
+		"Last-Modified": http_date(last_modified),
+		"Cache-Control": "public, max-age=31536000, immutable",
+	}
+	if_none_match = request.get_header("If-None-Match")
+	if_modified_since = parse_date(request.get_header("If-Modified-Since") or "")
+	if if_none_match:
+		not_modified = etag in [tag.strip() for tag in if_none_match.split(",")] or if_none_match.strip() == "*"
+	else:
+		not_modified = bool(if_modified_since) and if_modified_since >= last_modified
+	if not_modified:
+		for name, value in cache_headers.items():
+			response.set_header(name, value)
+		response.status = 304
+		return ""
+	
+	try:
+		path, seconds = certs.pool.fetch(result, rendition, fmt)
+		try:
+			cert = open(path, "rb")
+		except FileNotFoundError:
+			# Evicted by another worker in between: render again
+			path, seconds = certs.pool.fetch(result, rendition, fmt)
+			cert = open(path, "rb")
+	except certs.RenderBusy as e:
+		response.status = 503
+		response.set_header("Retry-After", str(e.retry_after))
+		response.set_header("Cache-Control", "no-store")
+		return "Too many certificates are being generated, please retry shortly"
+	for name, value in cache_headers.items():
+		response.set_header(name, value)
+	response.content_type = certs.FORMATS[fmt]["mime"]
+	if seconds is not None:
+		response.set_header("Server-Timing", f"render;dur={seconds * 1000:.1f}")
+	response.set_header("Content-Length", str(os.fstat(cert.fileno()).st_size))
+	return cert
 
 def on_result_open(tier, result_id):
 	result = storage.get_result(result_id)
+	if not result:
+		response.status = 404
+		return "Result not found"
 	if result["result_tier"] != tier:
 		return redirect(f"/result/tier-{result['result_tier']}/{result['id']}")
 	
 	domain = f"{request.urlparts.scheme}://{request.urlparts.netloc}"
-	status, body = tester.get_result_page(result_id, domain)
+	# Shared links are opened over and over: let browsers and proxies keep
+	# the page but check back, so a deleted result stops showing
+	etag = tester.result_page_etag(result, domain)
+	response.set_header("ETag", etag)
+	response.set_header("Cache-Control", "no-cache")
+	if_none_match = request.get_header("If-None-Match")
+	if if_none_match and (etag in [tag.strip() for tag in if_none_match.split(",")] or if_none_match.strip() == "*"):
+		response.status = 304
+		return ""
+	status, body = tester.result_pages.get(result, domain, etag)
 	response.status = status
 	return body
 
@@ -193,11 +279,21 @@ def admin_delete_result(result_id):
 	require_admin()
 	try:
 		storage.delete_result(result_id)
+		certs.prerenderer.discard(result_id)
+		certs.cache.invalidate(result_id)
+		tester.result_pages.invalidate(result_id)
+		static_site.site.remove(result_id)
 		return json.dumps({"success": True})
 	except Exception:
 		print(traceback.format_exc())
 		return json.dumps({"success": False})
 
+@main_app.route("/admin/cache_stats")
+def admin_cache_stats():
+	require_admin()
+	response.content_type = "application/json"
+	return json.dumps({"shared_cache": storage.shared_cache_stats()})
+
 @main_app.route("/admin/campaigns/<slug>/toggle", method="POST")
 def admin_toggle_campaign_enabled(slug):
 	require_admin()
@@ -229,51 +325,70 @@ def admin_download_csv():
 	require_admin()
 
 	campaign_filter_slug = request.query.get('campaign_slug')
+	# Archived results are only read when asked for
+	include_archived = request.query.get('include_archived') == '1'
+	campaign_name_for_file = campaign_file_label(campaign_filter_slug)
 
-	all_results = storage.get_all_results()
-	campaigns = storage.get_campaigns()
-	slug_to_name = {c['slug']: c['name'] for c in campaigns}
-	slug_to_campaign = {c['slug']: c for c in campaigns}
+	response.content_type = 'text/csv'
+	response.set_header(
+		'Content-Disposition', 
+		f'attachment; filename="test_results_{campaign_name_for_file}_{datetime.date.today()}.csv"'
+	)
 
-	results = []
-	for result in all_results:
-		# Map campaign slug to name and add percentile
-		campaign_slug = result.get("campaign_slug")
-		campaign_name = slug_to_name.get(campaign_slug, "Direct/Untagged")
-		
-		# Filtering logic
-		if campaign_filter_slug and campaign_filter_slug != "all":
-			if campaign_filter_slug == "untagged":
-				if campaign_name != "Direct/Untagged":
-					continue
-			elif campaign_slug != campaign_filter_slug:
-				continue
+	# Stream the CSV: rows are read in batches and flushed to the client
+	# as they are formatted, so memory stays flat for any number of results
+	return generate_results_csv(campaign_filter_slug, include_archived)
 
-		result["campaign_name"] = campaign_name
+def campaign_file_label(campaign_filter_slug):
+	"""Names an export file after the campaign filter."""
+	if campaign_filter_slug and campaign_filter_slug != "all":
+		if campaign_filter_slug == "untagged":
+			return "Direct_Untagged"
+		filter_campaign = storage.get_campaign_by_slug(campaign_filter_slug)
+		if filter_campaign:
+			# Use the campaign name, replace spaces with underscores
+			return filter_campaign['name'].replace(" ", "_")
+		return "filtered_results"
+	return "all_results"
 
-		if result["score"]:
-			# Use the global helper
-			percentile = calculate_iq_percentile(result["score"])
-			result["percentile"] = round(percentile, 1)
-		else:
-			result["percentile"] = "N/A"
-			
-		# Format dates and durations
-		result["date_time_formatted"] = datetime.datetime.fromtimestamp(
-			result.get("submit_time", 0)
-		).strftime("%Y-%m-%d %H:%M:%S") if result.get("submit_time") else "N/A"
+@main_app.route("/admin/download_certificates")
+def admin_download_certificates():
+	require_admin()
 
-		test_duration = result.get("test_duration")
-		result["duration_formatted"] = f"{test_duration // 60}m {test_duration % 60}s" if test_duration else "N/A"
+	campaign_filter_slug = request.query.get('campaign_slug')
+	include_archived = request.query.get('include_archived') == '1'
+	campaign_name_for_file = campaign_file_label(campaign_filter_slug)
 
-		result["correct_answers_formatted"] = f"{result.get('correct_answers', 'N/A')} from 60" if result.get('correct_answers') is not None else "N/A"
+	# Streamed entry by entry; missing certificates are rendered by the
+	# export processes a few entries ahead of the one being sent
+	results = storage.iter_results(campaign_filter_slug, batch_size=CSV_CHUNK_ROWS,
+		include_archived=include_archived)
+	try:
+		body = certs.iter_certificate_zip(results)
+	except certs.ExportBusy:
+		results.close()
+		response.status = 503
+		response.set_header("Retry-After", "60")
+		return "Another certificate download is running, please retry shortly"
+	response.content_type = 'application/zip'
+	response.set_header(
+		'Content-Disposition',
+		f'attachment; filename="certificates_{campaign_name_for_file}_{datetime.date.today()}.zip"'
+	)
+	return body
 
-		results.append(result)
+CSV_CHUNK_ROWS = 500
 
-	# In-memory file for CSV generation
+def generate_results_csv(campaign_filter_slug, include_archived=False):
 	output = StringIO()
 	writer = csv.writer(output)
 
+	def flush():
+		chunk = output.getvalue()
+		output.seek(0)
+		output.truncate()
+		return chunk
+
 	# 1. Write Header
 	header = [
 		"ID", "Email", "Name", "Date & Time", "IQ Score", 
@@ -281,45 +396,83 @@ def admin_download_csv():
 		"Campaign Slug", "Percentile", "Result Tier"
 	]
 	writer.writerow(header)
+	yield flush()
 
 	# 2. Write Data Rows
-	for result in results:
-		
+	for i, result in enumerate(storage.iter_results(
+			campaign_filter_slug, batch_size=CSV_CHUNK_ROWS,
+			include_archived=include_archived), 1):
+		if result["score"]:
+			# Use the global helper
+			percentile = round(calculate_iq_percentile(result["score"]), 1)
+		else:
+			percentile = "N/A"
+
+		# Format dates and durations
+		date_time_formatted = datetime.datetime.fromtimestamp(
+			result.get("submit_time", 0)
+		).strftime("%Y-%m-%d %H:%M:%S") if result.get("submit_time") else "N/A"
+
+		correct_answers_formatted = f"{result.get('correct_answers', 'N/A')} from 60" if result.get('correct_answers') is not None else "N/A"
+
 		row = [
 			# Ensure ID is always treated as a string
 			str(result.get("id", "N/A")),
 			result.get("email", "N/A"),
 			result.get("user_name", "N/A"),
-			result["date_time_formatted"],
+			date_time_formatted,
 			result.get("score", "N/A"),
 			result.get("test_duration", "N/A"), # Raw seconds for easy analysis
-			result["correct_answers_formatted"],
+			correct_answers_formatted,
 			result["campaign_name"],
 			result.get("campaign_slug", "untagged"),
-			result["percentile"],
+			percentile,
 			result.get("result_tier", "N/A")
 		]
 		writer.writerow(row)
+		if i % CSV_CHUNK_ROWS == 0:
+			yield flush()
 
-	# Logic for filename generation
-	if campaign_filter_slug and campaign_filter_slug != "all":
-		if campaign_filter_slug == "untagged":
-			campaign_name_for_file = "Direct_Untagged"
-		elif campaign_filter_slug in slug_to_campaign:
-			# Use the campaign name, replace spaces with underscores
-			campaign_name = slug_to_campaign[campaign_filter_slug]['name']
-			campaign_name_for_file = campaign_name.replace(" ", "_")
-		else:
-			campaign_name_for_file = "filtered_results"
-	else:
-		campaign_name_for_file = "all_results"
+	yield flush()
+
+@main_app.route("/admin/download_campaign_stats")
+def admin_download_campaign_stats():
+	require_admin()
+
+	# Served from the per-campaign rollups: one row per campaign, however
+	# many results there are
+	stats = storage.get_result_stats()
+	buckets = sorted({bucket for c in stats["campaigns"] for bucket, _ in c["histogram"]})
+
+	def format_time(timestamp):
+		return datetime.datetime.fromtimestamp(timestamp).strftime("%Y-%m-%d %H:%M:%S") if timestamp else "N/A"
+
+	def format_number(value):
+		return round(value, 1) if value is not None else "N/A"
+
+	output = StringIO()
+	writer = csv.writer(output)
+	writer.writerow([
+		"Campaign Name", "Campaign Slug", "Tests", "Scored Tests", "Avg. IQ",
+		"IQ Std. Dev.", "Min IQ", "Max IQ", "Avg. Test Duration (seconds)",
+		"First Test", "Last Test"
+	] + [f"IQ {bucket}-{bucket + storage.SCORE_BUCKET_WIDTH - 1}" for bucket in buckets])
+	for c in stats["campaigns"]:
+		histogram = dict(c["histogram"])
+		writer.writerow([
+			c["name"], c["slug"], c["count"], c["scored_count"],
+			format_number(c["avg_score"]), format_number(c["stddev_score"]),
+			c["min_score"] if c["min_score"] is not None else "N/A",
+			c["max_score"] if c["max_score"] is not None else "N/A",
+			format_number(c["avg_duration"]),
+			format_time(c["first_submit"]), format_time(c["last_submit"])
+		] + [histogram.get(bucket, 0) for bucket in buckets])
 
 	response.content_type = 'text/csv'
 	response.set_header(
-		'Content-Disposition', 
-		f'attachment; filename="test_results_{campaign_name_for_file}_{datetime.date.today()}.csv"'
+		'Content-Disposition',
+		f'attachment; filename="campaign_summary_{datetime.date.today()}.csv"'
 	)
-
 	return output.getvalue()
 
 
@@ -327,11 +480,26 @@ def admin_download_csv():
 def admin_panel():
 	require_admin()
 	
-	results = storage.get_all_results()
+	campaign_filter_slug = request.query.get('campaign_slug') or "all"
+	try:
+		page_size = min(max(int(request.query.get('page_size', ADMIN_PAGE_SIZE)), 1), ADMIN_MAX_PAGE_SIZE)
+	except ValueError:
+		page_size = ADMIN_PAGE_SIZE
+	page_cursor = request.query.get('cursor') or None
+
+	# Filtering, ordering and paging all happen in SQL
+	try:
+		page_results, next_cursor = storage.get_results_page(
+			campaign_filter_slug, page_size, page_cursor)
+	except ValueError:
+		# Malformed cursor: start over from the newest results
+		page_results, next_cursor = storage.get_results_page(
+			campaign_filter_slug, page_size)
+	# Dashboard cards come from the per-campaign rollups, not the result rows
+	stats = storage.get_result_stats()
 	
-    # Fetch and map campaigns
+    # Fetch campaigns for the filter options
 	campaigns = storage.get_campaigns() # Assuming this function exists and returns [{"slug": "...", "name": "..."}]
-	slug_to_name = {c['slug']: c['name'] for c in campaigns}
     
 	# Calculate percentiles based on IQ distribution
 	# IQ follows normal distribution: mean=100, std_dev=15
@@ -350,50 +518,22 @@ def admin_panel():
 		percentile = 0.5 * (1 + erf(z_score / sqrt(2)))
 		# Invert: 100% - percentile to show top percentage
 		return 100 - (percentile * 100)
-	
-	for result in results:
+
+	# Generate HTML table rows for this page only
+	row_parts = []
+	for result in page_results:
 		if result["score"]:
 			# Calculate percentile based on IQ distribution statistics
 			percentile = calculate_iq_percentile(result["score"])
 			result["percentile"] = round(percentile, 1)
 		else:
 			result["percentile"] = "N/A"
-            
-        # Add campaign name to result dictionary
-		campaign_slug = result.get("campaign_slug")
-		if campaign_slug and campaign_slug in slug_to_name:
-			result["campaign_name"] = slug_to_name[campaign_slug] # Display NAME
-		else:
-			result["campaign_name"] = "Direct/Untagged"
-        
-	# Sort results by Campaign Name for Grouping
-	results.sort(key=lambda r: r["campaign_name"])
 
-	# Generate HTML table
-	rows_html = ""
-	last_campaign_name = None # Variable to track grouping
-    
-	for result in results:
-        # Add Grouping Header
-		current_campaign_name = result["campaign_name"]
-		if current_campaign_name != last_campaign_name:
-            # colspan="9" because the table has 9 columns (Email to Actions)
-			rows_html += f'''
-            <tr class="campaign-group-header">
-                <td colspan="9"><h2>Campaign: {current_campaign_name}</h2></td>
-            </tr>
-            '''
-			last_campaign_name = current_campaign_name
-        
-		# import datetime # datetime is now imported globally
 		date_time = datetime.datetime.fromtimestamp(result["submit_time"]).strftime("%Y-%m-%d %H:%M:%S") if result["submit_time"] else "N/A"
 		test_duration_str = f"{result['test_duration'] // 60}m {result['test_duration'] % 60}s" if result["test_duration"] else "N/A"
 		correct_answers_str = f"{result.get('correct_answers', 'N/A')} from 60" if result.get('correct_answers') is not None else "N/A"
 		
-        # Use the campaign_name we stored in the result dict
-		campaign_display = result["campaign_name"] 
-        
-		rows_html += f'''
+		row_parts.append(f'''
 		<tr data-id="{result.get("id", "")}">
 			<td>{result.get("email", "N/A")}</td>
 			<td>{result.get("user_name", "N/A")}</td>
@@ -401,10 +541,23 @@ def admin_panel():
 			<td>{result.get("score", "N/A")}</td>
 			<td>{test_duration_str}</td>
             <td>{correct_answers_str}</td>
-            <td>{campaign_display}</td>  <td>{result.get("percentile", "N/A")}%</td>
+            <td>{result["campaign_name"]}</td>  <td>{result.get("percentile", "N/A")}%</td>
 			<td><button class="delete-btn" data-id="{result.get("id", "")}">Delete</button></td>
 		</tr>
-		'''
+		''')
+	if not row_parts:
+		row_parts.append('''
+		<tr><td colspan="9">No results.</td></tr>
+		''')
+	rows_html = "".join(row_parts)
+
+	# Pagination links keep the current filter and page size
+	page_query = {"campaign_slug": campaign_filter_slug, "page_size": page_size}
+	pagination_html = ""
+	if page_cursor:
+		pagination_html += f'<a class="logout-btn" href="/admin?{urlencode(page_query)}">&laquo; Newest</a> '
+	if next_cursor:
+		pagination_html += f'<a class="logout-btn" href="/admin?{urlencode(dict(page_query, cursor=next_cursor))}">Older &raquo;</a>'
 	
     # Campaign filter options for the UI
 	campaign_options_html = '<option value="all">All Campaigns</option>'
@@ -412,6 +565,21 @@ def admin_panel():
 	
 	for campaign in campaigns:
 		campaign_options_html += f'<option value="{campaign["slug"]}">{campaign["name"]}</option>' 
+
+	campaign_stats_html = "".join(f'''
+					<tr>
+						<td>{c["name"]}</td>
+						<td>{c["count"]}</td>
+						<td>{round(c["avg_score"], 1) if c["avg_score"] is not None else "N/A"}</td>
+						<td>{round(c["stddev_score"], 1) if c["stddev_score"] is not None else "N/A"}</td>
+						<td>{c["min_score"] if c["min_score"] is not None else "N/A"} / {c["max_score"] if c["max_score"] is not None else "N/A"}</td>
+						<td>{round(c["avg_duration"] / 60, 1) if c["avg_duration"] is not None else "N/A"}m</td>
+					</tr>''' for c in stats["campaigns"])
+
+	filter_options_html = "".join(
+		f'<option value="{value}"{" selected" if value == campaign_filter_slug else ""}>{label}</option>'
+		for value, label in [("all", "All Campaigns"), ("untagged", "Direct/Untagged")] +
+			[(c["slug"], c["name"]) for c in campaigns])
         
 	return f'''
 	<!DOCTYPE html>
@@ -510,18 +678,35 @@ def admin_panel():
 				font-weight: bold;
 				color: #667eea;
 			}}
-            /* Campaign Grouping Style */
-            .campaign-group-header td {{
-                background: #e0e7ff !important; 
-                font-weight: bold;
-                padding: 15px 12px;
-                border-top: 2px solid #667eea;
-                border-bottom: none;
+            .campaign-stats {{
+                margin-bottom: 20px;
+            }}
+            /* Results Filter and Pagination */
+            .filter-form {{
+                display: flex;
+                align-items: center;
+                gap: 15px;
+                margin-bottom: 15px;
             }}
-            .campaign-group-header h2 {{
-                margin: 0;
-                font-size: 1.2em;
-                color: #333;
+            .filter-form select, .filter-form input, .filter-form button {{
+                padding: 8px;
+                border-radius: 5px;
+                border: 1px solid #ddd;
+            }}
+            .filter-form input {{
+                width: 70px;
+            }}
+            .filter-form button {{
+                background: #667eea;
+                color: white;
+                cursor: pointer;
+                border: none;
+            }}
+            .pagination {{
+                display: flex;
+                justify-content: flex-end;
+                gap: 10px;
+                margin-top: 15px;
             }}
             /* CSV Download Section Styles */
             .csv-download-container {{
@@ -564,27 +749,59 @@ def admin_panel():
 		<div class="stats">
 			<div class="stat-card">
 				<h3>Total Tests</h3>
-				<div class="value">{len(results)}</div>
+				<div class="value">{stats["count"]}</div>
 			</div>
 			<div class="stat-card">
 				<h3>Average IQ Score</h3>
-				<div class="value">{round(sum(r["score"] for r in results if r["score"]) / len([r for r in results if r["score"]]) if [r for r in results if r["score"]] else 0, 1)}</div>
+				<div class="value">{round(stats["avg_score"] or 0, 1)}</div>
 			</div>
 			<div class="stat-card">
 				<h3>Avg. Test Duration</h3>
-				<div class="value">{round(sum(r["test_duration"] for r in results if r["test_duration"]) / len([r for r in results if r["test_duration"]]) / 60 if [r for r in results if r["test_duration"]] else 0, 1)}m</div>
+				<div class="value">{round((stats["avg_duration"] or 0) / 60, 1)}m</div>
 			</div>
 		</div>
+
+		<div class="container campaign-stats">
+			<table>
+				<thead>
+					<tr>
+						<th>Campaign</th>
+						<th>Tests</th>
+						<th>Avg. IQ</th>
+						<th>Std. Dev.</th>
+						<th>Min / Max IQ</th>
+						<th>Avg. Duration</th>
+					</tr>
+				</thead>
+				<tbody>
+					{campaign_stats_html}
+				</tbody>
+			</table>
+		</div>
 		
         <div class="csv-download-container">
             <h3>Download Results as CSV:</h3>
             <select id="campaign-select">
                 {campaign_options_html}
             </select>
+            <label><input type="checkbox" id="include-archived"> Include archived</label>
             <button id="download-csv-btn">Download CSV</button>
+            <button id="download-certs-btn">Download Certificates (ZIP)</button>
+            <a href="/admin/download_campaign_stats" class="logout-btn">Download Campaign Summary</a>
         </div>
 
 		<div class="container">
+			<form class="filter-form" method="GET" action="/admin">
+				<label>Campaign:
+					<select name="campaign_slug">
+						{filter_options_html}
+					</select>
+				</label>
+				<label>Per page:
+					<input type="number" name="page_size" min="1" max="{ADMIN_MAX_PAGE_SIZE}" value="{page_size}">
+				</label>
+				<button type="submit">Apply</button>
+			</form>
 			<table>
 				<thead>
 					<tr>
@@ -603,6 +820,9 @@ def admin_panel():
 					{rows_html}
 				</tbody>
 			</table>
+			<div class="pagination">
+				{pagination_html}
+			</div>
 		</div>
 
 		<div style="text-align:center; margin-bottom: 30px; padding-top: 32px;">
@@ -611,16 +831,25 @@ def admin_panel():
 		</div>
 
 		<script>
-            // CSV Download Script
-            document.getElementById('download-csv-btn').addEventListener('click', function() {{
+            // CSV and certificate download script
+            function downloadExport(path) {{
                 const campaignSlug = document.getElementById('campaign-select').value;
-                let url = '/admin/download_csv';
+                const params = new URLSearchParams();
                 
                 if (campaignSlug && campaignSlug !== 'all') {{
-                    url += `?campaign_slug=${{campaignSlug}}`;
+                    params.set('campaign_slug', campaignSlug);
+                }}
+                if (document.getElementById('include-archived').checked) {{
+                    params.set('include_archived', '1');
                 }}
                 
-                window.location.href = url;
+                window.location.href = path + (params.toString() ? `?${{params}}` : '');
+            }}
+            document.getElementById('download-csv-btn').addEventListener('click', function() {{
+                downloadExport('/admin/download_csv');
+            }});
+            document.getElementById('download-certs-btn').addEventListener('click', function() {{
+                downloadExport('/admin/download_certificates');
             }});
 
 			document.querySelectorAll('.delete-btn').forEach(btn => {{
@@ -665,7 +894,8 @@ def index_redirect():
 # New route for campaign access
 @main_app.route("/<campaign_slug>")
 def campaign_access(campaign_slug):
-	# Check if the slug is a campaign
+	# Check if the slug is a campaign (answered from the in-process
+	# campaign cache, which also remembers misses like /favicon.ico)
 	campaign = storage.get_campaign_by_slug(campaign_slug)
 	if campaign:
 		if not campaign.get("enabled", True):
@@ -692,7 +922,11 @@ def submit_result():
 
 	result = None
 	try:
-		result = tester.create_result(tester_data)
+		if ingest.journal_enabled():
+			# Acknowledge once journaled; the applier saves it shortly after
+			result = ingest.submit(tester_data)
+		else:
+			result = tester.create_result(tester_data)
 	except Exception:
 		print(traceback.format_exc())
 	if result:
@@ -773,7 +1007,8 @@ def submit_result():
 def admin_campaigns_panel():
 	require_admin()
 	
-	campaigns = storage.get_campaigns() # Now returns {slug, name, enabled}
+	campaigns = storage.get_campaigns() # Now returns {slug, name, enabled, cert_template}
+	template_names = certs.renderer.template_names()
 	campaigns_html = ""
 	for campaign in campaigns:
 		campaign_url = f"{request.urlparts.scheme}://{request.urlparts.netloc}/{campaign['slug']}"
@@ -781,6 +1016,11 @@ def admin_campaigns_panel():
 		link_style = '' if enabled else 'style="pointer-events:none;opacity:0.5;text-decoration:line-through;"'
 		btn_text = 'Disable' if enabled else 'Enable'
 		btn_class = 'toggle-enable-btn' + ('' if enabled else ' disabled-campaign')
+		campaign_template = certs.renderer.resolve(campaign.get("cert_template"))
+		template_options_html = "".join(
+			f'<option value="{name}"{" selected" if name == campaign_template else ""}>' \
+			f'{sanitize_html(certs.renderer.label(name))}</option>'
+			for name in template_names)
 		campaigns_html += f'''
 		<tr data-slug="{campaign['slug']}">
 			<td>{campaign.get("name", "N/A")}</td>
@@ -788,6 +1028,9 @@ def admin_campaigns_panel():
 				<span id="link-{campaign['slug']}"><a href="{campaign_url}" target="_blank" {link_style}>{campaign_url}</a></span>
 				<button class="copy-link-btn" data-link="{campaign_url}">Copy</button>
 			</td>
+			<td>
+				<select class="template-select" data-slug="{campaign['slug']}">{template_options_html}</select>
+			</td>
 			<td>
 				<button class="{btn_class}" data-slug="{campaign['slug']}" data-enabled="{int(enabled)}">{btn_text}</button>
 				<button class="delete-campaign-btn" data-slug="{campaign['slug']}">Delete</button>
@@ -951,6 +1194,7 @@ def admin_campaigns_panel():
 					<tr>
 						<th>Name</th>
 						<th>Link</th>
+						<th>Certificate</th>
 						<th>Actions</th>
 					</tr>
 				</thead>
@@ -985,6 +1229,25 @@ def admin_campaigns_panel():
 					}});
 			}});
 			
+			// Handle Certificate Template
+			document.querySelectorAll('.template-select').forEach(select => {{
+				select.addEventListener('change', async function() {{
+					try {{
+						const response = await fetch(`/admin/campaigns/${{this.dataset.slug}}/template`, {{
+							method: 'POST',
+							headers: {{ 'Content-Type': 'application/json' }},
+							body: JSON.stringify({{ template: this.value }})
+						}});
+						const data = await response.json();
+						if(!data.success) {{
+							alert('Failed to update certificate template');
+						}}
+					}} catch(e) {{
+						alert('Error updating campaign: ' + e.message);
+					}}
+				}});
+			}});
+			
 			// Handle Create Campaign
 			document.getElementById('create-campaign-form').addEventListener('submit', async function(e) {{
 				e.preventDefault();
@@ -1089,6 +1352,21 @@ def admin_create_campaign():
 		print(traceback.format_exc())
 		return json.dumps({"success": False, "message": "Internal error"})
 
+@main_app.route("/admin/campaigns/<slug>/template", method="POST")
+def admin_set_campaign_template(slug):
+	require_admin()
+	response.content_type = "application/json"
+	try:
+		template = request.json.get("template")
+		if template not in certs.renderer.template_names():
+			return json.dumps({"success": False, "message": "Unknown template"})
+		# The default template is stored as NULL, so it follows the manifest
+		storage.set_campaign_template(slug, None if template == certs.DEFAULT_TEMPLATE else template)
+		return json.dumps({"success": True})
+	except Exception:
+		print(traceback.format_exc())
+		return json.dumps({"success": False, "message": "Internal error"})
+
 @main_app.route("/admin/campaigns/<slug>", method="DELETE")
 def admin_delete_campaign(slug):
 	require_admin()
@@ -0,0 +1,248 @@
+"""Read cache shared by the worker processes of one host.
+
+Workers are separate processes, so an in-process cache warms once per
+worker and can't see what another worker deleted. This one lives in a
+small SQLite file next to the database (SHARED_CACHE_PATH), so a row one
+worker loaded serves all of them and an invalidation reaches all of them
+at once. Used by storage.get_result and storage.get_campaign_by_slug.
+
+Entries outlive the workers, so the file remembers which database they
+were loaded from and is only emptied when that changes.
+"""
+import json, os, sqlite3, threading, time
+from pathlib import Path
+
+DEFAULT_PATH = Path(__file__).parent / "shared_cache.db"
+# Bumped when the tables change; an older file is emptied and rebuilt
+SCHEMA_VERSION = 2
+
+class SharedCache():
+    """Bounded LRU cache of JSON values in a SQLite file.
+
+    Off until `start()`, which the server calls at startup: maintenance
+    commands and benchmarks read the database directly. Past
+    SHARED_CACHE_SIZE entries (default 100000, 0 disables the cache) the
+    least recently used tenth is evicted. To keep hits read-only, the last
+    use of an entry is only recorded again after `touch_interval` seconds.
+
+    `invalidate()` leaves a tombstone stamped with the time, and `put()`
+    doesn't replace a tombstone newer than the start of the read it
+    caches: a worker that read a row just before another worker deleted
+    it can't cache it again. For that guard to hold, tombstones are kept
+    for `max_load_seconds` and reads that took longer aren't cached.
+    Changes the cache wasn't told about, such as those made by maintenance
+    commands, show within SHARED_CACHE_TTL seconds (default 3600): older
+    entries are misses. A cache error counts as a miss, except in
+    `invalidate()`, where it is raised.
+
+    Hits and misses are counted in each process and added to the shared
+    counters every `flush_interval` seconds, so `stats()` covers all
+    workers.
+    """
+    MISS = object()
+
+    def __init__(self, path=None, max_entries=None, ttl=None, touch_interval=60,
+            flush_interval=5, evict_check_every=100, max_load_seconds=60):
+        self._path = path
+        self._max_entries = max_entries
+        self._ttl = ttl
+        self.touch_interval = touch_interval
+        self.flush_interval = flush_interval
+        self.evict_check_every = evict_check_every
+        self.max_load_seconds = max_load_seconds
+        self._started = False
+        self._lock = threading.Lock()
+        self._conn = None
+        self._pid = None
+        self._hits = 0
+        self._misses = 0
+        self._puts = 0
+        self._flushed_at = time.monotonic()
+
+    def path(self):
+        return Path(self._path or os.getenv("SHARED_CACHE_PATH") or DEFAULT_PATH)
+
+    def max_entries(self):
+        if self._max_entries is None:
+            return int(os.getenv("SHARED_CACHE_SIZE", "100000"))
+        return self._max_entries
+
+    def ttl(self):
+        if self._ttl is None:
+            return float(os.getenv("SHARED_CACHE_TTL", "3600"))
+        return self._ttl
+
+    def enabled(self):
+        return self._started and self.max_entries() > 0
+
+    def start(self, identity):
+        """Turns the cache on in this process.
+
+        `identity` names the data behind the cache (see
+        StorageBackend.cache_identity). Entries filled under another one
+        come from a database that has since been replaced or restored, so
+        the first worker to start after a change empties the cache; the
+        others, and workers started later, keep what it holds.
+        """
+        if self.max_entries() <= 0:
+            return
+        with self._lock:
+            conn = self._connection()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = conn.execute(
+                    "SELECT value FROM meta WHERE name = 'identity'").fetchone()
+                if row is None or row[0] != identity:
+                    conn.execute("DELETE FROM entries")
+                    conn.execute("INSERT OR REPLACE INTO meta VALUES ('identity', ?)",
+                        (identity,))
+                conn.execute("COMMIT")
+            except:
+                conn.execute("ROLLBACK")
+                raise
+        self._started = True
+
+    def get_or_load(self, key, load):
+        """Returns the value cached for `key`, or load()'s, cached unless None."""
+        if not self.enabled():
+            return load()
+        value = self.get(key)
+        if value is not self.MISS:
+            return value
+        since = time.time()
+        value = load()
+        # A tombstone left during a longer read may be gone already
+        if value is not None and time.time() - since < self.max_load_seconds:
+            self.put(key, value, since)
+        return value
+
+    def get(self, key):
+        now = time.time()
+        try:
+            with self._lock:
+                conn = self._connection()
+                row = conn.execute("SELECT value, used, stored FROM entries WHERE key = ?",
+                    (key,)).fetchone()
+                if row is None or row[0] is None or now - row[2] > self.ttl():
+                    self._misses += 1
+                    value = self.MISS
+                else:
+                    self._hits += 1
+                    value = json.loads(row[0])
+                    if now - row[1] > self.touch_interval:
+                        conn.execute("UPDATE entries SET used = ? " \
+                            "WHERE key = ? AND value IS NOT NULL", (now, key))
+                self._flush_counters(conn)
+            return value
+        except sqlite3.Error:
+            return self.MISS
+
+    def put(self, key, value, since):
+        """Caches `value`, unless `key` was invalidated after `since`."""
+        try:
+            with self._lock:
+                conn = self._connection()
+                now = time.time()
+                conn.execute("INSERT INTO entries (key, value, used, stored) VALUES (?, ?, ?, ?) " \
+                    "ON CONFLICT(key) DO UPDATE SET value = excluded.value, " \
+                    "used = excluded.used, stored = excluded.stored " \
+                    "WHERE entries.value IS NOT NULL OR entries.used < ?",
+                    (key, json.dumps(value), now, now, since))
+                self._puts += 1
+                if self._puts % self.evict_check_every == 0:
+                    self._evict(conn)
+        except sqlite3.Error:
+            pass
+
+    def invalidate(self, key):
+        if not self.enabled():
+            return
+        with self._lock:
+            now = time.time()
+            self._connection().execute("INSERT INTO entries (key, value, used, stored) " \
+                "VALUES (?, NULL, ?, ?) ON CONFLICT(key) DO UPDATE SET value = NULL, " \
+                "used = excluded.used, stored = excluded.stored",
+                (key, now, now))
+
+    def stats(self):
+        """Hits and misses of all workers since the counters were created."""
+        if not self.enabled():
+            return {"enabled": False}
+        with self._lock:
+            conn = self._connection()
+            self._flush_counters(conn, force=True)
+            counters = dict(conn.execute("SELECT name, value FROM counters"))
+            entries = conn.execute("SELECT count(*) FROM entries " \
+                "WHERE value IS NOT NULL AND stored >= ?",
+                (time.time() - self.ttl(),)).fetchone()[0]
+        hits = counters.get("hits", 0)
+        misses = counters.get("misses", 0)
+        return {
+            "enabled": True,
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": round(hits / (hits + misses), 4) if hits + misses else None,
+            "entries": entries,
+            "max_entries": self.max_entries(),
+        }
+
+    def _connection(self):
+        if self._pid != os.getpid():
+            # Forked child: never share the parent's sqlite handle or counts
+            self._conn = None
+            self._hits = self._misses = 0
+            self._pid = os.getpid()
+        if self._conn is None:
+            conn = sqlite3.connect(self.path(), timeout=5, isolation_level=None,
+                check_same_thread=False)
+            conn.execute("PRAGMA journal_mode = WAL")
+            conn.execute("PRAGMA synchronous = NORMAL")
+            if conn.execute("PRAGMA user_version").fetchone()[0] != SCHEMA_VERSION:
+                create_tables(conn)
+            self._conn = conn
+        return self._conn
+
+    def _flush_counters(self, conn, force=False):
+        now = time.monotonic()
+        if not force and now - self._flushed_at < self.flush_interval:
+            return
+        self._flushed_at = now
+        if not self._hits and not self._misses:
+            return
+        conn.executemany("INSERT INTO counters (name, value) VALUES (?, ?) " \
+            "ON CONFLICT(name) DO UPDATE SET value = value + excluded.value",
+            (("hits", self._hits), ("misses", self._misses)))
+        self._hits = self._misses = 0
+
+    def _evict(self, conn):
+        max_entries = self.max_entries()
+        count = conn.execute("SELECT count(*) FROM entries").fetchone()[0]
+        if count > max_entries:
+            # Expired entries go first, then the least recently used;
+            # recent tombstones stay (see get_or_load)
+            now = time.time()
+            conn.execute("DELETE FROM entries WHERE key IN (" \
+                "SELECT key FROM entries WHERE value IS NOT NULL OR used < ? " \
+                "ORDER BY stored >= ?, used LIMIT ?)",
+                (now - self.max_load_seconds, now - self.ttl(),
+                    count - max_entries + max_entries // 10))
+
+def create_tables(conn):
+    # Only the first of several workers opening an older file rebuilds it
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        if conn.execute("PRAGMA user_version").fetchone()[0] != SCHEMA_VERSION:
+            conn.execute("DROP TABLE IF EXISTS entries")
+            conn.execute("CREATE TABLE entries (key text PRIMARY KEY, value text, " \
+                "used real NOT NULL, stored real NOT NULL)")
+            conn.execute("CREATE INDEX entries_used ON entries (used)")
+            conn.execute("CREATE TABLE IF NOT EXISTS counters (" \
+                "name text PRIMARY KEY, value integer NOT NULL)")
+            conn.execute("CREATE TABLE IF NOT EXISTS meta (" \
+                "name text PRIMARY KEY, value text)")
+            conn.execute("DELETE FROM meta")
+            conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+        conn.execute("COMMIT")
+    except:
+        conn.execute("ROLLBACK")
+        raise
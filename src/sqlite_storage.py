@@ -0,0 +1,1130 @@
+import datetime, itertools, os, random, sqlite3, threading
+from pathlib import Path
+from storage import StorageBackend, UNTAGGED_NAME, result_row_to_dict, \
+    campaign_row_to_dict, decode_page_cursor, encode_page_cursor, \
+    normalize_email, SCORE_BUCKET_WIDTH, new_rollup, add_to_rollup, \
+    merge_rollups, stats_from_rollups
+from util import BloomFilter
+
+DEFAULT_DB_PATH = Path(__file__).parent / "tester.db"
+
+class SQLiteBackend(StorageBackend):
+    """Stores results and campaigns in a SQLite database file."""
+
+    def __init__(self, db_path=DEFAULT_DB_PATH):
+        self.db_path = Path(db_path)
+        self.pool = ConnectionPool(self)
+        self.email_filter = EmailFilter(self)
+        self._migrate_lock = threading.Lock()
+        self._migrated_pid = None
+
+    def db(self):
+        return DBAccess(self.pool)
+
+    def close(self):
+        self.pool.close_all()
+        self.email_filter.close()
+
+    def warm_up(self):
+        # Start building the email filter before the first /check_email
+        self.email_filter.might_contain(None)
+
+    def cache_identity(self):
+        # A restored copy is a new file; one copied over the old file keeps
+        # the inode but may have been made from another database
+        stat = os.stat(self.db_path)
+        with self.db() as db:
+            database_id = read_data_version(db.cursor, "database_id")
+        return f"{stat.st_dev}:{stat.st_ino}:{database_id}"
+
+    # --- Campaign Management Functions (New) ---
+
+    def create_campaign(self, slug, name):
+        with self.db() as db:
+            try:
+                db.cursor.execute(
+                    "INSERT INTO campaigns (slug, name, enabled) VALUES (?, ?, 1)", (slug, name)
+                )
+            except sqlite3.IntegrityError:
+                return False
+            bump_data_version(db.cursor, "campaigns")
+            return True
+
+    def get_campaigns(self):
+        with self.db() as db:
+            dbres = db.cursor.execute(
+                f"SELECT {CAMPAIGN_COLUMNS} FROM campaigns ORDER BY name ASC")
+            rows = dbres.fetchall()
+            return [campaign_row_to_dict(row) for row in rows]
+
+    def get_campaign_by_slug(self, slug):
+        with self.db() as db:
+            dbres = db.cursor.execute(
+                f"SELECT {CAMPAIGN_COLUMNS} FROM campaigns WHERE slug = ?", (slug,)
+            )
+            row = dbres.fetchone()
+            if row:
+                return campaign_row_to_dict(row)
+            return None
+
+    def delete_campaign(self, slug):
+        with self.db() as db:
+            db.cursor.execute("DELETE FROM campaigns WHERE slug = ?", (slug,))
+            bump_data_version(db.cursor, "campaigns")
+
+    def set_campaign_enabled(self, slug, enabled):
+        with self.db() as db:
+            db.cursor.execute("UPDATE campaigns SET enabled = ? WHERE slug = ?", (int(enabled), slug))
+            bump_data_version(db.cursor, "campaigns")
+
+    def set_campaign_template(self, slug, template):
+        with self.db() as db:
+            db.cursor.execute("UPDATE campaigns SET cert_template = ? WHERE slug = ?", (template, slug))
+            bump_data_version(db.cursor, "campaigns")
+
+    def get_campaigns_version(self):
+        with self.db() as db:
+            return read_data_version(db.cursor, "campaigns")
+
+    # --- Result Functions ---
+
+    def cert_id_exists(self, cert_id):
+        with self.db() as db:
+            dbres = db.cursor.execute(
+                "SELECT 1 FROM results WHERE id = ? " \
+                "UNION ALL SELECT 1 FROM archived_results WHERE id = ?",
+                (cert_id, cert_id))
+            search = dbres.fetchone()
+            return bool(search)
+
+    def email_exists(self, email):
+        email = normalize_email(email)
+        # Most emails checked were never seen: let the filter answer those
+        if not self.email_filter.might_contain(email):
+            return False
+        with self.db() as db:
+            dbres = db.cursor.execute(
+                "SELECT 1 FROM results WHERE email_norm = ? " \
+                "UNION ALL SELECT 1 FROM archived_results WHERE email_norm = ?",
+                (email, email))
+            search = dbres.fetchone()
+            return bool(search)
+
+    def get_result(self, result_id):
+        with self.db() as db:
+            dbres = db.cursor.execute(
+                f"SELECT {RESULT_COLUMNS} FROM results WHERE id = ?", (result_id,))
+            row = dbres.fetchone()
+            if row is None:
+                row = self._attach_archived(db, result_id)
+            if row:
+                return result_row_to_dict(row)
+
+    def save_result(self, result_row):
+        with self.db() as db:
+            db.cursor.execute(INSERT_RESULT, insert_params(result_row))
+            add_to_campaign_stats(db.cursor, result_row)
+        self.email_filter.add(result_row[7])
+
+    def insert_result(self, result_row, new_id):
+        result_row = tuple(result_row)
+        self.email_filter.add(result_row[7])
+        with self.db() as db:
+            while True:
+                if is_archived(db.cursor, result_row[0]):
+                    result_row = (new_id(),) + result_row[1:]
+                    continue
+                try:
+                    if HAS_RETURNING:
+                        dbres = db.cursor.execute(
+                            f"{INSERT_RESULT} RETURNING {RESULT_COLUMNS}",
+                            insert_params(result_row))
+                        result = result_row_to_dict(dbres.fetchone())
+                    else:
+                        db.cursor.execute(INSERT_RESULT, insert_params(result_row))
+                        result = result_row_to_dict(result_row)
+                except sqlite3.IntegrityError:
+                    result_row = (new_id(),) + result_row[1:]
+                    continue
+                add_to_campaign_stats(db.cursor, result_row)
+                return result
+
+    def get_all_results(self):
+        with self.db() as db:
+            dbres = db.cursor.execute(
+                f"SELECT {RESULT_COLUMNS} FROM results ORDER BY submit_time DESC")
+            rows = dbres.fetchall()
+            return [result_row_to_dict(row) for row in rows]
+
+    def delete_result(self, result_id):
+        with self.db() as db:
+            row = db.cursor.execute(
+                f"SELECT {RESULT_COLUMNS} FROM results WHERE id = ?",
+                (result_id,)).fetchone()
+            if row is not None:
+                db.cursor.execute("DELETE FROM results WHERE id = ?", (result_id,))
+            else:
+                row = self._attach_archived(db, result_id)
+                if row is None:
+                    return
+                db.cursor.execute("DELETE FROM archive.results WHERE id = ?", (result_id,))
+                db.cursor.execute("DELETE FROM archived_results WHERE id = ?", (result_id,))
+            remove_from_campaign_stats(db.cursor, row)
+            bump_data_version(db.cursor, "results_deletes")
+
+    # --- Journaled Ingestion ---
+
+    def get_journal_position(self):
+        with self.db() as db:
+            state = dict(db.cursor.execute("SELECT name, value FROM ingest_state " \
+                "WHERE name IN ('journal_generation', 'journal_offset')"))
+        return state.get("journal_generation", 0), state.get("journal_offset", 0)
+
+    def set_journal_position(self, generation, offset):
+        with self.db() as db:
+            db.cursor.executemany("INSERT OR REPLACE INTO ingest_state VALUES (?, ?)",
+                (("journal_generation", generation), ("journal_offset", offset)))
+
+    def apply_journaled_results(self, result_rows, journal_offset):
+        # Offset and rows commit together; see StorageBackend for semantics
+        inserted = []
+        rejected = []
+        with self.db() as db:
+            for result_row in result_rows:
+                result_row = tuple(result_row)
+                if is_archived(db.cursor, result_row[0]):
+                    rejected.append(result_row)
+                    continue
+                db.cursor.execute(INSERT_RESULT_OR_IGNORE, insert_params(result_row))
+                if db.cursor.rowcount:
+                    add_to_campaign_stats(db.cursor, result_row)
+                    inserted.append(result_row_to_dict(result_row))
+                    continue
+                existing = db.cursor.execute(
+                    "SELECT submit_time, user_name, email FROM results WHERE id = ?",
+                    (result_row[0],)).fetchone()
+                if existing != (result_row[3], result_row[5], result_row[7]):
+                    rejected.append(result_row)
+            db.cursor.execute(
+                "INSERT OR REPLACE INTO ingest_state VALUES ('journal_offset', ?)",
+                (journal_offset,))
+        for result in inserted:
+            self.email_filter.add(result["email"])
+        return inserted, rejected
+
+    # --- Result Listing ---
+
+    def get_results_page(self, campaign_slug=None, page_size=50, cursor=None):
+        # Keyset on (submit_time, id): every page is one index range scan
+        where, params = campaign_filter_sql(campaign_slug)
+        if cursor:
+            where += " AND (r.submit_time, r.id) < (?, ?)"
+            params += decode_page_cursor(cursor)
+        with self.db() as db:
+            dbres = db.cursor.execute(
+                f"SELECT {JOINED_RESULT_COLUMNS}, c.name FROM results r " \
+                "LEFT JOIN campaigns c ON c.slug = r.campaign_slug " \
+                f"WHERE {where} ORDER BY r.submit_time DESC, r.id DESC LIMIT ?",
+                params + (page_size + 1,))
+            rows = dbres.fetchall()
+        results = [joined_row_to_dict(row) for row in rows[:page_size]]
+        next_cursor = None
+        if len(rows) > page_size:
+            next_cursor = encode_page_cursor(results[-1])
+        return results, next_cursor
+
+    def iter_results(self, campaign_slug=None, batch_size=500, include_archived=False):
+        where, params = campaign_filter_sql(campaign_slug)
+        yield from self._iter_joined_rows(None, "results", where, params, batch_size)
+        if not include_archived:
+            return
+        # Archived months are older than anything still in the hot database
+        for partition in self._archive_partitions():
+            path = self.archive_path(partition)
+            if not path.exists():
+                continue
+            yield from self._iter_joined_rows(
+                path, "archive.results", where, params, batch_size)
+
+    def _iter_joined_rows(self, archive_path, table, where, params, batch_size):
+        # Keyset batches, each its own short read like export_results: a
+        # read left open for a whole slow download would pin the WAL
+        before = None
+        while True:
+            batch_where, batch_params = where, params
+            if before:
+                batch_where += " AND (r.submit_time, r.id) < (?, ?)"
+                batch_params += before
+            with self.db() as db:
+                if archive_path is not None:
+                    db.attach(archive_path, "archive")
+                rows = db.cursor.execute(
+                    f"SELECT {JOINED_RESULT_COLUMNS}, c.name FROM {table} r " \
+                    "LEFT JOIN main.campaigns c ON c.slug = r.campaign_slug " \
+                    f"WHERE {batch_where} ORDER BY r.submit_time DESC, r.id DESC LIMIT ?",
+                    batch_params + (batch_size,)).fetchall()
+            for row in rows:
+                yield joined_row_to_dict(row)
+            if len(rows) < batch_size:
+                return
+            before = (rows[-1][3], rows[-1][0])
+
+    # --- Aggregate Statistics ---
+
+    def get_result_stats(self, start_time=None, end_time=None):
+        with self.db() as db:
+            campaign_names = dict(db.cursor.execute("SELECT slug, name FROM campaigns"))
+            if start_time is None and end_time is None:
+                return stats_from_rollups(read_campaign_stats(db.cursor), campaign_names)
+            where, params = "1", ()
+            if start_time is not None:
+                where += " AND submit_time >= ?"
+                params += (start_time,)
+            if end_time is not None:
+                where += " AND submit_time < ?"
+                params += (end_time,)
+            rollups = read_range_rollups(db.cursor, "results r", where, params)
+        # Archived months overlapping the range, one attach at a time
+        for partition in self._archive_partitions():
+            start, end = month_bounds(partition)
+            if (end_time is not None and start >= end_time) or \
+                    (start_time is not None and end <= start_time):
+                continue
+            path = self.archive_path(partition)
+            if not path.exists():
+                continue
+            with self.db() as db:
+                db.attach(path, "archive")
+                archived = read_range_rollups(db.cursor, ARCHIVE_LISTED_RESULTS, where, params)
+            for slug, rollup in archived.items():
+                merge_rollups(rollups.setdefault(slug, new_rollup()), rollup)
+        return stats_from_rollups(rollups, campaign_names)
+
+    def rebuild_campaign_stats(self):
+        # Archived rollups are read first: attaching needs no open transaction
+        archived = []
+        for partition in self._archive_partitions():
+            path = self.archive_path(partition)
+            if path.exists():
+                with self.db() as db:
+                    db.attach(path, "archive")
+                    archived.append(read_archive_rollups(db.cursor))
+        with self.db() as db:
+            rebuild_campaign_stats(db.cursor)
+            for rollups in archived:
+                for slug, rollup in rollups.items():
+                    add_rollup_to_campaign_stats(db.cursor, rollup_key(slug), rollup)
+
+    # --- Bulk Transfer ---
+
+    def export_results(self, after=None, batch_size=5000, include_archived=False):
+        partitions = []
+        if include_archived:
+            partitions = sorted(self._archive_partitions())
+        for partition in partitions + [None]:
+            if partition is not None:
+                path = self.archive_path(partition)
+                if not path.exists() or (after and month_bounds(partition)[1] <= after[0]):
+                    continue
+            while True:
+                with self.db() as db:
+                    table, where, params = "results r", "1", ()
+                    if partition is not None:
+                        db.attach(path, "archive")
+                        table = ARCHIVE_LISTED_RESULTS
+                    if after:
+                        where += " AND (r.submit_time, r.id) > (?, ?)"
+                        params = tuple(after)
+                    rows = db.cursor.execute(
+                        f"SELECT {JOINED_RESULT_COLUMNS} FROM {table} WHERE {where} " \
+                        "ORDER BY r.submit_time, r.id LIMIT ?", params + (batch_size,)).fetchall()
+                for row in rows:
+                    yield result_row_to_dict(row)
+                if len(rows) < batch_size:
+                    break
+                after = (rows[-1][3], rows[-1][0])
+
+    def import_results(self, result_rows, batch_size=50000):
+        # A dedicated connection, tuned for loading rather than serving
+        self.migrate()
+        conn = open_connection(self.db_path)
+        conn.isolation_level = None
+        cache_size_kb = sqlite_setting("IMPORT_CACHE_SIZE_KB", 262144)
+        conn.execute(f"PRAGMA cache_size = -{cache_size_kb}")
+        conn.execute("PRAGMA temp_store = MEMORY")
+        inserted = 0
+        try:
+            cursor = conn.cursor()
+            cursor.execute("BEGIN IMMEDIATE")
+            # Into an empty table (seeding, a new host) everything goes in one
+            # transaction, with the indexes dropped and built once at the
+            # end, which is much faster than updating them row by row.
+            # Otherwise each batch commits on its own, letting the server's
+            # writes in between.
+            empty = cursor.execute(
+                "SELECT NOT EXISTS (SELECT 1 FROM results)").fetchone()[0]
+            indexes = []
+            if empty:
+                indexes = cursor.execute(
+                    "SELECT name, sql FROM sqlite_master WHERE type = 'index' " \
+                    "AND tbl_name = 'results' AND sql IS NOT NULL").fetchall()
+                for name, _ in indexes:
+                    cursor.execute(f"DROP INDEX {name}")
+            any_archived = cursor.execute(
+                "SELECT EXISTS (SELECT 1 FROM archived_results)").fetchone()[0]
+            result_rows = iter(result_rows)
+            while True:
+                batch = list(itertools.islice(result_rows, batch_size))
+                if not batch:
+                    break
+                if any_archived:
+                    batch = [row for row in batch if not is_archived(cursor, row[0])]
+                changes = conn.total_changes
+                cursor.executemany(INSERT_RESULT_OR_IGNORE,
+                    (insert_params(row) for row in batch))
+                inserted += conn.total_changes - changes
+                if not empty:
+                    cursor.execute("COMMIT")
+                    cursor.execute("BEGIN IMMEDIATE")
+            for _, sql in indexes:
+                cursor.execute(sql)
+            cursor.execute("COMMIT")
+            conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        except BaseException:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+        if inserted:
+            self.rebuild_campaign_stats()
+        return inserted
+
+    # --- Archival ---
+
+    def archive_dir(self):
+        return Path(os.getenv("ARCHIVE_DIR") or self.db_path.parent / "archive")
+
+    def archive_path(self, partition):
+        return self.archive_dir() / f"results-{partition}.db"
+
+    def archive_results(self, before_time):
+        with self.db() as db:
+            partitions = [row[0] for row in db.cursor.execute(
+                "SELECT DISTINCT strftime('%Y-%m', submit_time, 'unixepoch') " \
+                "FROM results WHERE submit_time < ?", (before_time,))]
+        return sum(self._archive_partition(partition, before_time)
+            for partition in partitions)
+
+    def _archive_partition(self, partition, before_time):
+        start, end = month_bounds(partition)
+        end = min(end, before_time)
+        path = self.archive_path(partition)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with self.db() as db:
+            db.attach(path, "archive")
+            for statement in ARCHIVE_SCHEMA:
+                db.cursor.execute(statement)
+            # Copy and commit the archive on its own first: a transaction over
+            # attached databases isn't atomic across files in WAL mode. If we
+            # stop before the second commit, the rows are copied again next time.
+            db.cursor.execute(
+                f"INSERT OR REPLACE INTO archive.results ({RESULT_COLUMNS}, email_norm) " \
+                f"SELECT {RESULT_COLUMNS}, email_norm FROM main.results " \
+                "WHERE submit_time >= ? AND submit_time < ?", (start, end))
+            db.conn.commit()
+            moved = "main.results WHERE submit_time >= ? AND submit_time < ? " \
+                "AND id IN (SELECT id FROM archive.results)"
+            db.cursor.execute(
+                "INSERT OR REPLACE INTO archived_results SELECT id, ?, " \
+                f"email_norm, campaign_slug, submit_time, score FROM {moved}",
+                (partition, start, end))
+            db.cursor.execute(f"DELETE FROM {moved}", (start, end))
+            count = db.cursor.rowcount
+            db.cursor.execute(
+                "INSERT OR IGNORE INTO archive_partitions VALUES (?)", (partition,))
+            # Rollups keep counting archived results, so they stay as they are
+            bump_data_version(db.cursor, "results_deletes")
+        return count
+
+    def _archive_partitions(self):
+        with self.db() as db:
+            return [row[0] for row in db.cursor.execute(
+                "SELECT partition FROM archive_partitions ORDER BY partition DESC")]
+
+    def _attach_archived(self, db, result_id):
+        # Attaches the archive holding `result_id` as "archive", returns its row
+        found = db.cursor.execute(
+            "SELECT partition FROM archived_results WHERE id = ?",
+            (result_id,)).fetchone()
+        if found is None:
+            return None
+        path = self.archive_path(found[0])
+        if not path.exists():
+            return None
+        db.attach(path, "archive")
+        return db.cursor.execute(
+            f"SELECT {RESULT_COLUMNS} FROM archive.results WHERE id = ?",
+            (result_id,)).fetchone()
+
+    def vacuum(self):
+        with self.db() as db:
+            db.cursor.execute("VACUUM")
+
+    # --- Schema Migrations ---
+
+    def migrate(self):
+        """Applies pending migrations once per process.
+
+        Safe to call from several worker processes at once: the version is
+        re-read after taking an exclusive lock on the database, so only the
+        first worker applies a step and the others see it done.
+        """
+        with self._migrate_lock:
+            if self._migrated_pid == os.getpid():
+                return
+            conn = open_connection(self.db_path)
+            try:
+                conn.isolation_level = None
+                cursor = conn.cursor()
+                cursor.execute("BEGIN EXCLUSIVE")
+                try:
+                    version = cursor.execute("PRAGMA user_version").fetchone()[0]
+                    for step, migration in enumerate(MIGRATIONS[version:], version + 1):
+                        migration(cursor)
+                        cursor.execute(f"PRAGMA user_version = {step}")
+                    cursor.execute("COMMIT")
+                except:
+                    cursor.execute("ROLLBACK")
+                    raise
+            finally:
+                conn.close()
+            self._migrated_pid = os.getpid()
+
+# RETURNING needs SQLite 3.35+; older libraries echo the inserted tuple
+HAS_RETURNING = sqlite3.sqlite_version_info >= (3, 35, 0)
+
+def campaign_filter_sql(campaign_slug):
+    """Builds the WHERE clause for an admin campaign filter.
+
+    The clause expects the results table aliased as `r` and campaigns
+    left-joined as `c`; see StorageBackend.get_results_page for values.
+    """
+    if not campaign_slug or campaign_slug == "all":
+        return "1", ()
+    if campaign_slug == "untagged":
+        return "c.slug IS NULL", ()
+    return "r.campaign_slug = ?", (campaign_slug,)
+
+def bump_data_version(cursor, name):
+    # Same transaction as the change, so other workers never miss it
+    cursor.execute(
+        "UPDATE data_versions SET value = value + 1 WHERE name = ?", (name,))
+
+def read_data_version(cursor, name):
+    return cursor.execute(
+        "SELECT value FROM data_versions WHERE name = ?", (name,)).fetchone()[0]
+
+# Result columns in the order of result rows; email_norm is derived on insert
+RESULT_COLUMNS = "id, score, age, submit_time, payment_id, user_name, " \
+    "result_tier, email, test_duration, correct_answers, campaign_slug"
+# Schema of the results table before email_norm
+RESULT_COLUMNS_DDL = "id text PRIMARY KEY, score integer, " \
+    "age integer, submit_time integer, payment_id text, " \
+    "user_name text, result_tier integer, email text, " \
+    "test_duration integer, correct_answers integer, " \
+    "campaign_slug text"
+CAMPAIGN_COLUMNS = "slug, name, enabled, cert_template"
+JOINED_RESULT_COLUMNS = ", ".join("r." + c for c in RESULT_COLUMNS.split(", "))
+INSERT_RESULT = f"INSERT INTO results ({RESULT_COLUMNS}, email_norm) " \
+    "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"
+INSERT_RESULT_OR_IGNORE = INSERT_RESULT.replace("INSERT", "INSERT OR IGNORE", 1)
+
+def insert_params(result_row):
+    return tuple(result_row) + (normalize_email(result_row[7]),)
+
+def joined_row_to_dict(row):
+    # A results row followed by the left-joined campaign name
+    result = result_row_to_dict(row)
+    result["campaign_name"] = row[11] or UNTAGGED_NAME
+    return result
+
+# --- Campaign Stats ---
+#
+# campaign_stats holds one rollup (see storage.new_rollup) per campaign_slug
+# of results, keyed by '' for results without one, and
+# campaign_score_buckets its score histogram. Both are updated in the same
+# transaction as the insert or delete of a result.
+
+ROLLUP_COLUMNS = "count, score_count, score_sum, score_sq_sum, " \
+    "min_score, max_score, duration_count, duration_sum, " \
+    "first_submit, last_submit"
+
+# Aggregates of results in ROLLUP_COLUMNS order; see storage.add_to_rollup
+ROLLUP_AGGREGATES = "COUNT(*), " \
+    "COUNT(CASE WHEN score THEN 1 END), " \
+    "COALESCE(SUM(CASE WHEN score THEN score END), 0), " \
+    "COALESCE(SUM(CASE WHEN score THEN score * score END), 0), " \
+    "MIN(CASE WHEN score THEN score END), " \
+    "MAX(CASE WHEN score THEN score END), " \
+    "COUNT(CASE WHEN test_duration THEN 1 END), " \
+    "COALESCE(SUM(CASE WHEN test_duration THEN test_duration END), 0), " \
+    "MIN(submit_time), MAX(submit_time)"
+
+SCORE_BUCKET_SQL = f"score / {SCORE_BUCKET_WIDTH} * {SCORE_BUCKET_WIDTH}"
+
+def rollup_key(campaign_slug):
+    return campaign_slug or ""
+
+def rollup_key_sql(key):
+    # Matches the results counted under a campaign_stats key
+    if key:
+        return "campaign_slug = ?", (key,)
+    return "(campaign_slug IS NULL OR campaign_slug = '')", ()
+
+def rollup_from_row(row):
+    rollup = new_rollup()
+    rollup.update(zip(ROLLUP_COLUMNS.split(", "), row))
+    return rollup
+
+def add_to_campaign_stats(cursor, result_row):
+    rollup = new_rollup()
+    add_to_rollup(rollup, result_row)
+    add_rollup_to_campaign_stats(cursor, rollup_key(result_row[10]), rollup)
+
+def add_rollup_to_campaign_stats(cursor, key, rollup):
+    cursor.execute(
+        f"INSERT INTO campaign_stats (campaign_slug, {ROLLUP_COLUMNS}) " \
+        "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?) " \
+        "ON CONFLICT(campaign_slug) DO UPDATE SET " \
+        "count = count + excluded.count, " \
+        "score_count = score_count + excluded.score_count, " \
+        "score_sum = score_sum + excluded.score_sum, " \
+        "score_sq_sum = score_sq_sum + excluded.score_sq_sum, " \
+        "min_score = CASE WHEN min_score IS NULL OR excluded.min_score < min_score " \
+            "THEN excluded.min_score ELSE min_score END, " \
+        "max_score = CASE WHEN max_score IS NULL OR excluded.max_score > max_score " \
+            "THEN excluded.max_score ELSE max_score END, " \
+        "duration_count = duration_count + excluded.duration_count, " \
+        "duration_sum = duration_sum + excluded.duration_sum, " \
+        "first_submit = CASE WHEN first_submit IS NULL OR excluded.first_submit < first_submit " \
+            "THEN excluded.first_submit ELSE first_submit END, " \
+        "last_submit = CASE WHEN last_submit IS NULL OR excluded.last_submit > last_submit " \
+            "THEN excluded.last_submit ELSE last_submit END",
+        (key,) + tuple(rollup[column] for column in ROLLUP_COLUMNS.split(", ")))
+    for bucket, count in rollup["histogram"].items():
+        cursor.execute(
+            "INSERT INTO campaign_score_buckets VALUES (?, ?, ?) " \
+            "ON CONFLICT(campaign_slug, bucket) DO UPDATE SET count = count + excluded.count",
+            (key, bucket, count))
+
+def remove_from_campaign_stats(cursor, result_row):
+    # Called after the result row is deleted
+    rollup = new_rollup()
+    add_to_rollup(rollup, result_row)
+    key = rollup_key(result_row[10])
+    cursor.execute(
+        "UPDATE campaign_stats SET count = count - 1, " \
+        "score_count = score_count - ?, score_sum = score_sum - ?, " \
+        "score_sq_sum = score_sq_sum - ?, duration_count = duration_count - ?, " \
+        "duration_sum = duration_sum - ? WHERE campaign_slug = ?",
+        (rollup["score_count"], rollup["score_sum"], rollup["score_sq_sum"],
+            rollup["duration_count"], rollup["duration_sum"], key))
+    for bucket in rollup["histogram"]:
+        cursor.execute(
+            "UPDATE campaign_score_buckets SET count = count - 1 " \
+            "WHERE campaign_slug = ? AND bucket = ?", (key, bucket))
+        cursor.execute(
+            "DELETE FROM campaign_score_buckets " \
+            "WHERE campaign_slug = ? AND bucket = ? AND count <= 0", (key, bucket))
+    row = cursor.execute(
+        "SELECT count, min_score, max_score, first_submit, last_submit " \
+        "FROM campaign_stats WHERE campaign_slug = ?", (key,)).fetchone()
+    if row is None:
+        return
+    if row[0] <= 0:
+        cursor.execute("DELETE FROM campaign_stats WHERE campaign_slug = ?", (key,))
+        return
+    # Extremes can't be decremented: re-read them if this result was one,
+    # from both the hot and the archived results. submit_time is indexed
+    # per campaign; scores only need a scan on the rare delete of a
+    # campaign's best or worst result.
+    where, params = rollup_key_sql(key)
+    if result_row[3] in (row[3], row[4]):
+        cursor.execute(
+            "UPDATE campaign_stats SET (first_submit, last_submit) = " \
+            "(SELECT MIN(low), MAX(high) FROM (" \
+            f"SELECT MIN(submit_time) AS low, MAX(submit_time) AS high FROM results WHERE {where} " \
+            f"UNION ALL SELECT MIN(submit_time), MAX(submit_time) FROM archived_results WHERE {where})) " \
+            "WHERE campaign_slug = ?", params + params + (key,))
+    if rollup["score_count"] and result_row[1] in (row[1], row[2]):
+        cursor.execute(
+            "UPDATE campaign_stats SET (min_score, max_score) = " \
+            "(SELECT MIN(low), MAX(high) FROM (" \
+            f"SELECT MIN(score) AS low, MAX(score) AS high FROM results WHERE {where} AND score " \
+            f"UNION ALL SELECT MIN(score), MAX(score) FROM archived_results WHERE {where} AND score)) " \
+            "WHERE campaign_slug = ?", params + params + (key,))
+
+def read_campaign_stats(cursor):
+    """Returns the rollups by campaign_slug, None for untagged results."""
+    rollups = {}
+    for row in cursor.execute(
+            f"SELECT campaign_slug, {ROLLUP_COLUMNS} FROM campaign_stats"):
+        rollups[row[0] or None] = rollup_from_row(row[1:])
+    for key, bucket, count in cursor.execute(
+            "SELECT campaign_slug, bucket, count FROM campaign_score_buckets"):
+        if (key or None) in rollups:
+            rollups[key or None]["histogram"][bucket] = count
+    return rollups
+
+def read_range_rollups(cursor, source, where, params):
+    """Aggregates the results of `source` (aliased r) matching `where`."""
+    rollups = {}
+    for row in cursor.execute(
+            f"SELECT r.campaign_slug, {ROLLUP_AGGREGATES} FROM {source} " \
+            f"WHERE {where} GROUP BY r.campaign_slug", params):
+        rollups[row[0]] = rollup_from_row(row[1:])
+    for slug, bucket, count in cursor.execute(
+            f"SELECT r.campaign_slug, {SCORE_BUCKET_SQL}, COUNT(*) FROM {source} " \
+            f"WHERE {where} AND r.score GROUP BY 1, 2", params):
+        rollups[slug]["histogram"][bucket] = count
+    return rollups
+
+def read_archive_rollups(cursor):
+    """Aggregates the results of the archive attached as "archive".
+
+    Only rows listed in archived_results count, so rows copied by an
+    interrupted archival run aren't counted twice.
+    """
+    rollups = {}
+    for row in cursor.execute(
+            f"SELECT r.campaign_slug, {ROLLUP_AGGREGATES} " \
+            f"FROM {ARCHIVE_LISTED_RESULTS} GROUP BY r.campaign_slug"):
+        rollups[row[0]] = rollup_from_row(row[1:])
+    for slug, bucket, count in cursor.execute(
+            f"SELECT r.campaign_slug, {SCORE_BUCKET_SQL}, COUNT(*) " \
+            f"FROM {ARCHIVE_LISTED_RESULTS} WHERE r.score GROUP BY 1, 2"):
+        rollups[slug]["histogram"][bucket] = count
+    return rollups
+
+def rebuild_campaign_stats(cursor):
+    # Hot results only; see SQLiteBackend.rebuild_campaign_stats
+    cursor.execute("DELETE FROM campaign_stats")
+    cursor.execute("DELETE FROM campaign_score_buckets")
+    cursor.execute(
+        f"INSERT INTO campaign_stats (campaign_slug, {ROLLUP_COLUMNS}) " \
+        f"SELECT COALESCE(campaign_slug, ''), {ROLLUP_AGGREGATES} " \
+        "FROM results GROUP BY COALESCE(campaign_slug, '')")
+    cursor.execute(
+        "INSERT INTO campaign_score_buckets " \
+        f"SELECT COALESCE(campaign_slug, ''), {SCORE_BUCKET_SQL}, COUNT(*) " \
+        "FROM results WHERE score GROUP BY 1, 2")
+
+# --- Archives ---
+#
+# Results older than the archival cutoff move to one SQLite file per month
+# (UTC) of submit_time, attached on demand. archived_results in the hot
+# database maps each archived id to its partition and keeps the few columns
+# needed without opening the archive: the email for /check_email and what
+# campaign_stats needs to recompute extremes.
+
+ARCHIVE_SCHEMA = [
+    f"CREATE TABLE IF NOT EXISTS archive.results ({RESULT_COLUMNS_DDL}, email_norm text)",
+    "CREATE INDEX IF NOT EXISTS archive.idx_results_submit_time " \
+        "ON results(submit_time, id)",
+    "CREATE INDEX IF NOT EXISTS archive.idx_results_campaign_time " \
+        "ON results(campaign_slug, submit_time, id)",
+]
+
+# Rows of the attached archive that archived_results lists
+ARCHIVE_LISTED_RESULTS = "archive.results r " \
+    "JOIN (SELECT id FROM main.archived_results) a ON a.id = r.id"
+
+def month_bounds(partition):
+    year, month = map(int, partition.split("-"))
+    start = datetime.datetime(year, month, 1, tzinfo=datetime.timezone.utc)
+    end = datetime.datetime(year + month // 12, month % 12 + 1, 1,
+        tzinfo=datetime.timezone.utc)
+    return int(start.timestamp()), int(end.timestamp())
+
+def is_archived(cursor, result_id):
+    return cursor.execute(
+        "SELECT 1 FROM archived_results WHERE id = ?", (result_id,)).fetchone() is not None
+
+# --- Email Filter ---
+
+class EmailFilter():
+    """In-process Bloom filter of the normalized emails in results.
+
+    Most /check_email calls are for emails never seen before, which the
+    filter answers without touching the database. It is built in a
+    background thread at startup (see warm_up) and kept current from a
+    dedicated connection: `PRAGMA data_version` tells cheaply whether any
+    other connection committed, and new rows are then read incrementally
+    by rowid. Deletes can let SQLite reuse rowids, so a delete (counted in
+    data_versions) schedules a full rebuild instead. Until a build is done
+    every email "might" exist and the database answers; stale emails only
+    cost false positives as well.
+    """
+    def __init__(self, backend, error_rate=0.01):
+        self.backend = backend
+        self.error_rate = error_rate
+        self._lock = threading.Lock()
+        self._conn = None
+        self._generation = 0
+        self._reset()
+
+    def _reset(self):
+        if self._conn is not None:
+            self._conn.close()
+        self._conn = None
+        self._generation += 1
+        self._pid = os.getpid()
+        self._bloom = None
+        self._building = False
+        self._data_version = None
+        self._deletes = None
+        self._last_rowid = 0
+
+    def might_contain(self, email):
+        with self._lock:
+            try:
+                self._refresh()
+            except sqlite3.Error:
+                self._reset()
+                return True
+            if self._bloom is None or email is None:
+                return True
+            return email in self._bloom
+
+    def add(self, email):
+        # Called before the insert commits: a false positive at worst
+        email = normalize_email(email)
+        with self._lock:
+            if self._bloom is not None and email is not None:
+                self._bloom.add(email)
+
+    def close(self):
+        with self._lock:
+            self._reset()
+
+    def _refresh(self):
+        if self._pid != os.getpid():
+            # Forked child: never share the parent's sqlite handle
+            self._conn = None
+            self._reset()
+        if self._conn is None:
+            self.backend.migrate()
+            self._conn = open_connection(self.backend.db_path)
+            self._conn.isolation_level = None
+        if self._building:
+            return
+        data_version = self._conn.execute("PRAGMA data_version").fetchone()[0]
+        if self._bloom is not None and data_version == self._data_version:
+            return
+        cursor = self._conn.cursor()
+        cursor.execute("BEGIN")
+        try:
+            deletes = read_data_version(cursor, "results_deletes")
+            max_rowid = cursor.execute(
+                "SELECT max(rowid) FROM results").fetchone()[0] or 0
+            # VACUUM may renumber rowids downwards, which also needs a rebuild
+            if self._bloom is None or deletes != self._deletes \
+                    or max_rowid < self._last_rowid \
+                    or self._bloom.count > self._bloom.capacity:
+                self._bloom = None
+                self._building = True
+                threading.Thread(target=self._build, args=(self._generation,),
+                    daemon=True, name="email-filter").start()
+                return
+            for (email,) in cursor.execute(
+                    "SELECT email_norm FROM results " \
+                    "WHERE rowid > ? AND email_norm IS NOT NULL",
+                    (self._last_rowid,)):
+                self._bloom.add(email)
+            self._last_rowid = max_rowid
+            self._data_version = data_version
+        finally:
+            cursor.execute("COMMIT")
+            cursor.close()
+
+    def _build(self, generation):
+        bloom = None
+        try:
+            conn = open_connection(self.backend.db_path)
+            try:
+                conn.isolation_level = None
+                conn.execute("BEGIN")
+                deletes = read_data_version(conn, "results_deletes")
+                max_rowid, count = conn.execute(
+                    "SELECT max(rowid), count(*) FROM results").fetchone()
+                count += conn.execute(
+                    "SELECT count(*) FROM archived_results").fetchone()[0]
+                bloom = BloomFilter(max(2 * count, 1024), self.error_rate)
+                for (email,) in conn.execute(
+                        "SELECT email_norm FROM results " \
+                        "WHERE rowid <= ? AND email_norm IS NOT NULL " \
+                        "UNION ALL SELECT email_norm FROM archived_results " \
+                        "WHERE email_norm IS NOT NULL", (max_rowid or 0,)):
+                    bloom.add(email)
+                conn.execute("COMMIT")
+            finally:
+                conn.close()
+        except sqlite3.Error:
+            bloom = None
+        with self._lock:
+            if self._generation != generation or self._pid != os.getpid():
+                return
+            self._building = False
+            if bloom is not None:
+                # Rows committed meanwhile are caught up on the next check
+                self._bloom = bloom
+                self._deletes = deletes
+                self._last_rowid = max_rowid or 0
+                self._data_version = None
+
+# --- Connection Pool ---
+
+SQLITE_STATEMENT_CACHE = 128
+
+def sqlite_setting(name, default):
+    """Reads an integer connection setting from the environment.
+
+    Read at connect time rather than import time, since server.py loads
+    the .env file only after importing the storage modules.
+    """
+    return int(os.getenv(name, default))
+
+class ConnectionPool():
+    """Per-process pool of long-lived SQLite connections.
+
+    Connections are opened lazily, configured once (WAL journal, busy
+    timeout, page cache, mmap) and handed back to the pool after use, so
+    the prepared statement cache of each connection is reused across
+    requests. Idle connections above `max_idle` are closed on release.
+    """
+    def __init__(self, backend, max_idle=None):
+        self.backend = backend
+        self.max_idle = max_idle
+        self._lock = threading.Lock()
+        self._idle = []
+        self._pid = os.getpid()
+
+    def acquire(self):
+        with self._lock:
+            if self._pid != os.getpid():
+                # Forked child: never share the parent's sqlite handles
+                self._idle = []
+                self._pid = os.getpid()
+            if self._idle:
+                return self._idle.pop()
+        return self._connect()
+
+    def release(self, conn):
+        with self._lock:
+            max_idle = self.max_idle
+            if max_idle is None:
+                max_idle = sqlite_setting("SQLITE_POOL_SIZE", 4)
+            if self._pid == os.getpid() and len(self._idle) < max_idle:
+                self._idle.append(conn)
+                return
+        conn.close()
+
+    def close_all(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.close()
+
+    def _connect(self):
+        self.backend.migrate()
+        return open_connection(self.backend.db_path)
+
+def open_connection(db_path):
+    """Opens a new connection with the standard pragmas applied."""
+    busy_timeout_ms = sqlite_setting("SQLITE_BUSY_TIMEOUT_MS", 5000)
+    conn = sqlite3.connect(db_path,
+        timeout=busy_timeout_ms / 1000,
+        cached_statements=SQLITE_STATEMENT_CACHE,
+        check_same_thread=False)
+    conn.execute(f"PRAGMA busy_timeout = {busy_timeout_ms}")
+    conn.execute("PRAGMA journal_mode = WAL")
+    conn.execute("PRAGMA synchronous = NORMAL")
+    cache_size_kb = sqlite_setting("SQLITE_CACHE_SIZE_KB", 16384)
+    conn.execute(f"PRAGMA cache_size = -{cache_size_kb}")
+    mmap_size = sqlite_setting("SQLITE_MMAP_SIZE", 64 * 1024 * 1024)
+    conn.execute(f"PRAGMA mmap_size = {mmap_size}")
+    return conn
+
+class DBAccess():
+    """Borrows a pooled connection for the duration of a `with` block.
+
+    The transaction is committed on a clean exit and rolled back if the
+    block raised, then the connection goes back to the pool.
+    """
+    def __init__(self, pool):
+        self.pool = pool
+        self.conn = pool.acquire()
+        self.cursor = self.conn.cursor()
+        self.attached = []
+
+    def attach(self, path, name):
+        """Attaches another database file until the block ends.
+
+        Must come before any write in the block: SQLite can't attach
+        inside a transaction.
+        """
+        self.cursor.execute(f"ATTACH DATABASE ? AS {name}", (str(path),))
+        self.attached.append(name)
+
+    def close(self, commit=True):
+        try:
+            if commit:
+                self.conn.commit()
+            else:
+                self.conn.rollback()
+            self.cursor.close()
+            for name in self.attached:
+                self.conn.execute(f"DETACH DATABASE {name}")
+        except sqlite3.Error:
+            # Don't return a connection in an unknown state to the pool
+            self.conn.close()
+            raise
+        self.pool.release(self.conn)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close(commit=type is None)
+
+# --- Schema Migrations ---
+#
+# Each step upgrades the schema by one version; the current version is kept
+# in `PRAGMA user_version`. Steps run once, in order, under an exclusive
+# lock, so they must never be edited once released - add a new step instead.
+# Steps 1 and 2 bring databases created by older releases (which patched
+# the schema with ALTER TABLE on every connection) up to a common baseline.
+
+def table_columns(cursor, table):
+    return [row[1] for row in cursor.execute(f"PRAGMA table_info({table})")]
+
+def migration_1_results(cursor):
+    cursor.execute(
+        "CREATE TABLE IF NOT EXISTS results (id text, score integer, " \
+        "age integer, submit_time integer, payment_id text, " \
+        "user_name text, result_tier integer, email text, " \
+        "test_duration integer, correct_answers integer, " \
+        "campaign_slug text)")
+    columns = table_columns(cursor, "results")
+    for name, col_type in (("email", "text"), ("test_duration", "integer"),
+            ("correct_answers", "integer"), ("campaign_slug", "text")):
+        if name not in columns:
+            cursor.execute(f"ALTER TABLE results ADD COLUMN {name} {col_type}")
+
+def migration_2_campaigns(cursor):
+    cursor.execute(
+        "CREATE TABLE IF NOT EXISTS campaigns (slug text PRIMARY KEY, " \
+        "name text UNIQUE, enabled integer DEFAULT 1)")
+    if "enabled" not in table_columns(cursor, "campaigns"):
+        cursor.execute("ALTER TABLE campaigns ADD COLUMN enabled integer DEFAULT 1")
+    # Legacy DBs may lack the unique constraint on name
+    cursor.execute(
+        "CREATE UNIQUE INDEX IF NOT EXISTS idx_campaign_name_unique ON campaigns(name)")
+
+def migration_3_results_keys(cursor):
+    # SQLite can't add a primary key in place: rebuild the table, keeping
+    # the column order intact. The old table had no key, so an id may
+    # appear twice: the first row keeps it, the others get new ids.
+    duplicates = cursor.execute(
+        "SELECT rowid, id, user_name FROM results WHERE rowid NOT IN " \
+        "(SELECT min(rowid) FROM results GROUP BY id) ORDER BY rowid").fetchall()
+    for rowid, old_id, user_name in duplicates:
+        while True:
+            new_id = str(random.randint(10 ** 11, 10 ** 12 - 1))
+            if not cursor.execute(
+                    "SELECT 1 FROM results WHERE id = ?", (new_id,)).fetchone():
+                break
+        cursor.execute("UPDATE results SET id = ? WHERE rowid = ?", (new_id, rowid))
+        print(f"Migration 3: duplicate result id {old_id} ({user_name}) " \
+            f"renumbered to {new_id}")
+    cursor.execute(f"CREATE TABLE results_new ({RESULT_COLUMNS_DDL})")
+    cursor.execute(
+        "INSERT INTO results_new SELECT id, score, age, " \
+        "submit_time, payment_id, user_name, result_tier, email, " \
+        "test_duration, correct_answers, campaign_slug " \
+        "FROM results ORDER BY rowid")
+    cursor.execute("DROP TABLE results")
+    cursor.execute("ALTER TABLE results_new RENAME TO results")
+    cursor.execute("CREATE INDEX idx_results_email ON results(email)")
+    cursor.execute(
+        "CREATE INDEX idx_results_campaign_time " \
+        "ON results(campaign_slug, submit_time, id)")
+    cursor.execute(
+        "CREATE INDEX idx_results_submit_time ON results(submit_time, id)")
+
+def migration_4_ingest_state(cursor):
+    cursor.execute(
+        "CREATE TABLE ingest_state (name text PRIMARY KEY, value integer)")
+
+def migration_5_data_versions(cursor):
+    # Counters bumped on every change to a table, for cross-process caches
+    cursor.execute(
+        "CREATE TABLE data_versions (name text PRIMARY KEY, value integer)")
+    cursor.execute("INSERT INTO data_versions VALUES ('campaigns', 0)")
+
+def migration_6_email_norm(cursor):
+    # Normalized email for case-insensitive lookups (see /check_email).
+    # Not unique: a candidate may take the test more than once.
+    cursor.execute("ALTER TABLE results ADD COLUMN email_norm text")
+    cursor.connection.create_function(
+        "normalize_email", 1, normalize_email, deterministic=True)
+    cursor.execute("UPDATE results SET email_norm = normalize_email(email)")
+    cursor.execute("DROP INDEX idx_results_email")
+    cursor.execute("CREATE INDEX idx_results_email_norm ON results(email_norm)")
+    cursor.execute("INSERT INTO data_versions VALUES ('results_deletes', 0)")
+
+def migration_7_campaign_stats(cursor):
+    cursor.execute(
+        "CREATE TABLE campaign_stats (campaign_slug text PRIMARY KEY, " \
+        "count integer, score_count integer, score_sum integer, " \
+        "score_sq_sum integer, min_score integer, max_score integer, " \
+        "duration_count integer, duration_sum integer, " \
+        "first_submit integer, last_submit integer)")
+    cursor.execute(
+        "CREATE TABLE campaign_score_buckets (campaign_slug text, " \
+        "bucket integer, count integer, PRIMARY KEY (campaign_slug, bucket))")
+    rebuild_campaign_stats(cursor)
+
+def migration_8_archives(cursor):
+    cursor.execute(
+        "CREATE TABLE archived_results (id text PRIMARY KEY, partition text, " \
+        "email_norm text, campaign_slug text, submit_time integer, score integer)")
+    cursor.execute(
+        "CREATE INDEX idx_archived_results_email_norm ON archived_results(email_norm)")
+    cursor.execute(
+        "CREATE INDEX idx_archived_results_campaign_time " \
+        "ON archived_results(campaign_slug, submit_time)")
+    cursor.execute("CREATE TABLE archive_partitions (partition text PRIMARY KEY)")
+
+def migration_9_campaign_templates(cursor):
+    # Name of a template in cert_assets/manifest.json, NULL for the default
+    cursor.execute("ALTER TABLE campaigns ADD COLUMN cert_template text")
+
+def migration_10_database_id(cursor):
+    # Random, so that caches tell this database from others at the same path
+    cursor.execute("INSERT INTO data_versions VALUES ('database_id', ?)",
+        (random.getrandbits(62),))
+
+MIGRATIONS = [
+    migration_1_results,
+    migration_2_campaigns,
+    migration_3_results_keys,
+    migration_4_ingest_state,
+    migration_5_data_versions,
+    migration_6_email_norm,
+    migration_7_campaign_stats,
+    migration_8_archives,
+    migration_9_campaign_templates,
+    migration_10_database_id,
+]
@@ -0,0 +1,118 @@
+"""Static copies of tier-3 result pages and certificates.
+
+With STATIC_OUTPUT_DIR set, the page of every tier-3 result and its full
+certificate are written there under their URL paths,
+
+	result/tier-3/<id>/index.html
+	cert/<id>
+
+so the reverse proxy can serve them without reaching Python (see the
+README for the nginx configuration). New results are published once the
+pre-renderer has rendered their certificate; `manage.py publish-static`
+publishes existing ones and removes files of results that are gone.
+"""
+import os, shutil, threading
+from pathlib import Path
+import certs, storage, tester
+
+class StaticSite():
+	def __init__(self, directory=None, site_url=None):
+		self._directory = directory
+		self._site_url = site_url
+
+	def enabled(self):
+		return self.directory() is not None
+
+	def directory(self):
+		directory = self._directory or os.getenv("STATIC_OUTPUT_DIR")
+		return Path(directory) if directory else None
+
+	def site_url(self):
+		# Pages carry absolute og:url / og:image links, and there is no
+		# request to take the domain from
+		site_url = self._site_url or os.getenv("STATIC_SITE_URL")
+		if not site_url or not site_url.startswith(("http://", "https://")):
+			raise ValueError("STATIC_OUTPUT_DIR needs STATIC_SITE_URL, " \
+				"the site's public origin, e.g. https://example.com")
+		return site_url.rstrip("/")
+
+	def page_path(self, result_id):
+		return self.directory() / "result" / "tier-3" / result_id / "index.html"
+
+	def cert_path(self, result_id):
+		return self.directory() / "cert" / result_id
+
+	def publish(self, result):
+		"""Writes the certificate, then the page, each replaced atomically.
+
+		Raises certs.RenderBusy if the certificate had to be rendered and
+		the render pool is full.
+		"""
+		if result["result_tier"] != 3 or not result["id"].isalnum():
+			return
+		cert, _ = certs.pool.fetch(result, "full", "jpeg", background=True)
+		self._link(cert, self.cert_path(result["id"]))
+		_, page = tester.get_result_page(result, self.site_url())
+		self._write(self.page_path(result["id"]), page.encode("utf-8"))
+
+	def publish_new(self, result):
+		"""Publishes a result whose certificate the pre-renderer just rendered.
+
+		The result may have been deleted while its certificate rendered,
+		after the delete removed the files: remove what was just written
+		if its job was discarded and the result is gone.
+		"""
+		self.publish(result)
+		if not certs.prerenderer.is_pending(result["id"]) and \
+				not storage.get_result(result["id"]):
+			self.remove(result["id"])
+
+	def remove(self, result_id):
+		if not self.enabled() or not result_id.isalnum():
+			return
+		try:
+			self.cert_path(result_id).unlink()
+		except FileNotFoundError:
+			pass
+		shutil.rmtree(self.page_path(result_id).parent, ignore_errors=True)
+
+	def published_ids(self):
+		try:
+			return [name for name in os.listdir(self.directory() / "cert")
+				if name.isalnum()]
+		except FileNotFoundError:
+			return []
+
+	def _tmp_path(self, path):
+		path.parent.mkdir(parents=True, exist_ok=True)
+		return path.with_name(f".{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+
+	def _write(self, path, data):
+		try:
+			if path.read_bytes() == data:
+				return
+		except FileNotFoundError:
+			pass
+		tmp_path = self._tmp_path(path)
+		tmp_path.write_bytes(data)
+		os.replace(tmp_path, path)
+
+	def _link(self, source, path):
+		# Cached files are never written in place, so a hard link is a
+		# stable copy; fall back to copying across file systems
+		try:
+			if os.path.samefile(source, path):
+				return
+		except FileNotFoundError:
+			pass
+		tmp_path = self._tmp_path(path)
+		try:
+			os.link(source, tmp_path)
+		except FileExistsError:
+			os.unlink(tmp_path)
+			os.link(source, tmp_path)
+		except OSError:
+			shutil.copyfile(source, tmp_path)
+		os.replace(tmp_path, path)
+
+site = StaticSite()
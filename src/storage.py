@@ -1,76 +1,242 @@
-import sqlite3
-from pathlib import Path
+"""Storage facade used by the rest of the app.
 
-db_path = Path(__file__).parent / "tester.db"
+The module-level functions below delegate to the active backend, chosen
+by the STORAGE_BACKEND environment variable:
 
-# --- Campaign Management Functions (New) ---
+- "sqlite" (default): the SQLite database file, see sqlite_storage.py
+- "memory": process-local dicts, see memory_storage.py. Nothing is
+  persisted or shared between workers; meant for load tests and
+  benchmarks of the HTTP and certificate layers without disk I/O.
 
-def create_campaign(slug, name):
-    """Creates a new campaign link/tag. Returns True if created, False if duplicate name."""
-    with DBAccess() as db:
-        try:
-            db.cursor.execute(
-                "INSERT INTO campaigns VALUES (?, ?, 1)", (slug, name)
-            )
-            return True
-        except sqlite3.IntegrityError:
-            return False
+New backends subclass StorageBackend and are registered in BACKENDS.
+"""
+import math, os, threading, time
+from shared_cache import SharedCache
 
-def get_campaigns():
-    """Fetches all campaigns."""
-    with DBAccess() as db:
-        dbres = db.cursor.execute(
-            "SELECT slug, name, enabled FROM campaigns ORDER BY name ASC")
-        rows = dbres.fetchall()
-        return [{"slug": row[0], "name": row[1], "enabled": bool(row[2])} for row in rows]
+UNTAGGED_NAME = "Direct/Untagged"
 
-def get_campaign_by_slug(slug):
-    """Fetches a single campaign by its slug."""
-    with DBAccess() as db:
-        dbres = db.cursor.execute(
-            "SELECT slug, name, enabled FROM campaigns WHERE slug = ?", (slug,)
-        )
-        row = dbres.fetchone()
-        if row:
-            return {"slug": row[0], "name": row[1], "enabled": bool(row[2])}
-        return None
+BACKENDS = {
+    "sqlite": ("sqlite_storage", "SQLiteBackend"),
+    "memory": ("memory_storage", "MemoryBackend"),
+}
 
-def delete_campaign(slug):
-    """Deletes a campaign by its slug."""
-    with DBAccess() as db:
-        db.cursor.execute("DELETE FROM campaigns WHERE slug = ?", (slug,))
+_backend = None
+_backend_lock = threading.Lock()
 
-# Set campaign enabled/disabled
-def set_campaign_enabled(slug, enabled):
-    """Set the enabled status of a campaign by slug."""
-    with DBAccess() as db:
-        db.cursor.execute("UPDATE campaigns SET enabled = ? WHERE slug = ?", (int(enabled), slug))
+def get_backend():
+    """Returns the active backend, creating it on first use.
 
+    Created lazily since server.py loads the .env file only after
+    importing this module.
+    """
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                name = os.getenv("STORAGE_BACKEND", "sqlite")
+                if name not in BACKENDS:
+                    raise ValueError(f"Unknown STORAGE_BACKEND: {name!r}")
+                module_name, class_name = BACKENDS[name]
+                module = __import__(module_name)
+                _backend = getattr(module, class_name)()
+    return _backend
 
-# --- Existing Result Functions (Modified) ---
+def set_backend(backend):
+    """Replaces the active backend, e.g. with a temporary database."""
+    global _backend
+    _backend = backend
 
-def cert_id_exists(cert_id):
-    with DBAccess() as db:
-        dbres = db.cursor.execute(
-            "SELECT 1 FROM results WHERE id = ?", (cert_id,))
-        search = dbres.fetchone()
-        return bool(search)
+class StorageBackend():
+    """Interface implemented by every storage backend.
 
-def email_exists(email):
-    with DBAccess() as db:
-        dbres = db.cursor.execute(
-            "SELECT 1 FROM results WHERE email = ?", (email,))
-        search = dbres.fetchone()
-        return bool(search)
+    Results are exchanged as dicts (see result_row_to_dict) and written as
+    11-tuples in the results column order; campaigns are dicts with
+    "slug", "name", "enabled" and "cert_template" (None for the default
+    certificate template).
+    """
+    # Whether all workers see the same data, so that they may share
+    # cached rows (see start_shared_cache)
+    shared = True
 
+    def migrate(self):
+        """Prepares the backend's schema; called once at startup."""
 
-def get_result(result_id):
-    with DBAccess() as db:
-        dbres = db.cursor.execute(
-            "SELECT * FROM results WHERE id = ?", (result_id,))
-        row = dbres.fetchone()
-        if row:
-            return result_row_to_dict(row)
+    def close(self):
+        """Releases connections or other resources held by the backend."""
+
+    def warm_up(self):
+        """Starts preloading in-process caches; called once at startup."""
+
+    def cache_identity(self):
+        """Returns a string that changes when the data is replaced.
+
+        Only needed by shared backends: the shared cache is emptied when
+        it changes, e.g. when the database is restored from a backup.
+        """
+        raise NotImplementedError
+
+    # --- Campaigns ---
+
+    def create_campaign(self, slug, name):
+        """Creates a campaign. Returns False if the slug or name is taken."""
+        raise NotImplementedError
+
+    def get_campaigns(self):
+        """Returns all campaigns ordered by name."""
+        raise NotImplementedError
+
+    def get_campaign_by_slug(self, slug):
+        raise NotImplementedError
+
+    def delete_campaign(self, slug):
+        raise NotImplementedError
+
+    def set_campaign_enabled(self, slug, enabled):
+        raise NotImplementedError
+
+    def set_campaign_template(self, slug, template):
+        """Sets the certificate template of a campaign's results, None for the default."""
+        raise NotImplementedError
+
+    def get_campaigns_version(self):
+        """Returns a counter bumped by every campaign change, in any process."""
+        raise NotImplementedError
+
+    # --- Results ---
+
+    def cert_id_exists(self, cert_id):
+        raise NotImplementedError
+
+    def email_exists(self, email):
+        """Whether any result has this email, compared normalized."""
+        raise NotImplementedError
+
+    def get_result(self, result_id):
+        """Returns the result dict, or None if there is no such result."""
+        raise NotImplementedError
+
+    def save_result(self, result_row):
+        raise NotImplementedError
+
+    def insert_result(self, result_row, new_id):
+        """Inserts a result and returns it, in a single transaction.
+
+        If the row's id is taken it is retried with an id from `new_id()`.
+        """
+        raise NotImplementedError
+
+    def get_all_results(self):
+        raise NotImplementedError
+
+    def delete_result(self, result_id):
+        raise NotImplementedError
+
+    # --- Journaled ingestion (see ingest.py) ---
+
+    def get_journal_position(self):
+        """Returns (generation, offset): how much of the journal is applied.
+
+        The generation tells which journal file the offset is in; it is 0
+        until the journal is first emptied.
+        """
+        raise NotImplementedError
+
+    def set_journal_position(self, generation, offset):
+        raise NotImplementedError
+
+    def apply_journaled_results(self, result_rows, journal_offset):
+        """Inserts a batch of journaled results in a single transaction.
+
+        The journal offset is stored in the same transaction, so a batch is
+        either fully applied and acknowledged or not at all. Inserts are
+        idempotent: a row whose id already exists with the same submission
+        is skipped as a replay. A row whose id is taken by another
+        submission is not inserted: its candidate was already sent to that
+        id, so giving the row another one would show them someone else's
+        result. Returns (inserted results as dicts, rejected rows).
+        """
+        raise NotImplementedError
+
+    # --- Listing and aggregates ---
+
+    def get_results_page(self, campaign_slug=None, page_size=50, cursor=None):
+        """Fetches one page of results, newest first.
+
+        `campaign_slug` is a campaign slug, "untagged" for results without
+        a known campaign, or None/"all" for no filtering. Pages are keyed
+        on (submit_time, id) rather than an offset, so every page costs the
+        same however deep it is. Returns the results (each with a
+        "campaign_name") and the cursor of the next page, or None on the
+        last page.
+        """
+        raise NotImplementedError
+
+    def iter_results(self, campaign_slug=None, batch_size=500, include_archived=False):
+        """Yields results like get_results_page, without paging.
+
+        Rows are read in batches, each a separate short read, so memory use
+        stays flat however many results match and a slow consumer doesn't
+        hold the database back; results added or deleted meanwhile may or
+        may not be included. With `include_archived`, archived results
+        follow the others, newest month first.
+        """
+        raise NotImplementedError
+
+    def get_result_stats(self, start_time=None, end_time=None):
+        """Summarizes results overall and per campaign.
+
+        Returns the overall summary (see summarize_rollup) with a
+        "campaigns" list holding the same summary plus "slug" and "name"
+        for each campaign that has results; results without a known
+        campaign are grouped as untagged. Without a time range this reads
+        the maintained rollups only; limited to submit_time in
+        [start_time, end_time) it aggregates the matching results in one
+        pass.
+        """
+        raise NotImplementedError
+
+    def rebuild_campaign_stats(self):
+        """Recomputes the per-campaign rollups from the results."""
+        raise NotImplementedError
+
+    # --- Bulk transfer (see manage.py export/import) ---
+
+    def export_results(self, after=None, batch_size=5000, include_archived=False):
+        """Yields all results oldest first, by (submit_time, id).
+
+        `after` is a (submit_time, id) watermark: only later results are
+        yielded, so an interrupted export can resume where it stopped.
+        Reads in keyset batches of `batch_size`, each in its own short
+        read, so the export never holds the database for long. Archived
+        results, when included, come before the hot ones.
+        """
+        raise NotImplementedError
+
+    def import_results(self, result_rows, batch_size=50000):
+        """Bulk-inserts result rows, skipping ids that already exist.
+
+        Meant for seeding and moving data between hosts rather than for
+        serving. Rows are inserted `batch_size` at a time per transaction
+        and the campaign rollups are rebuilt at the end. Returns how many
+        rows were inserted.
+        """
+        raise NotImplementedError
+
+    # --- Archival ---
+
+    def archive_results(self, before_time):
+        """Moves results submitted before `before_time` out of the hot store.
+
+        Archived results still count in the rollups and are still found by
+        get_result, delete_result, cert_id_exists and email_exists; only
+        listings skip them unless asked. Returns how many were moved.
+        """
+        raise NotImplementedError
+
+    def vacuum(self):
+        """Returns space freed by deletes or archival to the system."""
+
+# --- Shared Helpers ---
 
 def result_row_to_dict(row):
     # Updated to handle 11 columns for the new 'campaign_slug'
@@ -88,85 +254,308 @@ def result_row_to_dict(row):
         "campaign_slug": row[10] if len(row) > 10 else None # NEW COLUMN INDEX 10
     }
 
+def normalize_email(email):
+    # Emails are matched trimmed and case-insensitively
+    if email is None:
+        return None
+    return email.strip().lower()
+
+def result_dict_to_row(result):
+    # Inverse of result_row_to_dict
+    return (result["id"], result["score"], result["age"],
+        result["submit_time"], result["payment_id"], result["user_name"],
+        result["result_tier"], result.get("email"), result.get("test_duration"),
+        result.get("correct_answers"), result.get("campaign_slug"))
+
+def campaign_row_to_dict(row):
+    return {"slug": row[0], "name": row[1], "enabled": bool(row[2]),
+        "cert_template": row[3] if len(row) > 3 else None}
+
+def encode_page_cursor(result):
+    return f"{result['submit_time']}:{result['id']}"
+
+def decode_page_cursor(cursor):
+    submit_time, result_id = cursor.split(":", 1)
+    return int(submit_time), result_id
+
+# --- Result Rollups ---
+#
+# A rollup holds the running sums a summary is computed from. Backends keep
+# one per campaign slug, updated in the same transaction as every insert
+# and delete of a result, so summaries never need to scan the results.
+
+SCORE_BUCKET_WIDTH = 10
+
+def score_bucket(score):
+    return score // SCORE_BUCKET_WIDTH * SCORE_BUCKET_WIDTH
+
+def new_rollup():
+    return {
+        "count": 0,
+        "score_count": 0,
+        "score_sum": 0,
+        "score_sq_sum": 0,
+        "min_score": None,
+        "max_score": None,
+        "duration_count": 0,
+        "duration_sum": 0,
+        "first_submit": None,
+        "last_submit": None,
+        "histogram": {},
+    }
+
+def add_to_rollup(rollup, row):
+    # Results without a score or duration (NULL or 0) are left out of the
+    # averages, as the dashboard always did
+    score, submit_time, duration = row[1], row[3], row[8]
+    rollup["count"] += 1
+    if score:
+        rollup["score_count"] += 1
+        rollup["score_sum"] += score
+        rollup["score_sq_sum"] += score * score
+        bucket = score_bucket(score)
+        rollup["histogram"][bucket] = rollup["histogram"].get(bucket, 0) + 1
+    if duration:
+        rollup["duration_count"] += 1
+        rollup["duration_sum"] += duration
+    merge_extremes(rollup, score or None, score or None, submit_time, submit_time)
+
+def merge_rollups(rollup, other):
+    for key in ("count", "score_count", "score_sum", "score_sq_sum",
+            "duration_count", "duration_sum"):
+        rollup[key] += other[key]
+    for bucket, count in other["histogram"].items():
+        rollup["histogram"][bucket] = rollup["histogram"].get(bucket, 0) + count
+    merge_extremes(rollup, other["min_score"], other["max_score"],
+        other["first_submit"], other["last_submit"])
+
+def merge_extremes(rollup, min_score, max_score, first_submit, last_submit):
+    for key, value, pick in (("min_score", min_score, min),
+            ("max_score", max_score, max), ("first_submit", first_submit, min),
+            ("last_submit", last_submit, max)):
+        if value is not None:
+            current = rollup[key]
+            rollup[key] = value if current is None else pick(current, value)
+
+def summarize_rollup(rollup):
+    score_count = rollup["score_count"]
+    avg_score = stddev_score = None
+    if score_count:
+        avg_score = rollup["score_sum"] / score_count
+        variance = rollup["score_sq_sum"] / score_count - avg_score ** 2
+        stddev_score = math.sqrt(max(variance, 0))
+    duration_count = rollup["duration_count"]
+    return {
+        "count": rollup["count"],
+        "scored_count": score_count,
+        "avg_score": avg_score,
+        "stddev_score": stddev_score,
+        "min_score": rollup["min_score"],
+        "max_score": rollup["max_score"],
+        "avg_duration": rollup["duration_sum"] / duration_count if duration_count else None,
+        "first_submit": rollup["first_submit"],
+        "last_submit": rollup["last_submit"],
+        "histogram": sorted(rollup["histogram"].items()),
+    }
+
+def stats_from_rollups(rollups, campaign_names):
+    """Builds get_result_stats output from per-slug rollups.
+
+    `rollups` maps the campaign_slug of results (None for untagged) to its
+    rollup and `campaign_names` maps existing campaign slugs to names;
+    rollups of slugs that aren't a campaign (anymore) count as untagged.
+    Costs O(number of campaigns), whatever the number of results.
+    """
+    groups = {}
+    for slug, rollup in rollups.items():
+        if slug not in campaign_names:
+            slug = None
+        if slug not in groups:
+            groups[slug] = new_rollup()
+        merge_rollups(groups[slug], rollup)
+    total = new_rollup()
+    campaigns = []
+    # Untagged first, then by campaign name
+    for slug in sorted(groups, key=lambda s: (s is not None, campaign_names.get(s, ""))):
+        merge_rollups(total, groups[slug])
+        campaign = summarize_rollup(groups[slug])
+        campaign["slug"] = slug or "untagged"
+        campaign["name"] = campaign_names[slug] if slug else UNTAGGED_NAME
+        campaigns.append(campaign)
+    stats = summarize_rollup(total)
+    stats["campaigns"] = campaigns
+    return stats
+
+# --- Campaign Cache ---
+
+class CampaignCache():
+    """In-process cache of campaign lookups by slug, including misses.
+
+    Campaign links are hit by every candidate while campaigns change rarely,
+    so lookups are answered from memory. Changes made through this process
+    clear the cache at once; changes made by other workers are picked up by
+    re-reading the backend's campaigns version at most every `ttl` seconds,
+    so in the steady state a lookup costs no database access at all.
+    Lookups that miss go to the shared cache before the backend.
+    """
+    def __init__(self, ttl=None, max_entries=10000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._version = None
+        self._checked_at = 0
+
+    def get(self, slug):
+        self._revalidate()
+        try:
+            return self._entries[slug]
+        except KeyError:
+            pass
+        campaign = shared_cache.get_or_load(f"campaign:{slug}",
+            lambda: get_backend().get_campaign_by_slug(slug))
+        with self._lock:
+            if len(self._entries) >= self.max_entries:
+                # Unknown slugs are cached too, so keep junk URLs bounded
+                self._entries.clear()
+            self._entries[slug] = campaign
+        return campaign
+
+    def invalidate(self):
+        with self._lock:
+            self._entries.clear()
+            self._checked_at = 0
+
+    def _revalidate(self):
+        ttl = self.ttl
+        if ttl is None:
+            ttl = float(os.getenv("CAMPAIGN_CACHE_TTL", "10"))
+        now = time.monotonic()
+        if now - self._checked_at < ttl:
+            return
+        version = get_backend().get_campaigns_version()
+        with self._lock:
+            if version != self._version:
+                self._entries.clear()
+                self._version = version
+            self._checked_at = now
+
+shared_cache = SharedCache()
+campaign_cache = CampaignCache()
+
+def start_shared_cache():
+    """Shares result and campaign lookups between the workers of this host."""
+    backend = get_backend()
+    if backend.shared:
+        shared_cache.start(backend.cache_identity())
+
+def shared_cache_stats():
+    return shared_cache.stats()
+
+# --- Campaign Management Functions (New) ---
+
+def create_campaign(slug, name):
+    """Creates a new campaign link/tag. Returns True if created, False if duplicate name."""
+    created = get_backend().create_campaign(slug, name)
+    campaign_cache.invalidate()
+    return created
+
+def get_campaigns():
+    """Fetches all campaigns."""
+    return get_backend().get_campaigns()
+
+def get_campaign_by_slug(slug):
+    """Fetches a single campaign by its slug, through the campaign cache."""
+    return campaign_cache.get(slug)
+
+def delete_campaign(slug):
+    """Deletes a campaign by its slug."""
+    get_backend().delete_campaign(slug)
+    shared_cache.invalidate(f"campaign:{slug}")
+    campaign_cache.invalidate()
+
+# Set campaign enabled/disabled
+def set_campaign_enabled(slug, enabled):
+    """Set the enabled status of a campaign by slug."""
+    get_backend().set_campaign_enabled(slug, enabled)
+    shared_cache.invalidate(f"campaign:{slug}")
+    campaign_cache.invalidate()
+
+def set_campaign_template(slug, template):
+    """Sets the certificate template of a campaign, None for the default."""
+    get_backend().set_campaign_template(slug, template)
+    shared_cache.invalidate(f"campaign:{slug}")
+    campaign_cache.invalidate()
+
+# --- Result Functions ---
+
+def cert_id_exists(cert_id):
+    return get_backend().cert_id_exists(cert_id)
+
+def email_exists(email):
+    return get_backend().email_exists(email)
+
+def get_result(result_id):
+    # Results never change once written, they can only be deleted
+    return shared_cache.get_or_load(f"result:{result_id}",
+        lambda: get_backend().get_result(result_id))
+
 def save_result(result_row):
-    # Updated SQL statement for 11 columns
-    with DBAccess() as db:
-        db.cursor.execute(
-            "INSERT INTO results VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", result_row) # 11 question marks
+    get_backend().save_result(result_row)
+
+def insert_result(result_row, new_id):
+    return get_backend().insert_result(result_row, new_id)
 
 def get_all_results():
-    with DBAccess() as db:
-        dbres = db.cursor.execute(
-            "SELECT * FROM results ORDER BY submit_time DESC")
-        rows = dbres.fetchall()
-        return [result_row_to_dict(row) for row in rows]
+    return get_backend().get_all_results()
 
 def delete_result(result_id):
-    with DBAccess() as db:
-        db.cursor.execute("DELETE FROM results WHERE id = ?", (result_id,))
-
-class DBAccess():
-    def __init__(self):
-        init_needed = not db_path.exists()
-        
-        self.conn = sqlite3.connect(db_path)
-        self.cursor = self.conn.cursor()
-        
-        if init_needed:
-            # Create results table with new campaign_slug column
-            self.cursor.execute(
-                "CREATE TABLE results (id text, score integer, " \
-                "age integer, submit_time integer, payment_id text, " \
-                "user_name text, result_tier integer, email text, " \
-                "test_duration integer, correct_answers integer, " \
-                "campaign_slug text)") # New column
-            
-            # Create the campaigns table
-            self.cursor.execute(
-                "CREATE TABLE campaigns (slug text PRIMARY KEY, name text UNIQUE, enabled integer DEFAULT 1)")
-        else:
-            # Migration: add new columns if they don't exist in results
-            try:
-                self.cursor.execute("ALTER TABLE results ADD COLUMN email text")
-            except:
-                pass
-            try:
-                self.cursor.execute("ALTER TABLE results ADD COLUMN test_duration integer")
-            except:
-                pass
-            try:
-                self.cursor.execute("ALTER TABLE results ADD COLUMN correct_answers integer")
-            except:
-                pass
-            
-            # NEW MIGRATION: add campaign_slug column to results
-            try:
-                self.cursor.execute("ALTER TABLE results ADD COLUMN campaign_slug text")
-            except:
-                pass
-            
-            # NEW MIGRATION: create campaigns table if it doesn't exist, and add unique constraint to name
-            try:
-                self.cursor.execute("CREATE TABLE campaigns (slug text PRIMARY KEY, name text UNIQUE, enabled integer DEFAULT 1)")
-            except:
-                pass
-            # Migration: add enabled column if missing
-            try:
-                self.cursor.execute("ALTER TABLE campaigns ADD COLUMN enabled integer DEFAULT 1")
-            except:
-                pass
-            # Try to add unique constraint to name if missing (for legacy DBs)
-            try:
-                self.cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_campaign_name_unique ON campaigns(name)")
-            except:
-                pass
-    
-    def close(self):
-        self.conn.commit()
-        self.conn.close()
-    
-    def __enter__(self):
-        return self
-    
-    def __exit__(self, type, value, traceback):
-        self.close()
\ No newline at end of file
+    get_backend().delete_result(result_id)
+    shared_cache.invalidate(f"result:{result_id}")
+
+# --- Journaled Ingestion ---
+
+def get_journal_position():
+    return get_backend().get_journal_position()
+
+def set_journal_position(generation, offset):
+    get_backend().set_journal_position(generation, offset)
+
+def apply_journaled_results(result_rows, journal_offset):
+    return get_backend().apply_journaled_results(result_rows, journal_offset)
+
+# --- Listing and Aggregates ---
+
+def get_results_page(campaign_slug=None, page_size=50, cursor=None):
+    return get_backend().get_results_page(campaign_slug, page_size, cursor)
+
+def iter_results(campaign_slug=None, batch_size=500, include_archived=False):
+    return get_backend().iter_results(campaign_slug, batch_size, include_archived)
+
+def get_result_stats(start_time=None, end_time=None):
+    return get_backend().get_result_stats(start_time, end_time)
+
+def rebuild_campaign_stats():
+    get_backend().rebuild_campaign_stats()
+
+# --- Bulk Transfer ---
+
+def export_results(after=None, batch_size=5000, include_archived=False):
+    return get_backend().export_results(after, batch_size, include_archived)
+
+def import_results(result_rows, batch_size=50000):
+    return get_backend().import_results(result_rows, batch_size)
+
+# --- Archival ---
+
+def archive_results(before_time):
+    return get_backend().archive_results(before_time)
+
+def vacuum():
+    get_backend().vacuum()
+
+def migrate():
+    get_backend().migrate()
+
+def warm_up():
+    get_backend().warm_up()
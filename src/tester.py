@@ -1,6 +1,5 @@
-import time, os, random, storage, io, datetime
+import collections, hashlib, time, os, random, re, threading, storage, certs
 from pathlib import Path
-from PIL import Image, ImageDraw, ImageFont
 from util import sanitize_html
 
 base_dir = Path(__file__).parent
@@ -42,7 +41,14 @@ def get_iq_score(answers, age):
 	return score
 
 def create_result(tester_data):
-    result_id = get_new_cert_id()
+    # One transaction: the primary key catches the (rare) id collision
+    result_row = build_result_row(tester_data, new_cert_id())
+    result = storage.insert_result(result_row, new_cert_id)
+    # Render the certificate before anyone opens the result page
+    certs.prerenderer.enqueue(result)
+    return result
+
+def build_result_row(tester_data, result_id):
     age = tester_data["age"]
     answers = tester_data["answers"]
     score = get_iq_score(answers, age)
@@ -58,31 +64,147 @@ def create_result(tester_data):
     campaign_slug = tester_data.get("campaign_slug") 
     
     # MODIFICATION 2: result_row now has 11 elements
-    result_row = (result_id, score, age, submit_time,
+    return (result_id, score, age, submit_time,
         None, user_name, result_tier, email, test_duration, correct_answers,
         campaign_slug) # <-- 11th element added
-        
-    storage.save_result(result_row)
-    
-    return storage.get_result(result_id)
 
 
-def get_new_cert_id():
-	while True:
-		digits = 12
-		cert_id = str(random.randint(10 ** (digits - 1), 10 ** digits - 1))
-		if not storage.cert_id_exists(cert_id):
-			return cert_id
+def new_cert_id():
+	digits = 12
+	return str(random.randint(10 ** (digits - 1), 10 ** digits - 1))
 
 
 
-def get_result_page(result_id, domain):
-	result_tpl_path = base_dir / "result_template.html"
-	
-	result = storage.get_result(result_id)
-	if not result:
-		return (404, "Result not found")
-	
+class PageTemplate():
+	"""An HTML file with %name% placeholders, compiled once.
+
+	The file is split into literal text and placeholder slots; render()
+	fills the slots and joins the pieces. The file is stat'ed on each
+	render and recompiled only when its mtime changes.
+	"""
+	PLACEHOLDER = re.compile(r"%(\w+)%")
+
+	def __init__(self, path):
+		self.path = Path(path)
+		self.loads = 0
+		# (mtime, parts, slots), replaced as a whole: threads reading it
+		# while another recompiles never mix two versions of the file
+		self._compiled = (None, [], [])
+		self._lock = threading.Lock()
+
+	def compile(self, text):
+		"""Returns the literal parts and (index, name) placeholder slots."""
+		# re.split with a group puts the placeholder names at odd indices
+		parts = self.PLACEHOLDER.split(text)
+		return parts, [(i, parts[i]) for i in range(1, len(parts), 2)]
+
+	def _load(self):
+		mtime = os.stat(self.path).st_mtime_ns
+		compiled = self._compiled
+		if mtime != compiled[0]:
+			with self._lock:
+				compiled = self._compiled
+				if mtime != compiled[0]:
+					parts, slots = self.compile(self.path.read_text(encoding="utf-8"))
+					compiled = self._compiled = (mtime, parts, slots)
+					self.loads += 1
+		return compiled
+
+	def version(self):
+		"""Changes whenever the file does."""
+		return self._load()[0]
+
+	def render(self, **values):
+		_, parts, slots = self._load()
+		parts = parts.copy()
+		for i, name in slots:
+			# Unknown placeholders are left as they are
+			parts[i] = values.get(name, f"%{name}%")
+		return "".join(parts)
+
+result_template = PageTemplate(base_dir / "result_template.html")
+sharethis_html = None
+
+def sharethis_addin():
+	# Read once, after the server has loaded .env
+	global sharethis_html
+	if sharethis_html is None:
+		sharethis_html = os.getenv("SHARETHIS_ADDIN") or ""
+	return sharethis_html
+
+def result_expired(result):
+	if result["result_tier"] != 1:
+		return False
+	result_duration_hours = int(os.getenv("TEMP_LINK_LIFETIME_HOURS"))
+	result_duration = result_duration_hours * 60 * 60
+	now = int(time.time())
+	return result["submit_time"] + result_duration < now
+
+def result_page_etag(result, domain):
+	"""Changes with anything get_result_page(result, domain) depends on."""
+	parts = [repr(tuple(result.values())), domain, str(result_expired(result)),
+		str(result_template.version()), sharethis_addin()]
+	if result["result_tier"] == 3:
+		parts.append(certs.renderer.version(certs.template_of(result)))
+	digest = hashlib.blake2b("\0".join(parts).encode(), digest_size=12).hexdigest()
+	return f'"{digest}"'
+
+class ResultPageCache():
+	"""Rendered result pages, by result id then (tier, domain).
+
+	An entry is served only while its ETag matches the one computed from
+	the current row, so a result changed or deleted through another worker
+	is never served stale; invalidate() frees the entries of a result
+	deleted through this one. The domain comes from the Host header, so a
+	result keeps only its `variants` most recent (tier, domain) pages, and
+	the least recently viewed results are dropped once more than
+	RESULT_PAGE_CACHE_SIZE pages (default 5000) are cached.
+	"""
+	def __init__(self, max_entries=None, variants=2):
+		self._max_entries = max_entries
+		self.variants = variants
+		self._lock = threading.Lock()
+		self._entries = collections.OrderedDict()
+		self._pages = 0
+
+	def max_entries(self):
+		if self._max_entries is None:
+			self._max_entries = int(os.getenv("RESULT_PAGE_CACHE_SIZE", "5000"))
+		return self._max_entries
+
+	def get(self, result, domain, etag):
+		"""Returns (status, body) of the result page, rendering it on a miss."""
+		key = (result["result_tier"], domain)
+		with self._lock:
+			pages = self._entries.get(result["id"])
+			if pages is not None:
+				self._entries.move_to_end(result["id"])
+				cached = pages.get(key)
+				if cached and cached[0] == etag:
+					return (200, cached[1])
+		status, body = get_result_page(result, domain)
+		if status == 200:
+			with self._lock:
+				pages = self._entries.setdefault(result["id"], {})
+				self._entries.move_to_end(result["id"])
+				if key in pages:
+					del pages[key]
+				elif len(pages) >= self.variants:
+					del pages[next(iter(pages))]
+				else:
+					self._pages += 1
+				pages[key] = (etag, body)
+				while self._pages > self.max_entries() and len(self._entries) > 1:
+					self._pages -= len(self._entries.popitem(last=False)[1])
+		return (status, body)
+
+	def invalidate(self, result_id):
+		with self._lock:
+			self._pages -= len(self._entries.pop(result_id, {}))
+
+result_pages = ResultPageCache()
+
+def get_result_page(result, domain):
 	user_name = sanitize_html(result["user_name"])
 	title = f"{user_name}'s IQ Test Result"
 	og_meta_html = f"""
@@ -93,26 +215,18 @@ def get_result_page(result_id, domain):
 		<meta property="og:site_name" content="Raven's IQ Test" />
 	"""
 	
-	if result["result_tier"] == 1:
-		result_duration_hours = int(os.getenv("TEMP_LINK_LIFETIME_HOURS"))
-		result_duration = result_duration_hours * 60 * 60
-		now = int(time.time())
-		expired = result["submit_time"] + result_duration < now
-		if expired:
-			main_html = f"""
-				<div class="result expired">
-					<div class="desc">Result expired</div>
-					<button onclick="document.location='/';" class='main-page'>Main page</button>
-				</div>
-			"""
-			
-			page_html = result_tpl_path.read_text().replace(
-				"%title%", "Result expired").replace(
-				"%sharethis%", "").replace(
-				"%og_meta%", "").replace(
-				"%main%", main_html)
-			return (200, page_html)
+	if result_expired(result):
+		main_html = f"""
+			<div class="result expired">
+				<div class="desc">Result expired</div>
+				<button onclick="document.location='/';" class='main-page'>Main page</button>
+			</div>
+		"""
 		
+		page_html = result_template.render(title="Result expired",
+			sharethis="", og_meta="", main=main_html)
+		return (200, page_html)
+	
 	if result["result_tier"] in (1, 2):
 		main_html = f"""
 			<div class="result plain">
@@ -122,67 +236,34 @@ def get_result_page(result_id, domain):
 			</div>
 		"""
 	else:
-		img_url = f"../../cert/{result['id']}"
+		# The version makes the URL change with the template, since
+		# certificates are served as immutable
+		template = certs.template_of(result)
+		version = certs.renderer.version(template)
+		download_url = f"../../cert/{result['id']}?v={version}"
+		preview_url = f"../../cert/{result['id']}/preview?v={version}"
+		preview_width, preview_height = certs.renderer.size("preview", template)
 		main_html = f"""
 			<div class="result cert">
-				<a class="cert-wrapper" href="{img_url}" download="Certificate.jpg">
-					<img src="{img_url}" alt="{user_name}'s IQ certificate">
+				<a class="cert-wrapper" href="{download_url}" download="Certificate.jpg">
+					<img src="{preview_url}" width="{preview_width}" height="{preview_height}" alt="{user_name}'s IQ certificate">
 				</a>
 			</div>
 		"""
-		cert_url = f"{domain}/cert/{result['id']}"
+		cert_url = f"{domain}/cert/{result['id']}/social?v={version}"
+		social_width, social_height = certs.renderer.size("social", template)
 		og_meta_html += f"\n<meta property=\"og:image\" " \
-			f"content=\"{cert_url}\" />"
+			f"content=\"{cert_url}\" />" \
+			f"\n<meta property=\"og:image:type\" content=\"image/jpeg\" />" \
+			f"\n<meta property=\"og:image:width\" content=\"{social_width}\" />" \
+			f"\n<meta property=\"og:image:height\" content=\"{social_height}\" />"
 	
 	
-	page_html = result_tpl_path.read_text(encoding="utf-8").replace(
-		"%title%", title).replace(
-		"%sharethis%", os.getenv("SHARETHIS_ADDIN")).replace(
-		"%og_meta%", og_meta_html).replace(
-		"%main%", main_html)
+	page_html = result_template.render(title=title,
+		sharethis=sharethis_addin(), og_meta=og_meta_html, main=main_html)
 	
 	return (200, page_html)
 
 def gen_cert(cert_id, user_name, user_score, submit_time):
-	ASSETS_PATH = base_dir / "cert_assets"
-	FONTS_PATH = ASSETS_PATH / "fonts"
-	CERT_TPL_PATH = ASSETS_PATH / "cert_tpl.jpg"
-	
-	name_font = ImageFont.truetype(
-		str(FONTS_PATH / "Lato-Light.ttf"), 160)
-	serial_font = ImageFont.truetype(
-		str(FONTS_PATH / "Lato-Regular.ttf"), 55)
-	score_font = ImageFont.truetype(
-		str(FONTS_PATH / "Lato-Black.ttf"), 200)
-	date_font = ImageFont.truetype(
-		str(FONTS_PATH / "Lato-Light.ttf"), 75)
-	
-	img = Image.open(str(CERT_TPL_PATH))
-	cert_width  = img.width
-	cert_height = img.height
-	
-	draw = ImageDraw.Draw(img)
-	
-	_, _, w, h = draw.textbbox((0, 0), user_name, font=name_font)
-	draw.text(
-		((cert_width-w)/2, 740),
-		user_name, font=name_font, fill="black")
-	
-	cert_id_formatted = " ".join((cert_id[:4], cert_id[4:8], cert_id[8:]))
-	draw.text((495, 1580), cert_id_formatted, font=serial_font, fill="black")
-	
-	_, _, w, h = draw.textbbox((0, 0), str(user_score), font=score_font)
-	draw.text(
-		((cert_width-w)/2, 1150),
-		str(user_score), font=score_font, fill="black")
-	
-	date_formatted = datetime.datetime.fromtimestamp(
-		submit_time).strftime("%B %d, %Y")
-	_, _, w, h = draw.textbbox((0, 0), date_formatted, font=date_font)
-	draw.text(
-		((cert_width-w)/2, 1410),
-		date_formatted, font=date_font, fill="black")
-	
-	img_bytesio = io.BytesIO()
-	img.save(img_bytesio, "jpeg")
-	return img_bytesio.getvalue()
\ No newline at end of file
+	# Fonts and template are preloaded once per process, see certs.py
+	return certs.renderer.render(cert_id, user_name, user_score, submit_time)
\ No newline at end of file
@@ -1,7 +1,44 @@
-
+import hashlib, math
 
 def sanitize_html(text):
 	text = text.replace("&", "&amp;")
 	text = text.replace("<", "&lt;")
 	text = text.replace(">", "&gt;")
-	return text
\ No newline at end of file
+	return text
+
+class BloomFilter():
+	"""Fixed-size Bloom filter of strings.
+
+	Answers "definitely not added" or "maybe added"; sized for `capacity`
+	items at the given false positive rate. Items can't be removed.
+	"""
+	def __init__(self, capacity, error_rate=0.01):
+		capacity = max(capacity, 1)
+		self.capacity = capacity
+		self.size = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+		self.hashes = max(1, round(self.size / capacity * math.log(2)))
+		self.bits = bytearray((self.size + 7) // 8)
+		self.count = 0
+
+	def _positions(self, item):
+		# Double hashing: k positions from two 64-bit halves of one digest
+		digest = hashlib.blake2b(item.encode(), digest_size=16).digest()
+		h1 = int.from_bytes(digest[:8], "little")
+		h2 = int.from_bytes(digest[8:], "little") | 1
+		size = self.size
+		for _ in range(self.hashes):
+			yield h1 % size
+			h1 += h2
+
+	def add(self, item):
+		bits = self.bits
+		for pos in self._positions(item):
+			bits[pos >> 3] |= 1 << (pos & 7)
+		self.count += 1
+
+	def __contains__(self, item):
+		bits = self.bits
+		for pos in self._positions(item):
+			if not bits[pos >> 3] & (1 << (pos & 7)):
+				return False
+		return True